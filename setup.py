@@ -33,6 +33,10 @@ setup(name='pymusepipe',
       install_requires=['mpdaf', 'numpy', 'scipy', 'astropy'],
       include_package_data=True,
       zip_safe=False,
+      entry_points={
+        'console_scripts': ['pymusepipe-worker = pymusepipe.job_queue:main',
+                            'pymusepipe-benchmark = pymusepipe.benchmark_pipe:main'],
+       },
       classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -19,6 +19,9 @@ from os.path import join as joinpath
 
 import glob
 import copy
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 # Import Matplotlib
 import matplotlib.pyplot as plt
@@ -26,11 +29,12 @@ import matplotlib.pyplot as plt
 # Import Numpy Scipy
 import numpy as np
 import scipy.ndimage as nd
-from scipy.signal import correlate
+from scipy.fft import rfftn, irfftn, next_fast_len
 from scipy.odr import ODR, Model, RealData
 
 # Astropy
 from astropy import wcs as awcs
+from astropy.wcs.utils import proj_plane_pixel_area
 from astropy.io import fits as pyfits
 from astropy.modeling import models, fitting
 from astropy.stats import mad_std, sigma_clip
@@ -49,6 +53,7 @@ def is_sequence(arg):
 
 # Import needed modules from pymusepipe
 from . import util_pipe as upipe
+from .trace_pipe import traced
 from .config_pipe import mjd_names, date_names, tpl_names
 from .config_pipe import pointing_names, iexpo_names
 from .config_pipe import default_offset_table, dict_listObject
@@ -68,6 +73,23 @@ default_reference_unit = u.microJansky
 dict_equivalencies = {"WFI_BB": u.spectral_density(6483.58 * u.AA),
                    "DUPONT_R": u.spectral_density(6483.58 * u.AA)}
 
+# Keywords defining the grid of an image (with its shape)
+list_grid_keywords = ['CTYPE1', 'CTYPE2', 'CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2',
+                      'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'CDELT1', 'CDELT2',
+                      'PC1_1', 'PC1_2', 'PC2_1', 'PC2_2', 'CROTA2']
+# Maximum number of images cross-correlated in one batch
+crosscorr_batch_size = 16
+# Maximum shift (pixels) of a target grid for which the cached
+# projection of the reference is reused
+reprojection_cache_margin = 50
+# Maximum number of cached projections of the reference
+max_reprojection_cache = 256
+# Attributes of AlignMusePointing given to the worker processes
+list_align_worker_attributes = ['border', 'chunk_size', 'subim_window', 'median_window',
+                                'dynamic_range', 'conversion_factor', 'use_mpdaf',
+                                'use_polynorm', 'minflux_crosscorr', 'header_folder_name',
+                                'use_reprojection_cache']
+
 # ================== Useful function ====================== #
 def create_offset_table(image_names=[], table_folder="", 
         table_name="dummy_offset_table.fits", overwrite=False):
@@ -107,7 +129,11 @@ def create_offset_table(image_names=[], table_folder="",
             upipe.print_warning("[create_offset] Image {0} does not exists".format(ima))
             continue
 
-        head = pyfits.getheader(ima)
+        head = upipe.read_primary_keywords(ima, [date_names['image'],
+                                                 mjd_names['image'],
+                                                 tpl_names['image'],
+                                                 iexpo_names['image'],
+                                                 pointing_names['image']])
         date.append(head[date_names['image']])
         mjd.append(head[mjd_names['image']])
         tpls.append(head[tpl_names['image']])
@@ -501,6 +527,169 @@ def prepare_image(data, border=10, dynamic_range=10,
     return cdata
 
 
+def get_grid_key(hdu, crpix=True):
+    """Key identifying the grid (shape and WCS) of an image hdu
+
+    Input
+    -----
+    hdu: HDU
+    crpix: bool [True]
+        If False, CRPIX is ignored: the grids shifted with respect
+        to each other have the same key
+    """
+    return (hdu.data.shape,) + tuple(hdu.header.get(key) for key in list_grid_keywords
+                                     if crpix or not key.startswith('CRPIX'))
+
+
+class CrossCorrelator(object):
+    """FFT cross-correlation of images with a fixed reference image.
+
+    The real FFT of the reference is computed once, at a fast size
+    (next_fast_len). Each image then costs one forward FFT, one product
+    and one inverse FFT. The result is the same as
+    scipy.signal.correlate(reference, image, mode='full').
+    """
+    def __init__(self, reference, workers=None):
+        """Initialise the correlator
+
+        Input
+        -----
+        reference: 2d array
+            Prepared reference image (see prepare_image)
+        workers: int [None]
+            Number of threads of the FFTs (see scipy.fft)
+        """
+        self.shape = reference.shape
+        self.full_shape = tuple(2 * size - 1 for size in self.shape)
+        self.fft_shape = tuple(next_fast_len(size, real=True) for size in self.full_shape)
+        self.workers = workers
+        self._fft_reference = rfftn(reference, self.fft_shape, workers=workers)
+
+    def _check_shape(self, shape):
+        if tuple(shape) != self.shape:
+            raise ValueError("Image shape {0} differs from the reference "
+                             "shape {1}".format(tuple(shape), self.shape))
+
+    def correlate(self, image):
+        """Cross-correlate one image with the reference
+
+        Input
+        -----
+        image: 2d array
+            Prepared image, with the shape of the reference
+
+        Returns
+        -------
+        ccor: 2d array
+            Cross-correlation (full mode)
+        """
+        self._check_shape(image.shape)
+        fft_image = rfftn(image[::-1, ::-1], self.fft_shape, workers=self.workers)
+        fft_image *= self._fft_reference
+        ccor = irfftn(fft_image, self.fft_shape, workers=self.workers)
+        return ccor[:self.full_shape[0], :self.full_shape[1]]
+
+    def correlate_batch(self, images):
+        """Cross-correlate a set of images with the reference in one call
+
+        Input
+        -----
+        images: list of 2d arrays or 3d array
+            Prepared images, with the shape of the reference
+
+        Returns
+        -------
+        ccor: 3d array
+            Cross-correlations (full mode), one per image
+        """
+        images = np.asarray(images)
+        self._check_shape(images.shape[1:])
+        fft_images = rfftn(images[:, ::-1, ::-1], self.fft_shape, axes=(-2, -1),
+                           workers=self.workers)
+        fft_images *= self._fft_reference
+        ccor = irfftn(fft_images, self.fft_shape, axes=(-2, -1), workers=self.workers)
+        return ccor[:, :self.full_shape[0], :self.full_shape[1]]
+
+
+# State of an alignment worker process (see AlignMusePointing._align_pool)
+_align_worker = {}
+
+
+def _init_align_worker(shm_name, shape, dtype, ref_header, attributes):
+    """Initialise an alignment worker process: the reference data are
+    read from the shared memory block, and a light AlignMusePointing
+    (without the images) does the work for each image
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    align = AlignMusePointing.__new__(AlignMusePointing)
+    align.__dict__.update(attributes)
+    align.verbose, align._debug = False, False
+    align.reference_hdu = pyfits.ImageHDU(data=np.ndarray(shape, dtype=dtype,
+                                                          buffer=shm.buf),
+                                          header=ref_header)
+    align._cache_crosscorr = {}
+    align._cache_reprojection = {}
+    # Per image attributes, only for the image being processed
+    for name in ['list_offmuse_hdu', 'list_proj_refhdu', 'ima_polypar', 'ima_norm_factors',
+                 'ima_background', 'threshold_muse', '_convolve_muse', '_convolve_reference']:
+        setattr(align, name, {})
+    _align_worker.update(shm=shm, align=align)
+
+
+def _get_new_reprojection(align, key, cached):
+    """Projection of the reference cached by a worker for that key,
+    if it is not the one given with the task (None otherwise)
+    """
+    if key is None:
+        return None
+    new_cached = align._cache_reprojection.get(key)
+    return (key, new_cached) if new_cached is not None and new_cached is not cached \
+           else None
+
+
+def _worker_reference_image(task):
+    """Prepared reference image for the cross-correlation, projected
+    onto the grid of one MUSE image (in a worker process)
+    """
+    filename, ext, rotation, minflux, cached = task
+    align = _align_worker['align']
+    with pyfits.open(filename, memmap=False) as hdulist:
+        muse_hdu = hdulist[ext]
+        key = align._get_reprojection_key(muse_hdu, rotation)
+        if cached is not None:
+            align._store_reprojection(key, cached)
+        ima_ref = align._prepare_reference_image(muse_hdu, rotation=rotation,
+                                                 minflux=minflux)
+    return ima_ref, _get_new_reprojection(align, key, cached)
+
+
+def _worker_alignment(task):
+    """Projection of the reference and normalisation of one shifted
+    MUSE image (in a worker process)
+    """
+    nima, filename, ext, header, rotation, threshold, cached, kwargs = task
+    align = _align_worker['align']
+    with pyfits.open(filename, memmap=False) as hdulist:
+        align.list_offmuse_hdu[nima] = pyfits.PrimaryHDU(hdulist[ext].data, header=header)
+    align.threshold_muse[nima] = threshold
+    key = align._get_reprojection_key(align.list_offmuse_hdu[nima], rotation)
+    if cached is not None:
+        align._store_reprojection(key, cached)
+    _, align.list_proj_refhdu[nima], diffra_angle = align._align_reference_hdu(
+            hdu_target=align.list_offmuse_hdu[nima], target_rotation=rotation)
+    align.get_image_normfactor(nima, **kwargs)
+
+    proj_refhdu = align.list_proj_refhdu.pop(nima)
+    result = {'proj_data': proj_refhdu.data, 'proj_header': proj_refhdu.header,
+              'diffra_angle': diffra_angle, 'polypar': align.ima_polypar.pop(nima),
+              'reprojection': _get_new_reprojection(align, key, cached)}
+    for name in ['ima_norm_factors', 'ima_background', 'threshold_muse',
+                 '_convolve_muse', '_convolve_reference']:
+        result[name] = getattr(align, name).pop(nima, None)
+    align.list_offmuse_hdu.pop(nima)
+    return result
+
+
 def rotate_pixtables(folder="", name_suffix="", list_ifu=None,
                      angle=0., **kwargs):
     """Will update the derotator angle in each of the 24 pixtables
@@ -561,14 +750,19 @@ def rotate_pixtable(folder="", name_suffix="", nifu=1, angle=0., **kwargs):
         return
 
     # Continue with updating the table
-    mypix = pyfits.open(fullname_pixtable, mode='update')
-    hd = mypix[0].header
     if not fakemode and angle != 0.0:
+        mypix = pyfits.open(fullname_pixtable, mode='update')
+        hd = mypix[0].header
         if not angle_orig_keyword in hd:
             hd[angle_orig_keyword] = hd[angle_keyword]
         hd[angle_keyword] = hd[angle_orig_keyword] + angle
         upipe.print_info("Updating INS DROT POSANG for {0}".format(name_pixtable))
         mypix.flush()
+        mypix.close()
+    # Otherwise only read the angles from the header
+    else:
+        hd = upipe.read_primary_keywords(fullname_pixtable,
+                                         [angle_keyword, angle_orig_keyword])
 
     # Reading the result and printing
     print("=== {} === ".format(name_pixtable), end="")
@@ -669,6 +863,16 @@ class AlignMusePointing(object):
             Input MUSE flux unit
         minflux_crosscorr: float [0]
             Minimum flux to consider when doing the cross-correlation.
+        n_workers: int [1]
+            Number of processes used for the projections of the
+            reference and the normalisations of the images (the
+            reference image is shared with them through shared memory),
+            and number of threads of the cross-correlation FFTs. The
+            projections made by the processes are kept in the caches.
+        use_reprojection_cache: bool [True]
+            Keep the projection of the reference for each MUSE grid and
+            rotation: a shifted grid (new CRPIX) then only needs a
+            bilinear interpolation instead of a full reprojection.
         """
 
         # Some input variables for the cross-correlation
@@ -762,6 +966,13 @@ class AlignMusePointing(object):
                                               self.folder_offset_table)
         self.name_offset_table = kwargs.pop("name_offset_table", None)
         self.minflux_crosscorr = kwargs.pop("minflux_crosscorr", 0.)
+        # Cross-correlators of the prepared reference, per grid
+        self._cache_crosscorr = {}
+        # Number of processes for the work done on each image
+        self.n_workers = kwargs.pop("n_workers", 1)
+        # Projections of the reference, per grid (without CRPIX) and rotation
+        self.use_reprojection_cache = kwargs.pop("use_reprojection_cache", True)
+        self._cache_reprojection = {}
 
         # Get the MUSE images
         self._get_list_muse_images()
@@ -817,8 +1028,7 @@ class AlignMusePointing(object):
         self.init_guess_offset(self.firstguess)
 
         # Now doing the shifts and projections with the guess/input values
-        for nima in range(self.nimages):
-            self._apply_alignment(nima)
+        self._apply_alignments()
 
     def show_norm_factors(self):
         """Print some information about the normalisation factors.
@@ -845,6 +1055,7 @@ class AlignMusePointing(object):
                     self.ima_polypar[nima].beta[0], 
                     self.ima_polypar[nima].beta[1]))
 
+    @traced("alignment")
     def init_guess_offset(self, firstguess="crosscorr"):
         """Initialise first guess, either from cross-correlation (default)
         or from an Offset FITS Table
@@ -1176,6 +1387,7 @@ class AlignMusePointing(object):
                          overwrite=overwrite)
         self.name_output_table = name_output_table
 
+    @traced("alignment")
     def run(self, nima=0, **kwargs):
         """Run the offset and comparison
          
@@ -1270,6 +1482,29 @@ class AlignMusePointing(object):
         # Number of images to deal with
         self.nimages = len(self.list_muse_images)
 
+    def _get_muse_filename(self, nima):
+        return joinpath(self.folder_muse_images, self.list_muse_images[nima])
+
+    @contextmanager
+    def _align_pool(self):
+        """Pool of n_workers processes, sharing the reference data
+        through a shared memory block
+        """
+        ref_data = np.ascontiguousarray(self.reference_hdu.data)
+        shm = shared_memory.SharedMemory(create=True, size=max(ref_data.nbytes, 1))
+        try:
+            np.ndarray(ref_data.shape, dtype=ref_data.dtype, buffer=shm.buf)[...] = ref_data
+            attributes = {name: getattr(self, name) for name in list_align_worker_attributes}
+            with ProcessPoolExecutor(max_workers=self.n_workers,
+                                     initializer=_init_align_worker,
+                                     initargs=(shm.name, ref_data.shape, ref_data.dtype.str,
+                                               self.reference_hdu.header,
+                                               attributes)) as executor:
+                yield executor
+        finally:
+            shm.close()
+            shm.unlink()
+
     def open_hdu(self):
         """Open the HDU of the MUSE and reference images
         """
@@ -1343,6 +1578,8 @@ class AlignMusePointing(object):
         hdulist_reference = pyfits.open(joinpath(self.folder_reference,
                                         self.name_reference))
         self.reference_hdu = hdulist_reference[self.hdu_ext[0]]
+        self._cache_crosscorr = {}
+        self._cache_reprojection = {}
         if self.reference_hdu.data is None:
             upipe.print_error("No data found in extension of reference frame")
             upipe.print_error("Check your input, "
@@ -1351,6 +1588,7 @@ class AlignMusePointing(object):
 
         return 1
 
+    @traced("alignment")
     def find_ncross_peak(self, list_nima=None, minflux=None):
         """Run the cross correlation peaks on all MUSE images
         Derive the self.cross_off_pixel/arcsec parameters
@@ -1369,62 +1607,143 @@ class AlignMusePointing(object):
         if list_nima is None:
             list_nima = range(self.nimages)
 
+        # The references for the grids not yet in the cache are
+        # prepared by the worker processes, and added to the cache
+        if self.n_workers > 1:
+            dict_missing = {}
+            for nima in list_nima:
+                key = self._get_crosscorr_key(self.list_muse_hdu[nima],
+                                              self.init_rotangles[nima], minflux)
+                if key not in self._cache_crosscorr:
+                    dict_missing.setdefault(key, nima)
+            if len(dict_missing) > 1:
+                self._prepare_reference_images(dict_missing, minflux)
+
+        # Grouping the images with the same cross-correlator (grid)
+        dict_groups = {}
         for nima in list_nima:
-            self.cross_off_pixel[nima] = self.find_cross_peak(
-                    self.list_muse_hdu[nima],
-                    self.list_name_musehdr[nima], 
-                    rotation=self.init_rotangles[nima],
-                    minflux=minflux)
-            self.cross_off_arcsec[nima] = pixel_to_arcsec(
-                    self.list_muse_hdu[nima],
-                    self.cross_off_pixel[nima])
+            correlator = self._get_crosscorrelator(self.list_muse_hdu[nima],
+                                                   self.list_name_musehdr[nima],
+                                                   rotation=self.init_rotangles[nima],
+                                                   minflux=minflux)
+            dict_groups.setdefault(id(correlator), (correlator, []))[1].append(nima)
+
+        for correlator, list_group in dict_groups.values():
+            for i in range(0, len(list_group), crosscorr_batch_size):
+                list_batch = list_group[i: i + crosscorr_batch_size]
+                list_ccor = correlator.correlate_batch(
+                        [self._prepare_muse_image(self.list_muse_hdu[nima], minflux)
+                         for nima in list_batch])
+                for nima, ccor in zip(list_batch, list_ccor):
+                    self.cross_off_pixel[nima] = self._fit_cross_peak(ccor)
+                    self.cross_off_arcsec[nima] = pixel_to_arcsec(
+                            self.list_muse_hdu[nima],
+                            self.cross_off_pixel[nima])
+
+    def _prepare_reference_images(self, dict_nima, minflux=None):
+        """Prepare the reference images of several grids with the
+        n_workers processes, and add their cross-correlators (and
+        projections of the reference) to the caches
+
+        Input
+        -----
+        dict_nima: dict
+            Index of one MUSE image for each key of the cross-correlator
+        minflux: minimum flux to be used in the cross-correlation
+        """
+        list_tasks = []
+        for nima in dict_nima.values():
+            key = self._get_reprojection_key(self.list_muse_hdu[nima],
+                                             self.init_rotangles[nima])
+            list_tasks.append((self._get_muse_filename(nima), self.hdu_ext[1],
+                               self.init_rotangles[nima], minflux,
+                               self._cache_reprojection.get(key)))
+        with self._align_pool() as executor:
+            list_results = list(executor.map(_worker_reference_image, list_tasks))
+        for key, (ima_ref, reprojection) in zip(dict_nima, list_results):
+            self._cache_crosscorr[key] = CrossCorrelator(ima_ref, workers=self.n_workers)
+            if reprojection is not None:
+                self._store_reprojection(*reprojection)
+
+    def _get_crosscorr_key(self, muse_hdu, rotation=0.0, minflux=None):
+        """Key of the cross-correlator of a MUSE grid (see
+        _get_crosscorrelator)
+        """
+        if minflux is None:
+            minflux = self.minflux_crosscorr
+        return (get_grid_key(muse_hdu), rotation, minflux, self.border,
+                self.dynamic_range, self.median_window, self.conversion_factor)
+
+    def _get_crosscorrelator(self, muse_hdu, name_musehdr, rotation=0.0, minflux=None):
+        """Get the cross-correlator of the reference projected onto the
+        MUSE grid, from the cache if the same grid, rotation and
+        parameters were already used (not in debug mode, to keep the
+        intermediate images). The MUSE header is saved in any case.
 
-    def find_cross_peak(self, muse_hdu, name_musehdr, rotation=0.0, minflux=None):
-        """Aligns the MUSE HDU to a reference HDU
-         
         Input
         -----
         muse_hdu: MUSE hdu file
         name_musehdr: name of the muse hdr to save
-        rotation: Angle in degrees (0). 
+        rotation: Angle in degrees (0).
         minflux: minimum flux to be used in the cross-correlation
-                Flux below that value will be set to 0.
-                Default is 0.
-        
+
         Returns
         -------
-        xpix_cross
-        ypix_cross: x and y pixel coordinates of the cross-correlation peak
+        correlator: CrossCorrelator
         """
-        # Projecting the reference image onto the MUSE field
         tmphdr = muse_hdu.header.totextfile(joinpath(self.header_folder_name,
                                             name_musehdr), overwrite=True)
-        hdu_target, proj_ref_hdu, diffra_angle  = self._align_reference_hdu(muse_hdu,
-                                                        target_rotation=rotation)
+        key = self._get_crosscorr_key(muse_hdu, rotation, minflux)
+        if key not in self._cache_crosscorr or self._debug:
+            ima_ref = self._prepare_reference_image(muse_hdu, rotation=rotation,
+                                                    minflux=minflux)
+            self._cache_crosscorr[key] = CrossCorrelator(
+                    ima_ref, workers=self.n_workers if self.n_workers > 1 else None)
+        return self._cache_crosscorr[key]
+
+    def _prepare_reference_image(self, muse_hdu, rotation=0.0, minflux=None):
+        """Project the reference image onto the MUSE grid and clean it
+        for the cross-correlation
 
-        # Cleaning the images
+        Returns
+        -------
+        ima_ref: 2d array
+        """
         if minflux is None:
             minflux = self.minflux_crosscorr
 
+        # Projecting the reference image onto the MUSE field
+        hdu_target, proj_ref_hdu, diffra_angle  = self._align_reference_hdu(muse_hdu,
+                                                        target_rotation=rotation)
+
+        # Cleaning the image
         minflux_ref = minflux / self.conversion_factor
         ima_ref = prepare_image(proj_ref_hdu.data, self.border, 
                                 self.dynamic_range,
                                 self.median_window,
                                 minflux=minflux_ref) * self.conversion_factor
-        ima_muse = prepare_image(muse_hdu.data, self.border, 
-                self.dynamic_range, self.median_window,
-                minflux=minflux)
         if self._debug:
-            self._temp_input_origmuse_cc = muse_hdu.data * 1.0
             self._temp_input_origref_cc = proj_ref_hdu.data * 1.0
-
-        # Cross-correlate the images
-        ccor = correlate(ima_ref, ima_muse, mode='full', method='auto')
-        if self._debug:
-            self._temp_ima_muse_tocc = ima_muse * 1.0
             self._temp_ima_ref_tocc = ima_ref * 1.0
-            self._temp_cc = ccor * 1.0
+        return ima_ref
+
+    def _prepare_muse_image(self, muse_hdu, minflux=None):
+        """Clean the MUSE image for the cross-correlation
+        """
+        if minflux is None:
+            minflux = self.minflux_crosscorr
+        return prepare_image(muse_hdu.data, self.border, 
+                             self.dynamic_range, self.median_window,
+                             minflux=minflux)
 
+    def _fit_cross_peak(self, ccor):
+        """Fit the peak of a cross-correlation with a 2D Gaussian
+
+        Returns
+        -------
+        xpix_cross
+        ypix_cross: x and y pixel coordinates of the cross-correlation peak
+        """
         # Find peak of cross-correlation
         maxy, maxx = np.unravel_index(np.argmax(ccor),
                                       ccor.shape)
@@ -1458,6 +1777,39 @@ class AlignMusePointing(object):
 
         return xpix_cross, ypix_cross
 
+    def find_cross_peak(self, muse_hdu, name_musehdr, rotation=0.0, minflux=None):
+        """Aligns the MUSE HDU to a reference HDU. The reference
+        projected onto the MUSE grid is prepared once per grid and
+        rotation (see _get_crosscorrelator).
+         
+        Input
+        -----
+        muse_hdu: MUSE hdu file
+        name_musehdr: name of the muse hdr to save
+        rotation: Angle in degrees (0). 
+        minflux: minimum flux to be used in the cross-correlation
+                Flux below that value will be set to 0.
+                Default is 0.
+        
+        Returns
+        -------
+        xpix_cross
+        ypix_cross: x and y pixel coordinates of the cross-correlation peak
+        """
+        correlator = self._get_crosscorrelator(muse_hdu, name_musehdr,
+                                               rotation=rotation, minflux=minflux)
+        ima_muse = self._prepare_muse_image(muse_hdu, minflux=minflux)
+        if self._debug:
+            self._temp_input_origmuse_cc = muse_hdu.data * 1.0
+
+        # Cross-correlate the images
+        ccor = correlator.correlate(ima_muse)
+        if self._debug:
+            self._temp_ima_muse_tocc = ima_muse * 1.0
+            self._temp_cc = ccor * 1.0
+
+        return self._fit_cross_peak(ccor)
+
     def save_image(self, newfits_name=None, nima=0):
         """Save the newly determined hdu
          
@@ -1509,6 +1861,7 @@ class AlignMusePointing(object):
 
         return lperc, hperc
 
+    @traced("alignment")
     def _align_hdu(self, hdu_target=None, hdu_to_align=None, target_rotation=0.0,
                    to_align_rotation=0.0, conversion=False,
                    check_referential=True):
@@ -1616,13 +1969,138 @@ class AlignMusePointing(object):
         -------
         hdu_repr: HDU
             Reprojected HDU. None if nothing is provided
+
+        The projection is cached (see use_reprojection_cache). If the
+        target grid only differs from a cached one by its CRPIX, the
+        cached pixel mapping is shifted and the reference interpolated
+        (bilinear) on it, without a new reprojection.
+        """
+        key = self._get_reprojection_key(hdu_target, target_rotation, ref_rotation)
+        if key is None:
+            return self._align_hdu(hdu_target=hdu_target,
+                                   target_rotation=target_rotation,
+                                   to_align_rotation=ref_rotation,
+                                   hdu_to_align=self.reference_hdu,
+                                   conversion=True)
+
+        crpix = np.array([hdu_target.header['CRPIX1'], hdu_target.header['CRPIX2']],
+                         dtype=np.float64)
+        cached = self._cache_reprojection.get(key)
+        if cached is not None and np.all(np.abs(crpix - cached['crpix'])
+                                         < reprojection_cache_margin):
+            return self._shift_reprojection(cached, hdu_target, crpix)
+
+        hdu_target_rot, hdu_aligned, diffang = self._align_hdu(hdu_target=hdu_target,
+                                   target_rotation=target_rotation,
+                                   to_align_rotation=ref_rotation,
+                                   hdu_to_align=self.reference_hdu,
+                                   conversion=True)
+        self._store_reprojection(key, self._get_reprojection_mapping(
+                hdu_target_rot, hdu_aligned, diffang, crpix, ref_rotation))
+        return hdu_target_rot, hdu_aligned, diffang
+
+    def _get_reprojection_key(self, hdu_target, target_rotation=0.0, ref_rotation=0.0):
+        """Key of the cached projection of the reference onto a target
+        grid: the grid without CRPIX, the rotations and the conversion
+        factor. None if the cache is not used.
         """
+        if not self.use_reprojection_cache or self.use_mpdaf or hdu_target is None:
+            return None
+        return get_grid_key(hdu_target, crpix=False) + (target_rotation, ref_rotation,
+                                                        self.conversion_factor)
+
+    def _store_reprojection(self, key, cached):
+        """Add a projection of the reference to the cache, removing the
+        oldest one if the cache is full
+        """
+        self._cache_reprojection.pop(key, None)
+        if len(self._cache_reprojection) >= max_reprojection_cache:
+            self._cache_reprojection.pop(next(iter(self._cache_reprojection)))
+        self._cache_reprojection[key] = cached
+
+    def _get_reprojection_mapping(self, hdu_target, hdu_aligned, diffang, crpix,
+                                  ref_rotation=0.0):
+        """Compute the position in the reference of each pixel of the
+        target grid (extended by reprojection_cache_margin pixels), to
+        be reused for shifted grids
+
+        Input
+        -----
+        hdu_target: HDU
+            Target (rotated) as given by _align_hdu
+        hdu_aligned: HDU
+            Reference projected onto it
+        diffang: float
+        crpix: array of 2 floats
+            CRPIX of the input (not rotated) target
+        ref_rotation: float [0]
+
+        Returns
+        -------
+        cached: dict
+            With the mapping, the cutout of the reference covering it,
+            and the projection for that crpix
+        """
+        wcs_target = awcs.WCS(hdu_target.header).celestial
+        wcs_ref = WCS(hdr=self.reference_hdu.header)
+        if ref_rotation != 0.:
+            wcs_ref.rotate(-ref_rotation)
+        wcs_ref = wcs_ref.wcs.celestial
+
+        # Position in the reference of each pixel of the extended target
+        margin = reprojection_cache_margin
+        ny, nx = hdu_aligned.data.shape
+        y, x = np.mgrid[-margin: ny + margin, -margin: nx + margin]
+        ra, dec = wcs_target.wcs_pix2world(x, y, 0)
+        xref, yref = wcs_ref.wcs_world2pix(ra, dec, 0)
+
+        # Cutout of the reference covering the mapping
+        ref_data = self.reference_hdu.data
+        with np.errstate(invalid='ignore'):
+            good = np.isfinite(xref) & np.isfinite(yref)
+        if np.any(good):
+            x0 = int(np.clip(np.floor(np.min(xref[good])) - 2, 0, ref_data.shape[1]))
+            x1 = int(np.clip(np.ceil(np.max(xref[good])) + 3, x0, ref_data.shape[1]))
+            y0 = int(np.clip(np.floor(np.min(yref[good])) - 2, 0, ref_data.shape[0]))
+            y1 = int(np.clip(np.ceil(np.max(yref[good])) + 3, y0, ref_data.shape[0]))
+        else:
+            x0 = x1 = y0 = y1 = 0
 
-        return self._align_hdu(hdu_target=hdu_target,
-                               target_rotation=target_rotation,
-                               to_align_rotation=ref_rotation,
-                               hdu_to_align=self.reference_hdu,
-                               conversion=True)
+        change_area = proj_plane_pixel_area(wcs_target) / proj_plane_pixel_area(wcs_ref)
+        return {'crpix': crpix, 'header': hdu_target.header.copy(),
+                'data': hdu_aligned.data, 'diffang': diffang,
+                'xref': (xref - x0).astype(np.float32), 'yref': (yref - y0).astype(np.float32),
+                'cutout': np.array(ref_data[y0:y1, x0:x1], dtype=np.float64),
+                'factor': change_area * self.conversion_factor}
+
+    def _shift_reprojection(self, cached, hdu_target, crpix):
+        """Projection of the reference onto a target grid shifted with
+        respect to a cached one (see _get_reprojection_mapping)
+
+        Returns
+        -------
+        hdu_target, hdu_aligned, diffang: as _align_hdu
+        """
+        header = cached['header'].copy()
+        header['CRPIX1'], header['CRPIX2'] = crpix[0], crpix[1]
+        hdu_target_rot = pyfits.ImageHDU(data=np.nan_to_num(hdu_target.data),
+                                         header=header, name="DATA")
+
+        shift = crpix - cached['crpix']
+        if np.all(shift == 0.) or cached['cutout'].size == 0:
+            return hdu_target_rot, pyfits.PrimaryHDU(cached['data'].copy()), cached['diffang']
+
+        # Pixel (x, y) of the shifted grid is pixel (x - dx, y - dy) of the cached one
+        ny, nx = cached['data'].shape
+        y, x = np.indices((ny, nx), dtype=np.float64)
+        coords = [y - shift[1] + reprojection_cache_margin,
+                  x - shift[0] + reprojection_cache_margin]
+        xref = nd.map_coordinates(cached['xref'], coords, order=1, mode='nearest')
+        yref = nd.map_coordinates(cached['yref'], coords, order=1, mode='nearest')
+        daligned = nd.map_coordinates(cached['cutout'], [yref, xref], order=1,
+                                      mode='constant', cval=np.nan)
+        return hdu_target_rot, pyfits.PrimaryHDU(daligned * cached['factor']), \
+               cached['diffang']
 
     @property
     def _total_rotangles(self):
@@ -1685,6 +2163,69 @@ class AlignMusePointing(object):
         
         Does not return anything, but could in principle
         """
+        self._shift_muse_hdu(nima)
+
+        upipe.print_info("Image {0:03d} Rotation of {1} will be applied".format(
+                            nima, self._total_rotangles[nima]))
+        # Reprojecting the Reference image onto the new MUSE frame
+        hdu_target, self.list_proj_refhdu[nima], self._diffra_angle[nima] = \
+            self._align_reference_hdu(hdu_target=self.list_offmuse_hdu[nima],
+                                      target_rotation=self._total_rotangles[nima])
+        # Now reading the WCS and saving it in the list
+        self.list_wcs_proj_refhdu[nima] = WCS(
+                self.list_proj_refhdu[nima].header)
+
+        # Getting the normalisation factors again
+        musedata, refdata = self.get_image_normfactor(nima, **kwargs)
+
+    def _apply_alignments(self, list_nima=None, **kwargs):
+        """Apply the alignment (see _apply_alignment) to a list of
+        images, with n_workers processes if n_workers > 1
+
+        Input
+        -----
+        list_nima: list of int [None]
+            Indices of the images. Default is all images.
+        """
+        if list_nima is None:
+            list_nima = range(self.nimages)
+        if self.n_workers <= 1 or len(list_nima) <= 1:
+            for nima in list_nima:
+                self._apply_alignment(nima, **kwargs)
+            return
+
+        list_tasks = []
+        for nima in list_nima:
+            self._shift_muse_hdu(nima)
+            upipe.print_info("Image {0:03d} Rotation of {1} will be applied".format(
+                                nima, self._total_rotangles[nima]))
+            key = self._get_reprojection_key(self.list_offmuse_hdu[nima],
+                                             self._total_rotangles[nima])
+            list_tasks.append((nima, self._get_muse_filename(nima), self.hdu_ext[1],
+                               self.list_offmuse_hdu[nima].header,
+                               self._total_rotangles[nima], self.threshold_muse[nima],
+                               self._cache_reprojection.get(key), kwargs))
+        with self._align_pool() as executor:
+            list_results = list(executor.map(_worker_alignment, list_tasks))
+
+        # Results gathered in the order of the images
+        for nima, result in zip(list_nima, list_results):
+            self.list_proj_refhdu[nima] = pyfits.PrimaryHDU(result['proj_data'],
+                                                            header=result['proj_header'])
+            self.list_wcs_proj_refhdu[nima] = WCS(self.list_proj_refhdu[nima].header)
+            self._diffra_angle[nima] = result['diffra_angle']
+            self.ima_polypar[nima] = result['polypar']
+            # New projections of the reference kept for the next calls
+            if result['reprojection'] is not None:
+                self._store_reprojection(*result['reprojection'])
+            for name in ['ima_norm_factors', 'ima_background', 'threshold_muse',
+                         '_convolve_muse', '_convolve_reference']:
+                if result[name] is not None:
+                    getattr(self, name)[nima] = result[name]
+
+    def _shift_muse_hdu(self, nima=0):
+        """Create the shifted MUSE HDU of image nima, with its WCS
+        """
         # Create a new Header
         newhdr = copy.deepcopy(self.list_muse_hdu[nima].header)
 
@@ -1715,19 +2256,7 @@ class AlignMusePointing(object):
                 joinpath(self.header_folder_name, self.list_name_offmusehdr[nima]), 
                 overwrite=True)
 
-        upipe.print_info("Image {0:03d} Rotation of {1} will be applied".format(
-                            nima, self._total_rotangles[nima]))
-        # Reprojecting the Reference image onto the new MUSE frame
-        hdu_target, self.list_proj_refhdu[nima], self._diffra_angle[nima] = \
-            self._align_reference_hdu(hdu_target=self.list_offmuse_hdu[nima],
-                                      target_rotation=self._total_rotangles[nima])
-        # Now reading the WCS and saving it in the list
-        self.list_wcs_proj_refhdu[nima] = WCS(
-                self.list_proj_refhdu[nima].header)
-
-        # Getting the normalisation factors again
-        musedata, refdata = self.get_image_normfactor(nima, **kwargs)
-
+    @traced("alignment")
     def get_image_normfactor(self, nima=0, median_filter=True, 
             convolve_muse=0., convolve_reference=0.,
             threshold_muse=None, **kwargs):
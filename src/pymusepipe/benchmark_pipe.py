@@ -0,0 +1,318 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS benchmark module. Creates synthetic Raw folders and
+configuration files, and runs MusePipe.run_recipes or MusePipeSample
+with the esorex simulator as recipe backend, to measure the time spent
+by pymusepipe itself (scheduling, I/O, tables) without the MUSE pipeline.
+
+With time_scale=0, the simulated recipes take no time, and the measured
+times are the overheads of pymusepipe and of the esorex processes.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+from os.path import join as joinpath
+import time
+import json
+import argparse
+import tempfile
+
+from astropy.io import fits as pyfits
+from astropy.table import Table
+
+# pymusepipe modules
+from . import util_pipe as upipe
+from .config_pipe import dict_expotypes, dict_calib_tables, dict_recipes_per_num
+from .esorex_simulator import default_time_scale, default_size_scale
+
+# Names of the benchmark configuration files
+name_rc_benchmark = "rc_benchmark.dic"
+name_cal_benchmark = "calib_tables_benchmark.dic"
+# Number of raw frames of each type for one tpl
+dict_benchmark_nframes = {'BIAS': 11, 'FLAT': 11, 'ILLUM': 1, 'WAVE': 15,
+                          'TWILIGHT': 4, 'STD': 1}
+# Start of the synthetic observations
+benchmark_mjd = 58000.
+
+
+def create_benchmark_config(root, folder_config="Config/"):
+    """Write the rc and calibration files of a benchmark, and
+    empty static calibration files
+
+    Input
+    -----
+    root: str
+        Root folder of the benchmark
+    folder_config: str ['Config/']
+        Folder of the configuration files, within root
+
+    Returns
+    -------
+    folder_config, rc_filename, cal_filename
+    """
+    folder_config = joinpath(root, folder_config)
+    folder_calib = joinpath(root, "Calib/")
+    for folder in [folder_config, folder_calib]:
+        os.makedirs(folder, exist_ok=True)
+
+    with open(joinpath(folder_config, name_rc_benchmark), "w") as frc:
+        frc.write("musecalib {0}\n".format(folder_calib))
+        frc.write("musecalib_time {0}\n".format(folder_calib))
+        frc.write("root {0}\n".format(joinpath(root, "")))
+
+    with open(joinpath(folder_config, name_cal_benchmark), "w") as fcal:
+        for key, calfile in dict_calib_tables.items():
+            fcal.write("{0} {1}\n".format(key, calfile))
+            pyfits.PrimaryHDU().writeto(joinpath(folder_calib, calfile), overwrite=True)
+
+    return folder_config, name_rc_benchmark, name_cal_benchmark
+
+
+def create_benchmark_raw(folder_raw, targetname="BENCH", nexpo=4, nsky=0,
+                         musemode="WFM-NOAO-N", mjd=benchmark_mjd,
+                         dict_nframes=dict_benchmark_nframes):
+    """Write the headers of a synthetic set of raw MUSE files:
+    calibrations, one standard star and the science exposures,
+    each type with its own tpl
+
+    Input
+    -----
+    folder_raw: str
+        Raw folder (created if needed)
+    targetname: str
+    nexpo: int [4]
+        Number of OBJECT exposures
+    nsky: int [0]
+        Number of SKY exposures
+    musemode: str ['WFM-NOAO-N']
+    mjd: float
+        MJD of the first frame
+    dict_nframes: dict
+        Number of frames of each calibration type
+
+    Returns
+    -------
+    list of the names of the raw files
+    """
+    os.makedirs(folder_raw, exist_ok=True)
+    list_types = [(expotype, dict_nframes[expotype]) for expotype in dict_nframes]
+    list_types += [('OBJECT', nexpo), ('SKY', nsky)]
+
+    list_files = []
+    # One minute between two frames
+    step_mjd = 1. / 1440.
+    for expotype, nframes in list_types:
+        tpl = time.strftime("%Y-%m-%dT%H:%M:%S",
+                            time.gmtime((mjd - 40587.) * 86400.))
+        for iframe in range(nframes):
+            mjd_frame = mjd + iframe * step_mjd
+            date = time.strftime("%Y-%m-%dT%H:%M:%S",
+                                 time.gmtime((mjd_frame - 40587.) * 86400.))
+            header = pyfits.Header()
+            header['OBJECT'] = targetname if expotype in ['OBJECT', 'SKY'] \
+                               else dict_expotypes[expotype]
+            header['MJD-OBS'] = mjd_frame
+            header['EXPTIME'] = 0. if expotype == 'BIAS' else 100.
+            header['HIERARCH ESO DPR TYPE'] = dict_expotypes[expotype]
+            header['HIERARCH ESO INS MODE'] = musemode
+            header['HIERARCH ESO TPL START'] = tpl
+            header['HIERARCH ESO TPL NEXP'] = nframes
+            header['HIERARCH ESO TPL EXPNO'] = iframe + 1
+            filename = joinpath(folder_raw, "MUSE.{0}.{1:03d}.fits".format(date, iframe))
+            pyfits.PrimaryHDU(header=header).writeto(filename, overwrite=True)
+            list_files.append(filename)
+        mjd += (nframes + 10) * step_mjd
+
+    return list_files
+
+
+def _get_recipe_kwargs(time_scale, size_scale, kwargs):
+    """Arguments of the MusePipe to run the recipes with the simulator
+    """
+    kwargs.setdefault("recipe_backend", "simulator")
+    kwargs.setdefault("simulator_options", {'time_scale': time_scale,
+                                            'size_scale': size_scale})
+    kwargs.setdefault("likwid", None)
+    return kwargs
+
+
+def benchmark_musepipe(root, targetname="BENCH", pointing=1, nexpo=4,
+                       first_recipe=1, last_recipe="sky",
+                       time_scale=default_time_scale, size_scale=default_size_scale,
+                       **kwargs):
+    """Benchmark MusePipe.run_recipes on one synthetic pointing
+
+    Input
+    -----
+    root: str
+        Root folder of the benchmark (created if needed)
+    targetname: str ['BENCH']
+    pointing: int [1]
+    nexpo: int [4]
+        Number of OBJECT exposures
+    first_recipe, last_recipe: int or str [1, 'sky']
+        Recipes to run. The recipes after 'sky' need real images.
+    time_scale, size_scale: float
+        Scaling of the time and size of the simulated recipes
+    **kwargs:
+        Other arguments of MusePipe (e.g., max_parallel_recipes)
+
+    Returns
+    -------
+    dict of the times (s) of the initialisation, of the raw table
+    and of the recipes
+    """
+    # Import here as it needs the full pymusepipe
+    from .musepipe import MusePipe
+
+    folder_config, rc_filename, cal_filename = create_benchmark_config(root)
+    create_benchmark_raw(joinpath(root, targetname, "P{0:02d}".format(pointing), "Raw"),
+                         targetname=targetname, nexpo=nexpo)
+    kwargs = _get_recipe_kwargs(time_scale, size_scale, kwargs)
+
+    dict_times = {'mode': 'musepipe', 'npointings': 1, 'nexpo': nexpo,
+                  'time_scale': time_scale, 'size_scale': size_scale}
+    start = time.perf_counter()
+    mypipe = MusePipe(targetname=targetname, pointing=pointing, folder_config=folder_config,
+                      rc_filename=rc_filename, cal_filename=cal_filename,
+                      first_recipe=first_recipe, last_recipe=last_recipe,
+                      init_raw_table=False, **kwargs)
+    dict_times['init'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mypipe.init_raw_table(overwrite=True)
+    dict_times['raw_table'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mypipe.run_recipes()
+    dict_times['recipes'] = time.perf_counter() - start
+    dict_times['total'] = dict_times['init'] + dict_times['raw_table'] \
+                          + dict_times['recipes']
+    dict_times['failed_commands'] = len(mypipe.get_failed_commands())
+    return dict_times
+
+
+def benchmark_sample(root, ntargets=1, npointings=2, nexpo=4, subfolder="P000",
+                     last_recipe="sky", n_parallel_pointings=1,
+                     time_scale=default_time_scale, size_scale=default_size_scale,
+                     **kwargs):
+    """Benchmark MusePipeSample.reduce_target on synthetic targets
+
+    Input
+    -----
+    root: str
+        Root folder of the benchmark (created if needed)
+    ntargets: int [1]
+    npointings: int [2]
+        Number of pointings of each target
+    nexpo: int [4]
+        Number of OBJECT exposures per pointing
+    subfolder: str ['P000']
+        Subfolder of the targets
+    last_recipe: int or str ['sky']
+    n_parallel_pointings: int [1]
+        Number of pointings reduced at the same time
+    time_scale, size_scale: float
+        Scaling of the time and size of the simulated recipes
+    **kwargs:
+        Other arguments of the MusePipe of each pointing
+
+    Returns
+    -------
+    dict of the times (s) of the initialisation and of the reduction
+    """
+    # Import here as it needs the full pymusepipe
+    from .target_sample import MusePipeSample
+
+    folder_config, rc_filename, cal_filename = create_benchmark_config(root)
+    TargetDic = {}
+    for itarget in range(ntargets):
+        targetname = "BENCH{0:02d}".format(itarget + 1)
+        TargetDic[targetname] = [subfolder, {pointing: 1 for pointing
+                                             in range(1, npointings + 1)}]
+        for pointing in range(1, npointings + 1):
+            create_benchmark_raw(joinpath(root, subfolder, targetname,
+                                          "P{0:02d}".format(pointing), "Raw"),
+                                 targetname=targetname, nexpo=nexpo)
+    kwargs = _get_recipe_kwargs(time_scale, size_scale, kwargs)
+
+    dict_times = {'mode': 'sample', 'npointings': ntargets * npointings, 'nexpo': nexpo,
+                  'time_scale': time_scale, 'size_scale': size_scale}
+    start = time.perf_counter()
+    mysample = MusePipeSample(TargetDic, rc_filename=rc_filename, cal_filename=cal_filename,
+                              folder_config=folder_config, init_pipes=False,
+                              n_parallel_pointings=n_parallel_pointings)
+    dict_times['init'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for targetname in mysample.targetnames:
+        mysample.reduce_target(targetname=targetname, first_recipe=1,
+                               last_recipe=last_recipe, **kwargs)
+    dict_times['raw_table'] = 0.
+    dict_times['recipes'] = time.perf_counter() - start
+    dict_times['total'] = dict_times['init'] + dict_times['recipes']
+    return dict_times
+
+
+def main(argv=None):
+    """Run the benchmarks and print (and save) the times
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of pymusepipe "
+                                     "with the esorex simulator")
+    parser.add_argument("--root", default=None,
+                        help="Root folder (default: a new temporary folder)")
+    parser.add_argument("--mode", default="musepipe",
+                        choices=["musepipe", "sample", "all"])
+    parser.add_argument("--nexpo", type=int, default=4)
+    parser.add_argument("--ntargets", type=int, default=1)
+    parser.add_argument("--npointings", type=int, default=2)
+    parser.add_argument("--n-parallel-pointings", type=int, default=1)
+    parser.add_argument("--max-parallel-recipes", type=int, default=1)
+    parser.add_argument("--last-recipe", default="sky",
+                        choices=[dict_recipes_per_num[key] for key in
+                                 sorted(dict_recipes_per_num)])
+    parser.add_argument("--time-scale", type=float, default=default_time_scale)
+    parser.add_argument("--size-scale", type=float, default=default_size_scale)
+    parser.add_argument("--output", default=None,
+                        help="Name of a json file where the times are saved")
+    args = parser.parse_args(argv)
+
+    root = args.root
+    if root is None:
+        root = tempfile.mkdtemp(prefix="pymusepipe_benchmark_")
+    upipe.print_info("Benchmark in folder {0}".format(root))
+
+    list_results = []
+    if args.mode in ["musepipe", "all"]:
+        list_results.append(benchmark_musepipe(joinpath(root, "musepipe"), nexpo=args.nexpo,
+                             last_recipe=args.last_recipe, time_scale=args.time_scale,
+                             size_scale=args.size_scale,
+                             max_parallel_recipes=args.max_parallel_recipes))
+    if args.mode in ["sample", "all"]:
+        list_results.append(benchmark_sample(joinpath(root, "sample"), ntargets=args.ntargets,
+                            npointings=args.npointings, nexpo=args.nexpo,
+                            last_recipe=args.last_recipe,
+                            n_parallel_pointings=args.n_parallel_pointings,
+                            time_scale=args.time_scale, size_scale=args.size_scale,
+                            max_parallel_recipes=args.max_parallel_recipes))
+
+    names = ['mode', 'npointings', 'nexpo', 'init', 'raw_table', 'recipes', 'total']
+    summary = Table(rows=[[result[name] for name in names] for result in list_results],
+                    names=names)
+    for name in ['init', 'raw_table', 'recipes', 'total']:
+        summary[name].format = "{:.3f}"
+    summary.pprint(max_lines=-1, max_width=-1)
+
+    if args.output is not None:
+        with open(args.output, "w") as fout:
+            json.dump(list_results, fout, indent=1)
+    return list_results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS calibration plan module. The plan associates each
+science tpl (and exposure) with its closest calibrations, so that the
+SOF writers do not need to search the calibration tables again.
+It is saved as a json file and only the entries whose inputs have
+changed are recomputed.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+import json
+import hashlib
+
+# Numpy
+import numpy as np
+
+# Version of the format of the plan file
+calib_plan_version = 1
+
+
+def get_table_signature(table):
+    """Get a signature of the tpls and mjd columns of a table.
+    Returns an empty string for an empty table.
+    """
+    if len(table) == 0:
+        return ""
+    sig = hashlib.sha1()
+    for colname in ['tpls', 'mjd']:
+        if colname in table.colnames:
+            sig.update(np.ascontiguousarray(np.asarray(table[colname])).tobytes())
+    return sig.hexdigest()
+
+
+class CalibPlan(object):
+    """Calibration plan. Each entry is a science point (a tpl or a single
+    exposure of a given expotype) with its mjd and, for each calibration
+    (expotype, stage), the row index and tpl of the closest calibration.
+    The signature of each calibration table is stored so that entries
+    using an obsolete table are not used.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Removing all entries
+        """
+        self.entries = {}
+        self.signatures = {}
+        self._lookup = {}
+
+    @staticmethod
+    def calib_key(expotype, stage="master"):
+        return "{0}/{1}".format(expotype, stage)
+
+    @staticmethod
+    def mjd_key(mjd):
+        return repr(float(mjd))
+
+    def _build_lookup(self):
+        """Building the dictionary used to find an entry from the mjd
+        """
+        self._lookup = {}
+        for entry in self.entries.values():
+            mjdkey = self.mjd_key(entry['mjd'])
+            for calibkey, (index, tpl) in entry['calibs'].items():
+                self._lookup[(calibkey, mjdkey)] = (index, tpl)
+
+    def lookup(self, mjd, expotype, stage, signature):
+        """Get the index and tpl of the calibration associated with an mjd
+
+        Input
+        -----
+        mjd: float
+        expotype: str
+        stage: str
+        signature: str
+            Signature of the current table for expotype and stage
+
+        Returns
+        -------
+        index, tpl: int, str or None if not in the plan or if the
+            plan was built with a different table
+        """
+        calibkey = self.calib_key(expotype, stage)
+        if self.signatures.get(calibkey, None) != signature:
+            return None
+        return self._lookup.get((calibkey, self.mjd_key(mjd)), None)
+
+    def update(self, science_points, dict_signatures, select_calib):
+        """Update the plan with the current science points and tables
+
+        Input
+        -----
+        science_points: dict
+            Dictionary of key: [expotype, tpl, iexpo, mjd] for each
+            science point
+        dict_signatures: dict
+            Signature of each calibration table, with calib_key as key
+        select_calib: function
+            Called as select_calib(calibkey, list_mjd) and returning the
+            list of indices and tpls of the closest calibrations
+            (index = -1 if none was found)
+
+        Returns
+        -------
+        nupdate: int
+            Number of science points for which at least one calibration
+            has been recomputed
+        """
+        # Removing the science points which do not exist anymore
+        for key in list(self.entries.keys()):
+            if key not in science_points:
+                del self.entries[key]
+
+        # New or modified science points
+        new_points = []
+        for key, (expotype, tpl, iexpo, mjd) in science_points.items():
+            entry = self.entries.get(key, None)
+            if entry is None or entry['mjd'] != float(mjd):
+                self.entries[key] = {'expotype': expotype, 'tpl': tpl,
+                                     'iexpo': int(iexpo), 'mjd': float(mjd),
+                                     'calibs': {}}
+                new_points.append(key)
+
+        updated = set(new_points)
+        for calibkey, signature in dict_signatures.items():
+            if self.signatures.get(calibkey, None) == signature:
+                # Table unchanged: only the new points are computed
+                list_keys = [key for key in new_points
+                             if calibkey not in self.entries[key]['calibs']]
+            else:
+                list_keys = list(self.entries.keys())
+            if len(list_keys) > 0:
+                list_mjd = [self.entries[key]['mjd'] for key in list_keys]
+                indices, tpls = select_calib(calibkey, list_mjd)
+                for key, index, tpl in zip(list_keys, indices, tpls):
+                    self.entries[key]['calibs'][calibkey] = [int(index), str(tpl)]
+                updated.update(list_keys)
+            self.signatures[calibkey] = signature
+
+        # Removing the calibrations which are not in the plan anymore
+        for calibkey in list(self.signatures.keys()):
+            if calibkey not in dict_signatures:
+                del self.signatures[calibkey]
+                for entry in self.entries.values():
+                    entry['calibs'].pop(calibkey, None)
+
+        self._build_lookup()
+        return len(updated)
+
+    def read(self, filename):
+        """Reading the plan from a json file. Returns False if the
+        file does not exist or cannot be used.
+        """
+        self.reset()
+        if not os.path.isfile(filename):
+            return False
+        try:
+            with open(filename, "r") as fplan:
+                plan = json.load(fplan)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(plan, dict) or plan.get('version', None) != calib_plan_version:
+            return False
+        self.entries = plan.get('entries', {})
+        self.signatures = plan.get('signatures', {})
+        self._build_lookup()
+        return True
+
+    def write(self, filename):
+        """Writing the plan in a json file
+        """
+        plan = {'version': calib_plan_version, 'signatures': self.signatures,
+                'entries': self.entries}
+        # Write first in a temporary file to never leave a broken plan
+        temp_name = filename + ".tmp"
+        with open(temp_name, "w") as fplan:
+            json.dump(plan, fplan, indent=1, sort_keys=True)
+        os.replace(temp_name, filename)
@@ -0,0 +1,200 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS checkpoint module. A marker is written when a unit of
+the reduction (one recipe for one tpl or exposure) is completed, with
+its command and the list of its products (size, time and checksum).
+Another marker is written when all the units of a run_* recipe are
+completed, so that a new run can resume at the first incomplete one.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+from os.path import join as joinpath
+import json
+import zlib
+
+from . import util_pipe as upipe
+
+# Version of the format of the markers
+checkpoint_version = 1
+# Size of the chunks read to compute the checksums
+checksum_chunk_size = 1 << 24
+
+
+def get_file_checksum(filename):
+    """Get the crc32 checksum of a file, read by chunks
+    """
+    crc = 0
+    with open(filename, "rb") as fin:
+        for chunk in iter(lambda: fin.read(checksum_chunk_size), b''):
+            crc = zlib.crc32(chunk, crc)
+    return "crc32:{0:08x}".format(crc & 0xffffffff)
+
+
+def get_product_info(filename, checksum=True):
+    """Get the name, size, modification time and checksum of a product
+    """
+    filestat = os.stat(filename)
+    return {'name': filename, 'size': filestat.st_size,
+            'mtime_ns': filestat.st_mtime_ns,
+            'checksum': get_file_checksum(filename) if checksum else ""}
+
+
+def check_product_info(info, verify="size"):
+    """Check that a product is still the one recorded in a marker
+
+    Input
+    -----
+    info: dict
+        As given by get_product_info
+    verify: str ['size']
+        'exist' only checks that the file exists, 'size' also checks
+        its size and modification time, 'checksum' also computes its
+        checksum again.
+    """
+    if not os.path.isfile(info['name']):
+        return False
+    if verify == "exist":
+        return True
+    filestat = os.stat(info['name'])
+    if filestat.st_size != info['size'] or filestat.st_mtime_ns != info['mtime_ns']:
+        return False
+    if verify == "checksum" and info['checksum'] != "":
+        return get_file_checksum(info['name']) == info['checksum']
+    return True
+
+
+class CheckpointStore(object):
+    """Markers of the completed units and recipes, saved as json files
+    in one folder
+    """
+    def __init__(self, folder, verify="size", checksum=True):
+        """Initialise the store
+
+        Input
+        -----
+        folder: str
+            Folder of the markers (created if needed)
+        verify: str ['size']
+            How the products are checked (see check_product_info)
+        checksum: bool [True]
+            Compute the checksum of the products when writing a marker
+        """
+        self.folder = folder
+        self.verify = verify
+        self.checksum = checksum
+
+    def _get_marker_name(self, name, level="unit"):
+        return joinpath(self.folder, "{0}_{1}.json".format(level, name))
+
+    def _read_marker(self, name, level="unit"):
+        marker_name = self._get_marker_name(name, level)
+        if not os.path.isfile(marker_name):
+            return None
+        try:
+            with open(marker_name, "r") as fmarker:
+                marker = json.load(fmarker)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(marker, dict) or marker.get('version', None) != checkpoint_version:
+            return None
+        return marker
+
+    def _write_marker(self, name, marker, level="unit"):
+        os.makedirs(self.folder, exist_ok=True)
+        marker['version'] = checkpoint_version
+        marker['time'] = upipe.formatted_time()
+        marker_name = self._get_marker_name(name, level)
+        # Write first in a temporary file to never leave a broken marker
+        temp_name = "{0}.{1}.tmp".format(marker_name, os.getpid())
+        with open(temp_name, "w") as fmarker:
+            json.dump(marker, fmarker, indent=1, sort_keys=True)
+        os.replace(temp_name, marker_name)
+
+    def remove(self, name, level="unit"):
+        """Remove a marker
+        """
+        marker_name = self._get_marker_name(name, level)
+        if os.path.isfile(marker_name):
+            os.remove(marker_name)
+
+    def is_unit_complete(self, name, command=None, key=None):
+        """Check if a unit was completed with the same command (if
+        given, and the same inputs if key is given) and if its
+        products are still there
+        """
+        marker = self._read_marker(name)
+        if marker is None or (command is not None and marker['command'] != command):
+            return False
+        if key is not None and marker.get('key', None) != key:
+            return False
+        return all(check_product_info(info, self.verify) for info in marker['products'])
+
+    def write_unit(self, name, command, list_products, pointing=None, key=None, sof=None):
+        """Write the marker of a completed unit
+
+        Input
+        -----
+        name: str
+            Name of the unit (recipe, tpl and exposure)
+        command: str
+            Command of the unit
+        list_products: list of str
+            Names of the products
+        pointing: int
+        key: str [None]
+            Key of the inputs of the unit (command and SOF content)
+        sof: str [None]
+            SOF file of the unit
+        """
+        self._write_marker(name, {'name': name, 'command': command, 'pointing': pointing,
+                                  'key': key, 'sof': sof,
+                                  'products': [get_product_info(product, self.checksum)
+                                               for product in list_products]})
+
+    def is_recipe_complete(self, recipe, inputs=None, get_key=None):
+        """Check if a run_* recipe was completed with the same inputs
+        and if all its units are still complete
+
+        Input
+        -----
+        recipe: str
+        inputs: str [None]
+            Key of the inputs of the recipe (arguments, raw files),
+            compared with the one of the marker
+        get_key: function [None]
+            If given, get_key(command, sof) gives the current key of the
+            inputs of a unit, compared with the one of its marker. Units
+            without SOF (e.g., linked shared calibrations) are only
+            checked with their command and products.
+        """
+        marker = self._read_marker(recipe, level="recipe")
+        if marker is None or len(marker.get('units', [])) == 0 \
+                or marker.get('inputs', None) != inputs:
+            return False
+        for name in marker['units']:
+            unit = self._read_marker(name)
+            if unit is None:
+                return False
+            key = None
+            if get_key is not None and unit.get('sof', None) is not None:
+                if unit.get('key', None) is None:
+                    return False
+                key = get_key(unit['command'], unit['sof'])
+            if not self.is_unit_complete(name, unit['command'], key):
+                return False
+        return True
+
+    def write_recipe(self, recipe, list_units, pointing=None, inputs=None):
+        """Write the marker of a completed run_* recipe with its units
+        and the key of its inputs. Nothing is written if there is no unit
+        """
+        if len(list_units) == 0:
+            return
+        self._write_marker(recipe, {'name': recipe, 'pointing': pointing, 'inputs': inputs,
+                                    'units': sorted(set(list_units))}, level="recipe")
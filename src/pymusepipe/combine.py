@@ -36,6 +36,7 @@ from .recipes_pipe import PipeRecipes
 from .create_sof import SofPipe
 from .init_musepipe import InitMuseParameters
 from . import util_pipe as upipe
+from .trace_pipe import traced
 from .util_pipe import filter_list_with_pdict
 from . import musepipe, prep_recipes_pipe
 from .config_pipe import (default_filter_list, default_PHANGS_filter_list,
@@ -616,7 +617,7 @@ class MusePointings(SofPipe, PipeRecipes):
             os.chdir(newpath)
             upipe.print_info("Going to folder {0}".format(newpath), pipe=self)
             if addtolog:
-                upipe.append_file(self.paths.log_filename, "cd {0}\n".format(newpath))
+                self._append_logfile("cd {0}\n".format(newpath))
             self.paths._prev_folder = prev_folder
         except OSError:
             if not os.path.isdir(newpath):
@@ -650,6 +651,7 @@ class MusePointings(SofPipe, PipeRecipes):
         for name in self.pipe_params._dict_folders_target:
             setattr(self.paths, name, joinpath(self.paths.target, self.pipe_params._dict_folders_target[name]))
 
+    @traced("mosaic")
     def create_reference_wcs(self, pointings_wcs=True, mosaic_wcs=True,
                              reference_cube=True, refcube_name=None,
                              **kwargs):
@@ -704,6 +706,7 @@ class MusePointings(SofPipe, PipeRecipes):
                                         lambdaminmax_wcs=lambdaminmax_for_mosaic,
                                         refcube_name=wcs_refcube_name)
 
+    @traced("run")
     def run_combine_all_single_pointings(self,
                                          add_suffix="",
                                          sof_filename='pointings_combine',
@@ -741,6 +744,7 @@ class MusePointings(SofPipe, PipeRecipes):
                                              sof_filename=sof_filename,
                                              **kwargs)
 
+    @traced("run")
     def run_combine_single_pointing(self, pointing, add_suffix="",
                                     sof_filename='pointing_combine',
                                     **kwargs):
@@ -815,6 +819,7 @@ class MusePointings(SofPipe, PipeRecipes):
             _ = self.create_pointing_wcs(pointing=pointing,
                                          filter_list=filter_list, **kwargs)
 
+    @traced("mosaic")
     def create_pointing_wcs(self, pointing,
             lambdaminmax_mosaic=lambdaminmax_for_mosaic,
             filter_list="white", **kwargs):
@@ -888,6 +893,7 @@ class MusePointings(SofPipe, PipeRecipes):
         upipe.print_info("...Done")
         return full_cname
 
+    @traced("mosaic")
     def extract_combined_narrow_wcs(self, name_cube=None, **kwargs):
         """Create the reference WCS from the full mosaic with
         only 2 lambdas
@@ -946,6 +952,7 @@ class MusePointings(SofPipe, PipeRecipes):
         upipe.print_info("...Done")
         return full_cname
 
+    @traced("mosaic")
     def create_combined_wcs(self, refcube_name=None,
             lambdaminmax_wcs=lambdaminmax_for_wcs,
             **kwargs):
@@ -1001,6 +1008,7 @@ class MusePointings(SofPipe, PipeRecipes):
         upipe.print_info("...Done")
         return combined_wcs_name
 
+    @traced("run")
     def run_combine(self, sof_filename='pointings_combine',
                     lambdaminmax=[4000., 10000.],
                     list_pointings=None,
@@ -182,6 +182,8 @@ dict_folders = {
             "sof" : "Sof/", 
             # Figure
             "figures" : "Figures/",
+            # Checkpoint markers
+            "checkpoints" : "Checkpoints/",
             }
 
 # This dictionary includes extra folders for certain specific task
@@ -309,3 +311,56 @@ dict_recipes_per_num = {1:'bias', 2:'flat', 3:'wave',
 dict_recipes_per_name = {}
 for key in dict_recipes_per_num:
     dict_recipes_per_name[dict_recipes_per_num[key]] = key
+
+# Recipes providing the inputs of each recipe
+dict_recipes_dependencies = {'bias': [],
+               'flat': ['bias'],
+               'wave': ['bias', 'flat'],
+               'lsf': ['bias', 'flat', 'wave'],
+               'twilight': ['bias', 'flat', 'wave'],
+               'scibasic_all': ['bias', 'flat', 'wave', 'twilight'],
+               'standard': ['scibasic_all'],
+               'sky': ['scibasic_all', 'standard', 'lsf'],
+               'prep_align': ['scibasic_all', 'standard', 'sky', 'lsf'],
+               'align_bypointing': ['prep_align'],
+               'align_bygroup': ['prep_align'],
+               'scipost_perexpo': ['scibasic_all', 'standard', 'sky', 'lsf',
+                                   'align_bypointing', 'align_bygroup'],
+               'scipost_sky': ['scibasic_all', 'standard', 'sky', 'lsf'],
+               'combine_pointing': ['scipost_perexpo', 'align_bypointing']}
+
+# Rough memory needs of each recipe in GB (for the recipe scheduler)
+dict_recipes_memory = {'bias': 4, 'flat': 8, 'wave': 8, 'lsf': 8,
+               'twilight': 16, 'scibasic_all': 16, 'standard': 8,
+               'sky': 8, 'prep_align': 32, 'align_bypointing': 2,
+               'align_bygroup': 2, 'scipost_perexpo': 32,
+               'scipost_sky': 32, 'combine_pointing': 64}
+
+#===========================================
+# Calibration plan: science types and list of (expotype, stage)
+# for the calibrations associated with each science tpl and exposure
+list_science_calib_plan = ['OBJECT', 'SKY', 'STD']
+list_calib_plan = [('BIAS', 'master'), ('FLAT', 'master'), ('TRACE', 'master'),
+                   ('WAVE', 'master'), ('LSF', 'master'), ('TWILIGHT', 'master'),
+                   ('STD', 'master'), ('SKY', 'processed'), ('ILLUM', 'raw'),
+                   ('GEOMETRY', 'raw'), ('ASTROMETRY', 'raw')]
+name_calib_plan = "calib_plan.json"
+
+#===========================================
+# Job queue shared between the workers reducing a sample
+name_job_queue = "pymusepipe_jobs.sqlite"
+# Duration of the lease of a job (s) and number of attempts
+default_lease_time = 600.
+default_max_attempts = 3
+
+#===========================================
+# Calibration recipes which can be shared between pointings:
+# raw expotype used and master expotypes produced by each recipe
+dict_shared_calib_recipes = {'bias': ['BIAS', ['BIAS']],
+               'flat': ['FLAT', ['FLAT', 'TRACE']],
+               'wave': ['WAVE', ['WAVE']],
+               'lsf': ['WAVE', ['LSF']],
+               'twilight': ['TWILIGHT', ['TWILIGHT']]}
+list_shared_calib_recipes = ['bias', 'flat', 'wave', 'lsf', 'twilight']
+# Folder of the shared masters, in the root folder of a sample
+name_shared_masters = "Shared_Masters/"
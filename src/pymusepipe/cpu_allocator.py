@@ -0,0 +1,303 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS cpu allocator module. Reads the cpu topology of the host
+(NUMA nodes, cores and threads) and hands out disjoint sets of cpus,
+within one NUMA node when possible, to the recipes running at the same
+time. The cpus are locked with files shared by all the processes of
+the host, so that several pipes do not use the same cores.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+from os.path import join as joinpath
+import re
+import time
+import shutil
+import tempfile
+import threading
+import fcntl
+from contextlib import contextmanager
+
+from . import util_pipe as upipe
+
+# Folder of the host topology
+default_sysfs_folder = "/sys/devices/system"
+# Folder of the lock files, shared by all the pipes of the host
+default_cpu_lock_folder = joinpath(tempfile.gettempdir(), "pymusepipe_cpus")
+# Time (s) between two attempts to get free cpus
+cpu_poll_time = 0.5
+# Time (s) after which fewer cpus than requested are accepted
+default_partial_wait = 30.
+
+
+def parse_cpu_list(cpulist):
+    """Parse a list of cpus in the sysfs format (e.g., '0-3,8,10-11')
+
+    Returns
+    -------
+    list of int
+    """
+    list_cpu = []
+    for item in cpulist.strip().split(','):
+        if item == "":
+            continue
+        start, _, end = item.partition('-')
+        list_cpu += list(range(int(start), int(end or start) + 1))
+    return list_cpu
+
+
+def format_cpu_list(list_cpu):
+    """Format a list of cpus with ranges (e.g., '0-3,8,10-11'), as
+    understood by taskset and likwid-pin
+    """
+    list_cpu = sorted(set(list_cpu))
+    list_ranges = []
+    for cpu in list_cpu:
+        if list_ranges and cpu == list_ranges[-1][1] + 1:
+            list_ranges[-1][1] = cpu
+        else:
+            list_ranges.append([cpu, cpu])
+    return ",".join(["{0}".format(start) if start == end else "{0}-{1}".format(start, end)
+                     for start, end in list_ranges])
+
+
+def _read_sysfs(filename, default=None):
+    try:
+        with open(filename, "r") as fsys:
+            return fsys.read().strip()
+    except OSError:
+        return default
+
+
+def read_cpu_topology(sysfs_folder=default_sysfs_folder):
+    """Read the topology of the cpus usable by the current process
+
+    Input
+    -----
+    sysfs_folder: str
+        Folder with the cpu and node sub-folders
+
+    Returns
+    -------
+    topology: dict
+        For each cpu, a dictionary with its 'node', its 'core'
+        (package and core ids) and its 'thread' (rank among the cpus
+        of the same core)
+    """
+    online = _read_sysfs(joinpath(sysfs_folder, "cpu", "online"))
+    list_cpu = parse_cpu_list(online) if online else list(range(os.cpu_count() or 1))
+    if hasattr(os, "sched_getaffinity"):
+        allowed = os.sched_getaffinity(0)
+        list_cpu = [cpu for cpu in list_cpu if cpu in allowed]
+
+    # NUMA nodes (a single node if not given)
+    dict_node = {}
+    folder_node = joinpath(sysfs_folder, "node")
+    if os.path.isdir(folder_node):
+        for name in os.listdir(folder_node):
+            match = re.match(r"^node(\d+)$", name)
+            cpulist = _read_sysfs(joinpath(folder_node, name, "cpulist"), "")
+            if match is not None:
+                for cpu in parse_cpu_list(cpulist):
+                    dict_node[cpu] = int(match.group(1))
+
+    topology = {}
+    for cpu in list_cpu:
+        folder_topology = joinpath(sysfs_folder, "cpu", "cpu{0}".format(cpu), "topology")
+        package = _read_sysfs(joinpath(folder_topology, "physical_package_id"), "0")
+        core = _read_sysfs(joinpath(folder_topology, "core_id"), "{0}".format(cpu))
+        topology[cpu] = {'node': dict_node.get(cpu, 0), 'core': (int(package), int(core))}
+
+    # Rank of each cpu among the threads of its core
+    dict_threads = {}
+    for cpu in sorted(topology):
+        threads = dict_threads.setdefault(topology[cpu]['core'], [])
+        topology[cpu]['thread'] = len(threads)
+        threads.append(cpu)
+    return topology
+
+
+def get_pin_prefix(list_cpu, likwid=""):
+    """Command prefix pinning a process to a list of cpus, with
+    likwid-pin if available, otherwise with taskset
+
+    Input
+    -----
+    list_cpu: list of int
+        Cpu ids (as numbered by the system)
+    likwid: str ['']
+        likwid command (e.g., 'likwid-pin -c N:'). A trailing
+        domain prefix (e.g., 'N:') is removed as the ids are those
+        of the system. Empty to use taskset.
+
+    Returns
+    -------
+    prefix: str (empty if no pinning tool is found)
+    """
+    if len(list_cpu) == 0:
+        return ""
+    list_options = likwid.split()
+    if len(list_options) > 0 and shutil.which(list_options[0]) is not None:
+        if list_options[-1].endswith(":"):
+            list_options = list_options[:-1]
+        return "{0} {1}".format(" ".join(list_options), format_cpu_list(list_cpu))
+    if shutil.which("taskset") is not None:
+        return "taskset -c {0}".format(format_cpu_list(list_cpu))
+    return ""
+
+
+class CpuAllocator(object):
+    """Allocator of disjoint sets of cpus to the recipes running at the
+    same time, in this process and in the other processes of the host
+    using the same lock folder.
+    """
+    def __init__(self, list_cpu=None, lock_folder=default_cpu_lock_folder,
+                 sysfs_folder=default_sysfs_folder, partial_wait=default_partial_wait):
+        """Initialise the allocator
+
+        Input
+        -----
+        list_cpu: list of int [None]
+            Cpus which can be allocated. Default is all the cpus
+            usable by the process.
+        lock_folder: str
+            Folder of the lock files (one per cpu). None means that the
+            cpus are only shared within this process.
+        sysfs_folder: str
+            Folder with the host topology
+        partial_wait: float [30]
+            Time (s) after which a request is given the free cpus, if
+            there are fewer than requested
+        """
+        self.topology = read_cpu_topology(sysfs_folder)
+        if list_cpu is not None and len(list_cpu) > 0:
+            self.topology = {cpu: self.topology[cpu] for cpu in list_cpu
+                             if cpu in self.topology}
+        self.list_cpu = sorted(self.topology)
+        self.lock_folder = lock_folder
+        self.partial_wait = partial_wait
+        self._lock = threading.Lock()
+        self._held = set()
+        self._fds = {}
+        if lock_folder is not None:
+            os.makedirs(lock_folder, exist_ok=True)
+
+    @property
+    def nodes(self):
+        """NUMA nodes of the cpus
+        """
+        return sorted(set(self.topology[cpu]['node'] for cpu in self.list_cpu))
+
+    def _lock_cpu(self, cpu):
+        """Try to lock a cpu for the other processes
+        """
+        if self.lock_folder is None:
+            return True
+        if cpu not in self._fds:
+            self._fds[cpu] = os.open(joinpath(self.lock_folder, "cpu_{0:04d}.lock".format(cpu)),
+                                     os.O_RDONLY | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(self._fds[cpu], fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _unlock_cpu(self, cpu):
+        if self.lock_folder is not None and cpu in self._fds:
+            fcntl.flock(self._fds[cpu], fcntl.LOCK_UN)
+
+    def _select_cpus(self, list_free, ncpu):
+        """Select ncpu cpus among the free ones: within the NUMA node
+        with the fewest free cpus which has enough of them, otherwise
+        over the nodes with the most free cpus. The first thread of
+        each core is used before the others.
+        """
+        dict_free = {}
+        for cpu in list_free:
+            dict_free.setdefault(self.topology[cpu]['node'], []).append(cpu)
+        for node in dict_free:
+            dict_free[node].sort(key=lambda cpu: (self.topology[cpu]['thread'],
+                                                  self.topology[cpu]['core'], cpu))
+        list_fit = [node for node in dict_free if len(dict_free[node]) >= ncpu]
+        if len(list_fit) > 0:
+            node = min(list_fit, key=lambda node: (len(dict_free[node]), node))
+            return dict_free[node][:ncpu]
+        selection = []
+        for node in sorted(dict_free, key=lambda node: (-len(dict_free[node]), node)):
+            selection += dict_free[node][:ncpu - len(selection)]
+        return selection
+
+    def allocate(self, ncpu, timeout=None):
+        """Get a set of free cpus
+
+        Input
+        -----
+        ncpu: int
+            Number of cpus requested
+        timeout: float [None]
+            Maximum waiting time (s) if no cpu is free. None to wait
+            until one is released.
+
+        Returns
+        -------
+        list of int: the allocated cpus (fewer than ncpu if not
+            enough cpus were released after partial_wait seconds)
+        """
+        ncpu = max(1, min(ncpu, len(self.list_cpu)))
+        start = time.time()
+        while True:
+            with self._lock:
+                # Locking all the free cpus, then keeping the selected ones
+                list_free = [cpu for cpu in self.list_cpu
+                             if cpu not in self._held and self._lock_cpu(cpu)]
+                waited = time.time() - start
+                if len(list_free) >= ncpu or (len(list_free) > 0
+                                              and waited >= self.partial_wait):
+                    selection = self._select_cpus(list_free, ncpu)
+                else:
+                    selection = []
+                for cpu in list_free:
+                    if cpu not in selection:
+                        self._unlock_cpu(cpu)
+                self._held.update(selection)
+            if len(selection) > 0:
+                if len(selection) < ncpu:
+                    upipe.print_warning("Only {0} free cpus out of the {1} "
+                                        "requested".format(len(selection), ncpu))
+                return sorted(selection)
+            if timeout is not None and waited >= timeout:
+                raise TimeoutError("No free cpu after {0:.0f} s".format(waited))
+            time.sleep(cpu_poll_time)
+
+    def release(self, list_cpu):
+        """Give back allocated cpus
+        """
+        with self._lock:
+            for cpu in list_cpu:
+                if cpu in self._held:
+                    self._held.discard(cpu)
+                    self._unlock_cpu(cpu)
+
+    @contextmanager
+    def cpus(self, ncpu, timeout=None):
+        """Context giving a set of cpus, released at the end
+        """
+        list_cpu = self.allocate(ncpu, timeout=timeout)
+        try:
+            yield list_cpu
+        finally:
+            self.release(list_cpu)
+
+    def close(self):
+        """Release all the cpus and close the lock files
+        """
+        self.release(list(self._held))
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = {}
@@ -16,10 +16,12 @@ __contact__   = " <eric.emsellem@eso.org>"
 # Standard modules
 import os
 from os.path import join as joinpath
+import threading
 
 from collections import OrderedDict
 
 from . import util_pipe as upipe
+from .trace_pipe import traced
 from .config_pipe import get_suffix_product
 
 class SofDict(OrderedDict) :
@@ -35,9 +37,31 @@ class SofPipe(object) :
     def __init__(self) :
         """Initialisation of SofPipe
         """
+        # The SOF dictionary and current SOF are specific to each thread
+        # so that several recipes can prepare their SOF at the same time
+        self._sof_context = threading.local()
         # Creating an empty dictionary for the SOF writing
         self._sofdict = SofDict()
 
+    @property
+    def _sofdict(self):
+        if not hasattr(self._sof_context, "sofdict"):
+            self._sof_context.sofdict = SofDict()
+        return self._sof_context.sofdict
+
+    @_sofdict.setter
+    def _sofdict(self, sofdict):
+        self._sof_context.sofdict = sofdict
+
+    @property
+    def current_sof(self):
+        return getattr(self._sof_context, "current_sof", None)
+
+    @current_sof.setter
+    def current_sof(self, sof):
+        self._sof_context.current_sof = sof
+
+    @traced("sof")
     def write_sof(self, sof_filename, new=False, verbose=None) :
         """Feeding an sof file with input filenames from a dictionary
         """
@@ -81,7 +105,8 @@ class SofPipe(object) :
         """
         if reset: self._sofdict.clear()
         # Finding the best tpl for this master
-        index, this_tpl = self._select_closest_mjd(mean_mjd, self._get_table_expo(expotype)) 
+        index, this_tpl = self._select_closest_mjd(mean_mjd, self._get_table_expo(expotype),
+                                                   expotype, "master")
         if self._debug:
             upipe.print_debug("Index = {0}, Tpl = {1}".format(index, this_tpl))
         if index >= 0:
@@ -98,7 +123,7 @@ class SofPipe(object) :
         if reset: self._sofdict.clear()
         # Finding the best tpl for this raw file type
         expo_table = self._get_table_expo(expotype, "raw")
-        index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table) 
+        index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table, expotype, "raw")
         if index >= 0:
             self._sofdict[expotype] = [upipe.normpath(joinpath(self.paths.rawfiles, 
                 expo_table['filename'][index]))]
@@ -113,7 +138,7 @@ class SofPipe(object) :
         if reset: self._sofdict.clear()
         # Finding the best tpl for this sky calib file type
         expo_table = self._get_table_expo(expotype, stage)
-        index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table) 
+        index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table, expotype, stage)
         dir_calib = self._get_fullpath_expo(expotype, stage)
         if perexpo:
             iexpo = expo_table[index]['iexpo']
@@ -142,11 +167,12 @@ class SofPipe(object) :
         """
         if self._time_astrometry :
             calfolder = self.pipe_params.musecalib_time
-            geofile = self.retrieve_geoastro_name(tpls, filetype='geo')
+            geofile = self._get_geoastro_name(tpls, filetype='geo')
         else:
             expo_table = self._get_table_expo("GEOMETRY", "raw")
             if len(expo_table) > 0:
-                index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table) 
+                index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table,
+                                                           "GEOMETRY", "raw")
                 calfolder = self.paths.rawfiles
                 geofile = expo_table['filename'][index]
             else:
@@ -164,11 +190,12 @@ class SofPipe(object) :
         """
         if self._time_astrometry :
             calfolder = self.pipe_params.musecalib_time
-            astrofile = self.retrieve_geoastro_name(tpls, filetype='astro')
+            astrofile = self._get_geoastro_name(tpls, filetype='astro')
         else :
             expo_table = self._get_table_expo("ASTROMETRY", "raw")
             if len(expo_table) > 0:
-                index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table) 
+                index, this_tpl = self._select_closest_mjd(mean_mjd, expo_table,
+                                                           "ASTROMETRY", "raw")
                 calfolder = self.paths.rawfiles
                 astrofile = expo_table['filename'][index]
             else:
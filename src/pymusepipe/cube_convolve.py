@@ -18,6 +18,8 @@ from astropy.convolution import (Moffat2DKernel, Gaussian2DKernel, convolve,
                                  convolve_fft)
 from astropy.stats import gaussian_fwhm_to_sigma
 
+from .trace_pipe import traced
+
 # pypher
 try:
     import pypher.pypher as ph
@@ -346,6 +348,7 @@ def convolution_kernel_gaussian(fwhm_wave, target_fwhm, target_psf,
 
     return conv_kernel
 
+@traced("convolution")
 def cube_convolve(data, kernel, variance=None, fft=True, fill_value=np.nan):
     """Convolve a 3D datacube
 
@@ -411,6 +414,7 @@ def cube_convolve(data, kernel, variance=None, fft=True, fill_value=np.nan):
 
     return data, variance
 
+@traced("convolution")
 def cube_kernel(shape, wave, input_fwhm,  target_fwhm,
                 input_function, target_function, lambda0=6483.58,
                 input_nmoffat=None, target_nmoffat=None, b=-3e-5,
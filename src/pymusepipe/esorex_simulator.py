@@ -0,0 +1,328 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS esorex simulator module. Stand-in for esorex which
+parses the command line and the SOF file of a MUSE recipe, waits
+following a simple cost model, and writes synthetic FITS products
+with the names and (scaled) sizes of the real ones in the output folder.
+
+It only uses the standard library, so that it can be run as a script
+(python esorex_simulator.py ...) without importing pymusepipe, as the
+real esorex would be.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+from os.path import join as joinpath
+import sys
+import time
+import math
+
+# Default scaling of the costs and sizes
+default_time_scale = 1.e-3
+default_size_scale = 1.e-3
+
+# Number of IFUs
+nifu_muse = 24
+
+# Cost model of the recipes, in seconds for the full scale:
+# (base time, time per input frame, tags of the input frames)
+dict_recipe_costs = {
+        'muse_bias': (30., 10., ['BIAS']),
+        'muse_flat': (30., 20., ['FLAT']),
+        'muse_wavecal': (60., 30., ['ARC']),
+        'muse_lsf': (60., 60., ['ARC']),
+        'muse_twilight': (60., 60., ['SKYFLAT']),
+        'muse_scibasic': (20., 100., ['OBJECT', 'SKY', 'STD', 'ASTROMETRY']),
+        'muse_standard': (60., 0., ['PIXTABLE_STD']),
+        'muse_create_sky': (30., 0., ['PIXTABLE_SKY']),
+        'muse_scipost': (60., 30., ['PIXTABLE_OBJECT', 'PIXTABLE_SKY', 'PIXTABLE_STD',
+                                    'PIXTABLE_REDUCED']),
+        'muse_exp_align': (5., 1., ['IMAGE_FOV']),
+        'muse_exp_combine': (60., 120., ['PIXTABLE_REDUCED']),
+        }
+
+# Typical size (bytes) of the products for the full scale
+default_product_size = 1000000
+dict_product_sizes = {
+        'MASTER_BIAS': 1650000000, 'MASTER_FLAT': 1650000000,
+        'TRACE_TABLE': 2000000, 'WAVECAL_TABLE': 1000000,
+        'WAVECAL_RESIDUALS': 50000000, 'LSF_PROFILE': 300000000,
+        'DATACUBE_SKYFLAT': 250000000, 'TWILIGHT_CUBE': 250000000,
+        'PIXTABLE': 330000000, 'PIXTABLE_REDUCED': 7500000000,
+        'PIXTABLE_POSITIONED': 7500000000, 'PIXTABLE_COMBINED': 7500000000,
+        'DATACUBE_FINAL': 3000000000, 'DATACUBE_STD': 3000000000,
+        'OBJECT_RESAMPLED': 3000000000, 'IMAGE_FOV': 1300000,
+        'SKY_IMAGE': 1300000, 'RAMAN_IMAGES': 5000000,
+        'OFFSET_LIST': 10000, 'SOURCE_LIST': 100000,
+        }
+
+# Products of scipost and exp_combine for each option of --save
+# Those with a number per exposure are in dict_save_expo_products
+dict_save_products = {'cube': ['DATACUBE_FINAL'], 'stacked': ['OBJECT_RESAMPLED']}
+dict_save_expo_products = {'individual': ['PIXTABLE_REDUCED'],
+        'positioned': ['PIXTABLE_POSITIONED'], 'combined': ['PIXTABLE_COMBINED'],
+        'skymodel': ['SKY_MASK', 'SKY_SPECTRUM', 'SKY_LINES', 'SKY_IMAGE',
+                     'SKY_CONTINUUM'],
+        'raman': ['RAMAN_IMAGES'], 'autocal': ['AUTOCAL_FACTORS']}
+
+# Size of a FITS block
+fits_block = 2880
+# Size of the chunks of data written in the products
+write_chunk_size = 1 << 20
+
+
+def get_simulator_command(time_scale=default_time_scale, size_scale=default_size_scale,
+                          python=None):
+    """Get the command running the simulator, used instead of esorex
+
+    Input
+    -----
+    time_scale: float
+        Scaling of the time taken by the recipes (1 is the full scale)
+    size_scale: float
+        Scaling of the size of the products (1 is the full scale)
+    python: str [None]
+        Python executable. Default is the current one.
+    """
+    if python is None:
+        python = sys.executable
+    return "{0} {1} --time-scale={2} --size-scale={3}".format(python,
+                os.path.abspath(__file__), time_scale, size_scale)
+
+
+def read_sof(sof):
+    """Read a SOF file
+
+    Returns
+    -------
+    list of (filename, tag)
+    """
+    list_frames = []
+    with open(sof, "r") as fsof:
+        for line in fsof:
+            words = line.split()
+            if len(words) >= 2 and not words[0].startswith("#"):
+                list_frames.append((words[0], words[1]))
+    return list_frames
+
+
+def parse_options(list_args):
+    """Parse a list of --key=value options
+
+    Returns
+    -------
+    dict of options (value is True if no value is given)
+    list of the other arguments
+    """
+    options, others = {}, []
+    for arg in list_args:
+        if arg.startswith("--"):
+            key, sep, value = arg[2:].partition("=")
+            options[key.replace("-", "_")] = value if sep else True
+        else:
+            others.append(arg)
+    return options, others
+
+
+def parse_command(argv):
+    """Parse an esorex command line
+
+    Input
+    -----
+    argv: list of str
+        Arguments, as [esorex options] recipe [recipe options] sof
+
+    Returns
+    -------
+    esorex_options: dict
+    recipe: str
+    recipe_options: dict
+    sof: str
+    """
+    irecipe = None
+    for i, arg in enumerate(argv):
+        if not arg.startswith("-"):
+            irecipe = i
+            break
+    if irecipe is None:
+        return parse_options(argv)[0], None, {}, None
+    esorex_options, _ = parse_options(argv[:irecipe])
+    recipe_options, others = parse_options(argv[irecipe+1:])
+    sof = others[-1] if len(others) > 0 else None
+    return esorex_options, argv[irecipe], recipe_options, sof
+
+
+def count_input_frames(recipe, list_frames):
+    """Number of input frames of a recipe in the SOF, following
+    the tags of the cost model
+    """
+    list_tags = dict_recipe_costs[recipe][2]
+    return sum(1 for _, tag in list_frames if tag in list_tags)
+
+
+def get_product_size(name, size_scale=default_size_scale):
+    """Scaled size (bytes) of the data of a product from its name
+    """
+    for key in sorted(dict_product_sizes, key=len, reverse=True):
+        if name.startswith(key):
+            return int(dict_product_sizes[key] * size_scale)
+    return int(default_product_size * size_scale)
+
+
+def get_list_products(recipe, recipe_options, list_frames):
+    """Names of the products of a recipe (without the .fits extension)
+    as written by the MUSE pipeline
+    """
+    filters = str(recipe_options.get('filter', 'white')).split(',')
+    if recipe == 'muse_bias':
+        return ['MASTER_BIAS']
+    elif recipe == 'muse_flat':
+        return ['MASTER_FLAT', 'TRACE_TABLE']
+    elif recipe == 'muse_wavecal':
+        list_products = ['WAVECAL_TABLE']
+        if recipe_options.get('residuals', False):
+            list_products.append('WAVECAL_RESIDUALS')
+        return list_products
+    elif recipe == 'muse_lsf':
+        return ['LSF_PROFILE']
+    elif recipe == 'muse_twilight':
+        return ['DATACUBE_SKYFLAT', 'TWILIGHT_CUBE']
+    elif recipe == 'muse_scibasic':
+        nifu = int(recipe_options.get('nifu', -1))
+        list_ifu = range(1, nifu_muse + 1) if nifu <= 0 else [nifu]
+        list_products = []
+        for tag in dict_recipe_costs[recipe][2]:
+            nexpo = sum(1 for _, frame_tag in list_frames if frame_tag == tag)
+            list_products += ['PIXTABLE_{0}_{1:04d}-{2:02d}'.format(tag, iexpo, ifu)
+                              for iexpo in range(1, nexpo + 1) for ifu in list_ifu]
+        return list_products
+    elif recipe == 'muse_standard':
+        return ['{0}_0001'.format(name) for name in ['DATACUBE_STD', 'STD_FLUXES',
+                                                     'STD_RESPONSE', 'STD_TELLURIC']]
+    elif recipe == 'muse_create_sky':
+        return ['SKY_MASK', 'SKY_IMAGE', 'SKY_LINES', 'SKY_SPECTRUM', 'SKY_CONTINUUM']
+    elif recipe == 'muse_exp_align':
+        nimages = count_input_frames(recipe, list_frames)
+        return ['OFFSET_LIST'] + ['SOURCE_LIST_{0:04d}'.format(i)
+                                  for i in range(1, nimages + 1)]
+    elif recipe in ['muse_scipost', 'muse_exp_combine']:
+        if recipe == 'muse_scipost':
+            # Pixel tables are given per IFU
+            nexpo = max(1, int(math.ceil(count_input_frames(recipe, list_frames)
+                                         / float(nifu_muse))))
+        else:
+            nexpo = 1
+        list_products = []
+        for option in str(recipe_options.get('save', 'cube')).split(','):
+            list_products += dict_save_products.get(option, [])
+            if option == 'cube':
+                list_products += ['IMAGE_FOV_{0:04d}'.format(i)
+                                  for i in range(1, len(filters) + 1)]
+            list_products += ['{0}_{1:04d}'.format(name, iexpo)
+                              for name in dict_save_expo_products.get(option, [])
+                              for iexpo in range(1, nexpo + 1)]
+        return list_products
+    return []
+
+
+def write_fits_product(filename, catg, size):
+    """Write a synthetic FITS file with a valid primary header and
+    a data unit of a given size (bytes, zeros)
+    """
+    list_cards = ["SIMPLE  =                    T",
+                  "BITPIX  =                    8",
+                  "NAXIS   =                    {0}".format(1 if size > 0 else 0)]
+    if size > 0:
+        list_cards.append("NAXIS1  = {0:20d}".format(size))
+    list_cards += ["EXTEND  =                    T",
+                   "HIERARCH ESO PRO CATG = '{0}'".format(catg),
+                   "HIERARCH ESO PRO REC1 PIPE ID = 'esorex_simulator'",
+                   "END"]
+    header = "".join(card.ljust(80) for card in list_cards)
+    header = header.ljust(int(math.ceil(len(header) / float(fits_block))) * fits_block)
+    ndata = int(math.ceil(size / float(fits_block))) * fits_block
+    zeros = bytes(min(ndata, write_chunk_size))
+    with open(filename, "wb") as fout:
+        fout.write(header.encode("ascii"))
+        while ndata > 0:
+            nwrite = min(ndata, write_chunk_size)
+            fout.write(zeros[:nwrite])
+            ndata -= nwrite
+
+
+def simulate_recipe(argv, stdout=None):
+    """Simulate an esorex command
+
+    Input
+    -----
+    argv: list of str
+        Arguments of the command, as for esorex, with two extra options
+        placed before the recipe: --time-scale and --size-scale
+    stdout: file [None]
+        Where to print the messages. Default is sys.stdout.
+
+    Returns
+    -------
+    exit code (0 if successful)
+    """
+    if stdout is None:
+        stdout = sys.stdout
+    esorex_options, recipe, recipe_options, sof = parse_command(argv)
+    time_scale = float(esorex_options.get('time_scale', default_time_scale))
+    size_scale = float(esorex_options.get('size_scale', default_size_scale))
+    output_dir = esorex_options.get('output_dir', ".")
+    log_dir = esorex_options.get('log_dir', ".")
+    log_file = esorex_options.get('log_file', "esorex.log")
+
+    list_lines = []
+    def message(level, text):
+        line = "{0} [{1:^7}] {2}: {3}".format(time.strftime("%H:%M:%S"), level,
+                                               recipe or "esorex", text)
+        list_lines.append(line)
+        print(line, file=stdout, flush=True)
+
+    status = 0
+    if recipe not in dict_recipe_costs:
+        message("ERROR", "Unknown recipe {0}".format(recipe))
+        status = 1
+    elif sof is None or not os.path.isfile(sof):
+        message("ERROR", "Could not open the SOF file {0}".format(sof))
+        status = 1
+    else:
+        list_frames = read_sof(sof)
+        ninput = count_input_frames(recipe, list_frames)
+        base_time, frame_time, _ = dict_recipe_costs[recipe]
+        duration = (base_time + frame_time * ninput) * time_scale
+        message("INFO", "Simulating {0} with {1} frames ({2} input frames) "
+                "- {3:.3f} s".format(recipe, len(list_frames), ninput, duration))
+        # Time spread over the IFUs, as the real recipes do
+        for ifu in range(1, nifu_muse + 1):
+            message("INFO", "Processing IFU {0}".format(ifu))
+            time.sleep(duration / nifu_muse)
+
+        os.makedirs(output_dir, exist_ok=True)
+        for name in get_list_products(recipe, recipe_options, list_frames):
+            catg = name.split("_0")[0]
+            write_fits_product(joinpath(output_dir, name + ".fits"), catg,
+                               get_product_size(name, size_scale))
+            message("INFO", "Saved {0}.fits".format(name))
+
+    if log_dir is not None and os.path.isdir(log_dir):
+        with open(joinpath(log_dir, log_file), "a") as flog:
+            flog.write("\n".join(list_lines) + "\n")
+    return status
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    sys.exit(simulate_recipe(argv))
+
+
+if __name__ == "__main__":
+    main()
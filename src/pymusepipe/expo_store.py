@@ -0,0 +1,142 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS exposure store module. Provides indexes built once
+on the astropy tables of exposures (raw, master, processed), so that
+the selection of tpls and exposures does not need to regroup the
+tables for each recipe and each tpl.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Numpy
+import numpy as np
+
+from .calib_plan import get_table_signature
+
+
+class ExpoTableIndex(object):
+    """Index on one astropy Table of exposures. It includes the table
+    grouped by tpls, the map from tpl to group number, the
+    boundaries of each group and the sorted MJD values.
+    """
+    def __init__(self, table):
+        """Build the index for a given table
+
+        Input
+        -----
+        table: astropy Table
+            Table including at least a 'tpls' column
+        """
+        self.table = table
+        self.nrows = len(table)
+        # Grouping only once
+        self.grouped = table.group_by('tpls')
+        self.indices = np.asarray(self.grouped.groups.indices)
+        self.tpls = np.asarray(self.grouped.groups.keys['tpls'])
+        self.dict_tpl_group = {tpl: igroup for igroup, tpl in enumerate(self.tpls)}
+        # Sorted MJD values with the corresponding rows of the table
+        if 'mjd' in table.colnames:
+            self.idx_sorted_mjd = np.argsort(np.asarray(table['mjd']), kind='stable')
+            self.sorted_mjd = np.asarray(table['mjd'])[self.idx_sorted_mjd]
+        else:
+            self.idx_sorted_mjd = np.array([], dtype=int)
+            self.sorted_mjd = np.array([])
+
+    @property
+    def signature(self):
+        """Signature of the tpls and mjd columns, computed once
+        """
+        if not hasattr(self, "_signature"):
+            self._signature = get_table_signature(self.table)
+        return self._signature
+
+    def is_valid(self, table):
+        """Check if the index still corresponds to the given table
+        """
+        return (self.table is table) and (self.nrows == len(table))
+
+    def select_tpl(self, tpl="ALL"):
+        """Select the grouped table for a given tpl
+        Returns the full grouped table if tpl is 'ALL', and an empty
+        grouped table if the tpl does not exist.
+        """
+        if tpl == "ALL":
+            return self.grouped
+        if tpl in self.dict_tpl_group:
+            return self.grouped.groups[[self.dict_tpl_group[tpl]]]
+        return self.grouped.groups[np.array([], dtype=int)]
+
+    def closest_mjd(self, mjdin):
+        """Find the rows of the table with the closest mjd to the input
+        values, using the sorted MJD values. For each input, this gives the
+        same row as np.argmin((mjdin - table['mjd'])**2), namely
+        the first one in the table in case of equal distances.
+
+        Input
+        -----
+        mjdin: float or array of floats
+
+        Returns
+        -------
+        rows: int or array of int
+            Row indices in the table (same shape as the input)
+        """
+        mjd = np.asarray(mjdin, dtype=float)
+        nmjd = len(self.sorted_mjd)
+        pos = np.searchsorted(self.sorted_mjd, mjd, side='left')
+        right = np.clip(pos, 0, nmjd - 1)
+        # First item with the same mjd value as the one on the left
+        left = np.clip(pos - 1, 0, nmjd - 1)
+        left = np.searchsorted(self.sorted_mjd, self.sorted_mjd[left], side='left')
+        dist_left = (mjd - self.sorted_mjd[left])**2
+        dist_right = (mjd - self.sorted_mjd[right])**2
+        rows_left = self.idx_sorted_mjd[left]
+        rows_right = self.idx_sorted_mjd[right]
+        choose_right = (dist_right < dist_left) \
+                       | ((dist_right == dist_left) & (rows_right < rows_left))
+        rows = np.where(choose_right, rows_right, rows_left)
+        if np.ndim(rows) == 0:
+            return int(rows)
+        return rows
+
+
+class ExpoStore(object):
+    """Store of the indexes for the tables of exposures, keyed by
+    (expotype, stage). An index is rebuilt automatically when the
+    table attached to an (expotype, stage) has been replaced.
+    """
+    def __init__(self):
+        self._dict_index = {}
+
+    def reset(self):
+        """Removing all indexes
+        """
+        self._dict_index.clear()
+
+    def invalidate(self, expotype, stage="master"):
+        """Removing the index for a given expotype and stage
+        """
+        self._dict_index.pop((expotype, stage), None)
+
+    def get_index(self, table, expotype, stage="master"):
+        """Get the index for a table, building it if needed
+
+        Input
+        -----
+        table: astropy Table
+        expotype: str
+        stage: str ['master']
+
+        Returns
+        -------
+        index: ExpoTableIndex
+        """
+        key = (expotype, stage)
+        index = self._dict_index.get(key, None)
+        if index is None or not index.is_valid(table):
+            index = ExpoTableIndex(table)
+            self._dict_index[key] = index
+        return index
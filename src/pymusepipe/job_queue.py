@@ -0,0 +1,484 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS job queue module. The reduction of a sample is split into
+jobs (one target, one pointing, a range of recipes) stored in an SQLite
+file on the shared filesystem. Workers, possibly on different nodes,
+claim the jobs with a lease which they renew while the job is running.
+Jobs whose lease has expired (crashed worker) are put back in the queue.
+A worker which loses the lease of a job stops it, since the job may
+already be running again on another worker.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+import time
+import json
+import socket
+import signal
+import sqlite3
+import argparse
+import multiprocessing
+from contextlib import contextmanager
+
+# pymusepipe modules
+from . import util_pipe as upipe
+from .config_pipe import default_lease_time, default_max_attempts
+
+list_job_status = ['pending', 'running', 'done', 'failed']
+
+_sql_create_jobs = """CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    targetname TEXT, pointing INTEGER,
+    first_recipe TEXT, last_recipe TEXT,
+    name_method TEXT, pipe_kwargs TEXT, method_kwargs TEXT, history TEXT,
+    status TEXT, worker TEXT, lease_expiry REAL,
+    attempts INTEGER, max_attempts INTEGER,
+    submitted REAL, started REAL, finished REAL, error TEXT)"""
+
+
+def get_worker_name():
+    """Default name of a worker: host and process id
+    """
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+    """Queue of jobs stored in an SQLite file. Each method opens its own
+    connection, so that the queue can be used from several threads and
+    processes at the same time.
+    """
+    def __init__(self, filename, lease_time=default_lease_time,
+                 max_attempts=default_max_attempts, timeout=60.):
+        """Initialise the queue, creating the file if needed
+
+        Input
+        -----
+        filename: str
+            Name of the SQLite file (on the shared filesystem)
+        lease_time: float
+            Duration of a lease (s). A running job whose lease is not
+            renewed within that time is put back in the queue.
+        max_attempts: int
+            Number of times a job is claimed before being set as failed
+        timeout: float
+            Time (s) to wait for the lock of the database
+        """
+        self.filename = filename
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        with self._transaction() as db:
+            db.execute(_sql_create_jobs)
+
+    @contextmanager
+    def _transaction(self):
+        """Connection with an immediate (write) transaction, committed
+        at the end or rolled back in case of error
+        """
+        db = sqlite3.connect(self.filename, timeout=self.timeout,
+                             isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    @staticmethod
+    def _row_to_job(row):
+        job = dict(row)
+        for key in ['pipe_kwargs', 'method_kwargs']:
+            job[key] = json.loads(job[key])
+        return job
+
+    def submit(self, targetname, pointing, pipe_kwargs, name_method="run_recipes",
+               method_kwargs={}, history="", force=False):
+        """Add a job in the queue
+
+        Input
+        -----
+        targetname: str
+        pointing: int
+        pipe_kwargs: dict
+            Arguments to initialise the MusePipe (json serialisable),
+            including first_recipe and last_recipe
+        name_method: str
+            Name of the MusePipe method to run
+        method_kwargs: dict
+            Arguments of that method (json serialisable)
+        history: str
+            Python command saved as history of the MusePipe
+        force: bool [False]
+            Add the job even if the same job is already pending,
+            running or done.
+
+        Returns
+        -------
+        job_id: int
+        """
+        first_recipe = str(pipe_kwargs.get("first_recipe", 1))
+        last_recipe = str(pipe_kwargs.get("last_recipe", None))
+        pipe_kwargs = json.dumps(pipe_kwargs, sort_keys=True)
+        method_kwargs = json.dumps(method_kwargs, sort_keys=True)
+        with self._transaction() as db:
+            if not force:
+                row = db.execute("SELECT id FROM jobs WHERE targetname=? AND pointing=? "
+                                 "AND name_method=? AND pipe_kwargs=? AND method_kwargs=? "
+                                 "AND status!='failed'",
+                                 (targetname, int(pointing), name_method, pipe_kwargs,
+                                  method_kwargs)).fetchone()
+                if row is not None:
+                    return row['id']
+            cursor = db.execute("INSERT INTO jobs (targetname, pointing, first_recipe, "
+                                "last_recipe, name_method, pipe_kwargs, method_kwargs, "
+                                "history, status, worker, lease_expiry, attempts, "
+                                "max_attempts, submitted, error) VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?, 'pending', '', 0, 0, ?, ?, '')",
+                                (targetname, int(pointing), first_recipe, last_recipe,
+                                 name_method, pipe_kwargs, method_kwargs, history,
+                                 self.max_attempts, time.time()))
+            return cursor.lastrowid
+
+    def _requeue_expired(self, db, now):
+        """Put back in the queue the running jobs with an expired lease
+        (or set them as failed after max_attempts)
+        """
+        db.execute("UPDATE jobs SET status='failed', finished=?, "
+                   "error='Lease expired after ' || attempts || ' attempt(s)' "
+                   "WHERE status='running' AND lease_expiry<? AND attempts>=max_attempts",
+                   (now, now))
+        cursor = db.execute("UPDATE jobs SET status='pending', worker='' "
+                            "WHERE status='running' AND lease_expiry<?", (now,))
+        return cursor.rowcount
+
+    def requeue_expired(self):
+        """Put back in the queue the jobs of crashed workers
+
+        Returns
+        -------
+        nrequeued: int
+            Number of jobs put back in the queue
+        """
+        with self._transaction() as db:
+            return self._requeue_expired(db, time.time())
+
+    def claim(self, worker):
+        """Claim the first pending job
+
+        Input
+        -----
+        worker: str
+            Name of the worker
+
+        Returns
+        -------
+        job: dict or None if no job is pending
+        """
+        now = time.time()
+        with self._transaction() as db:
+            self._requeue_expired(db, now)
+            row = db.execute("SELECT * FROM jobs WHERE status='pending' "
+                             "ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status='running', worker=?, lease_expiry=?, "
+                       "attempts=attempts+1, started=? WHERE id=?",
+                       (worker, now + self.lease_time, now, row['id']))
+            row = db.execute("SELECT * FROM jobs WHERE id=?", (row['id'],)).fetchone()
+        return self._row_to_job(row)
+
+    def heartbeat(self, job_id, worker):
+        """Renew the lease of a running job
+
+        Returns
+        -------
+        status: bool
+            False if the job is not owned by that worker anymore
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expiry=? WHERE id=? AND worker=? "
+                                "AND status='running'",
+                                (time.time() + self.lease_time, job_id, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, error=""):
+        """Record the end of a job: done, or failed if an error is given
+
+        Returns
+        -------
+        status: bool
+            False if the job was not owned by that worker anymore
+        """
+        status = "failed" if error else "done"
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET status=?, finished=?, error=? "
+                                "WHERE id=? AND worker=? AND status='running'",
+                                (status, time.time(), error, job_id, worker))
+            return cursor.rowcount == 1
+
+    def get_jobs(self, list_ids=None, status=None, targetname=None):
+        """Get the jobs, selected by id, status and/or target
+
+        Returns
+        -------
+        list_jobs: list of dict
+        """
+        query, values = [], []
+        if list_ids is not None:
+            query.append("id IN ({0})".format(",".join("?" * len(list_ids))))
+            values.extend(list_ids)
+        if status is not None:
+            query.append("status=?")
+            values.append(status)
+        if targetname is not None:
+            query.append("targetname=?")
+            values.append(targetname)
+        where = " WHERE " + " AND ".join(query) if len(query) > 0 else ""
+        with self._transaction() as db:
+            rows = db.execute("SELECT * FROM jobs" + where + " ORDER BY id",
+                              values).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def count_jobs(self, list_ids=None):
+        """Number of jobs for each status
+
+        Returns
+        -------
+        dict_count: dict
+        """
+        dict_count = {status: 0 for status in list_job_status}
+        for job in self.get_jobs(list_ids):
+            dict_count[job['status']] += 1
+        return dict_count
+
+    def wait(self, list_ids=None, poll_time=30., timeout=None):
+        """Wait until the jobs are done or failed
+
+        Input
+        -----
+        list_ids: list of int
+            Jobs to wait for. Default is None, meaning all jobs.
+        poll_time: float
+            Time (s) between two checks of the queue
+        timeout: float
+            Maximum time (s) to wait. None means no limit.
+
+        Returns
+        -------
+        list_jobs: list of dict
+            The jobs at the end of the wait
+        """
+        start_time = time.time()
+        while True:
+            self.requeue_expired()
+            list_jobs = self.get_jobs(list_ids)
+            if all(job['status'] in ['done', 'failed'] for job in list_jobs):
+                return list_jobs
+            if timeout is not None and time.time() - start_time > timeout:
+                upipe.print_warning("Timeout while waiting for the jobs")
+                return list_jobs
+            time.sleep(poll_time)
+
+
+def get_job_cpus(pipe_kwargs):
+    """Cpus of a job, from the list_cpu (or first_cpu and ncpu)
+    arguments of its MusePipe
+    """
+    list_cpu = pipe_kwargs.get("list_cpu", [])
+    if list_cpu is None or len(list_cpu) < 1:
+        first_cpu = pipe_kwargs.get("first_cpu", 0)
+        list_cpu = list(range(first_cpu, first_cpu + pipe_kwargs.get("ncpu", 24)))
+    return list(list_cpu)
+
+
+def run_job(job, cpus=None):
+    """Run one job of the queue in the current process
+
+    Input
+    -----
+    job: dict
+        Job as returned by JobQueue.claim
+    cpus: list of int
+        Cpus to use. Default is None, meaning the cpus of the job.
+
+    Returns
+    -------
+    status: dict
+        As returned by reduce_pointing_process
+    """
+    # Imported here as target_sample needs the full pipeline
+    from .target_sample import reduce_pointing_process
+    pipe_kwargs = job['pipe_kwargs']
+    if cpus is None:
+        cpus = get_job_cpus(pipe_kwargs)
+    return reduce_pointing_process(pipe_kwargs, job['name_method'],
+                                   job['method_kwargs'], cpus, job['history'])
+
+
+def _run_job_process(job, cpus, conn):
+    """Run a job in a child process of the worker (see run_worker) and
+    send its status through conn. The process gets its own process
+    group, so that it can be stopped with its esorex commands.
+    """
+    if hasattr(os, "setsid"):
+        os.setsid()
+    try:
+        status = run_job(job, cpus)
+    except Exception as error:
+        status = {'status': "failed", 'error': repr(error), 'time': 0.}
+    conn.send(status)
+    conn.close()
+
+
+def _stop_job_process(process, timeout=10.):
+    """Stop the process of a job and its esorex commands
+    """
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.terminate()
+    except OSError:
+        # The process group is not created yet
+        process.terminate()
+    process.join(timeout)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+def run_worker(queue_filename, worker=None, poll_time=10., max_jobs=None,
+               exit_when_empty=True, cpus=None, lease_time=default_lease_time):
+    """Claim and run the jobs of a queue until there are none left
+
+    Input
+    -----
+    queue_filename: str
+        Name of the SQLite file of the queue
+    worker: str
+        Name of the worker. Default is host:pid.
+    poll_time: float
+        Time (s) between two claims when no job is pending
+    max_jobs: int
+        Maximum number of jobs to run. None means no limit.
+    exit_when_empty: bool [True]
+        Stop when no job is pending or running. If False, the worker
+        waits for new jobs.
+    cpus: list of int
+        Cpus to use. Default is None, meaning the cpus of each job.
+    lease_time: float
+        Duration of a lease (s). It is renewed every lease_time / 4.
+
+    Returns
+    -------
+    njobs: int
+        Number of jobs run by this worker
+    """
+    if worker is None:
+        worker = get_worker_name()
+    queue = JobQueue(queue_filename, lease_time=lease_time)
+    njobs = 0
+    while max_jobs is None or njobs < max_jobs:
+        job = queue.claim(worker)
+        if job is None:
+            dict_count = queue.count_jobs()
+            if exit_when_empty and dict_count['pending'] + dict_count['running'] == 0:
+                break
+            time.sleep(poll_time)
+            continue
+
+        upipe.print_info("Worker {0}: starting job {1} [Target {2} - Pointing {3:02d} "
+                         "- recipes {4} to {5}]".format(worker, job['id'], job['targetname'],
+                                                        job['pointing'], job['first_recipe'],
+                                                        job['last_recipe']))
+        # The job runs in a child process, and the lease is renewed
+        # while it is running. If the lease is lost, the job may
+        # already run on another worker: it is stopped.
+        start_time = time.time()
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_run_job_process,
+                                          args=(job, cpus, send_conn))
+        process.start()
+        send_conn.close()
+        lease_lost = False
+        while process.is_alive() and not recv_conn.poll(lease_time / 4.):
+            try:
+                if not queue.heartbeat(job['id'], worker):
+                    lease_lost = True
+                    break
+            except sqlite3.Error as error:
+                upipe.print_warning("Worker {0}: heartbeat failed "
+                                    "[{1}]".format(worker, error))
+        if lease_lost:
+            upipe.print_warning("Worker {0}: lease of job {1} lost - stopping "
+                                "it".format(worker, job['id']))
+            _stop_job_process(process)
+            njobs += 1
+            continue
+
+        try:
+            status = recv_conn.recv()
+        except EOFError:
+            status = {'status': "failed", 'time': time.time() - start_time,
+                      'error': "Job process ended with exit code {0}".format(
+                               process.exitcode)}
+        process.join()
+
+        error = status['error'] if status['status'] != "done" else ""
+        if not queue.complete(job['id'], worker, error):
+            upipe.print_warning("Worker {0}: job {1} was given to another "
+                                "worker".format(worker, job['id']))
+        upipe.print_info("Worker {0}: job {1} {2} in {3:.1f}s".format(
+                         worker, job['id'], status['status'], status['time']))
+        njobs += 1
+
+    return njobs
+
+
+def main(argv=None):
+    """Entry point of the pymusepipe-worker command
+    """
+    parser = argparse.ArgumentParser(description="Run the jobs of a pymusepipe queue")
+    parser.add_argument("queue_filename", help="SQLite file of the job queue")
+    parser.add_argument("--worker", default=None, help="Name of the worker [host:pid]")
+    parser.add_argument("--poll-time", type=float, default=10.,
+                        help="Time (s) between two claims when the queue is empty")
+    parser.add_argument("--max-jobs", type=int, default=None,
+                        help="Maximum number of jobs to run")
+    parser.add_argument("--wait", action="store_true",
+                        help="Wait for new jobs instead of stopping when the queue is empty")
+    parser.add_argument("--first-cpu", type=int, default=None,
+                        help="First cpu to use [default is the one of each job]")
+    parser.add_argument("--ncpu", type=int, default=None,
+                        help="Number of cpus to use [default is the one of each job]")
+    parser.add_argument("--list-cpu", default=None,
+                        help="Comma separated list of the cpus to use "
+                             "[overrides --first-cpu and --ncpu]")
+    parser.add_argument("--lease-time", type=float, default=default_lease_time,
+                        help="Duration of a lease (s)")
+    args = parser.parse_args(argv)
+
+    cpus = None
+    if args.list_cpu is not None:
+        cpus = [int(cpu) for cpu in args.list_cpu.split(",")]
+    elif args.ncpu is not None:
+        first_cpu = 0 if args.first_cpu is None else args.first_cpu
+        cpus = list(range(first_cpu, first_cpu + args.ncpu))
+
+    run_worker(args.queue_filename, worker=args.worker, poll_time=args.poll_time,
+               max_jobs=args.max_jobs, exit_when_empty=not args.wait, cpus=cpus,
+               lease_time=args.lease_time)
+
+
+if __name__ == "__main__":
+    main()
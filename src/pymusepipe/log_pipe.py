@@ -0,0 +1,195 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS log module. Writes the log files of the pipes from a
+background thread: the messages are put in a bounded queue and written
+by batches, the log files being kept open between two batches.
+Records can also be written as JSON lines.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+import time
+import json
+import queue
+import atexit
+import threading
+from collections import OrderedDict
+
+# Maximum number of messages waiting to be written
+default_log_queue_size = 10000
+# Maximum time (s) between the reception of a message and its writing
+default_log_flush_time = 0.5
+# Maximum number of messages written in one batch
+log_batch_size = 1000
+# Maximum number of log files kept open
+max_open_logfiles = 32
+# Header of the messages in the log files
+log_header = "# At : {0}{1} - pymusepipe version {2}\n"
+
+
+class LogWriter(object):
+    """Writer of the log files, in a background thread.
+
+    The messages are kept in order for each file. A full queue blocks
+    the callers until the writer thread catches up.
+    """
+    def __init__(self, queue_size=default_log_queue_size,
+                 flush_time=default_log_flush_time):
+        """Initialise the writer
+
+        Input
+        -----
+        queue_size: int [10000]
+            Maximum number of messages waiting to be written
+        flush_time: float [0.5]
+            Maximum time (s) before a message is written on disk
+        """
+        self.queue_size = queue_size
+        self.flush_time = flush_time
+        self._start()
+
+    def _start(self):
+        """Start the writer thread (again, e.g., in a forked process)
+        """
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._files = OrderedDict()
+        self._time_cache = (None, "")
+        self._errors = 0
+        self._thread = threading.Thread(target=self._run, name="pymusepipe-log",
+                                        daemon=True)
+        self._thread.start()
+
+    def _formatted_time(self, timestamp):
+        # The time string only changes every second
+        second = int(timestamp)
+        if self._time_cache[0] != second:
+            self._time_cache = (second, time.strftime("%d-%m-%Y %H:%M:%S",
+                                                      time.localtime(second)))
+        return self._time_cache[1]
+
+    def write(self, filename, text, header=None):
+        """Append a text to a log file
+
+        Input
+        -----
+        filename: str
+        text: str
+        header: tuple [None]
+            If given, (fakemode, version) used to write the time header
+            before the text (see log_header), with the time of the call
+        """
+        timestamp = time.time() if header is not None else None
+        self._queue.put(("text", filename, text, header, timestamp))
+
+    def write_record(self, filename, record):
+        """Append a record (dictionary) as a JSON line
+        """
+        self._queue.put(("json", filename, record, None, None))
+
+    def flush(self):
+        """Wait until all the messages are written on disk
+        """
+        self._queue.put(("flush", None, None, None, None))
+        self._queue.join()
+
+    def _format(self, kind, text, header, timestamp):
+        if kind == "json":
+            return json.dumps(text, default=str) + "\n"
+        if header is None:
+            return text
+        fakemode, version = header
+        return log_header.format(self._formatted_time(timestamp),
+                                 " FAKEMODE" if fakemode else "", version) \
+               + text + "\n"
+
+    def _get_file(self, filename):
+        if filename in self._files:
+            self._files.move_to_end(filename)
+            return self._files[filename]
+        if len(self._files) >= max_open_logfiles:
+            _, oldfile = self._files.popitem(last=False)
+            oldfile.close()
+        self._files[filename] = open(filename, "a")
+        return self._files[filename]
+
+    def _write_batch(self, batch):
+        dict_texts = OrderedDict()
+        for kind, filename, text, header, timestamp in batch:
+            if kind == "flush":
+                continue
+            dict_texts.setdefault(filename, []).append(
+                    self._format(kind, text, header, timestamp))
+        for filename in dict_texts:
+            try:
+                logfile = self._get_file(filename)
+                logfile.write("".join(dict_texts[filename]))
+                logfile.flush()
+            except (OSError, ValueError) as error:
+                # The folder may have been removed: opening it again next time
+                self._files.pop(filename, None)
+                self._errors += 1
+                if self._errors <= 10:
+                    print("# MusePipeWarning Cannot write in {0}: {1}".format(
+                          filename, error))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_time
+            # Collecting messages until the deadline, or a flush request
+            while len(batch) < log_batch_size and batch[-1][0] != "flush":
+                try:
+                    batch.append(self._queue.get(timeout=max(0., deadline - time.time())))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def close(self):
+        """Write the remaining messages and close the log files
+        """
+        if self._pid != os.getpid():
+            return
+        self.flush()
+        for logfile in self._files.values():
+            try:
+                logfile.close()
+            except OSError:
+                pass
+        self._files = OrderedDict()
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer(queue_size=default_log_queue_size,
+                   flush_time=default_log_flush_time):
+    """Return the log writer shared by all the pipes of the process,
+    creating it if needed (the arguments are then used)
+    """
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = LogWriter(queue_size=queue_size, flush_time=flush_time)
+            atexit.register(_log_writer.close)
+            # The writer thread does not survive a fork
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(after_in_child=_log_writer._start)
+    return _log_writer
+
+
+def flush_logs():
+    """Write all the pending messages of the process on disk
+    """
+    if _log_writer is not None:
+        _log_writer.flush()
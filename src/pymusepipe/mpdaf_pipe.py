@@ -45,6 +45,7 @@ from .config_pipe import default_wave_wcs, ao_mask_lambda, dict_extra_filters
 from .util_pipe import (filter_list_with_pdict, filter_list_with_suffix_list,\
                        add_string)
 from .cube_convolve import cube_kernel, cube_convolve
+from .trace_pipe import traced
 
 def get_sky_spectrum(specname) :
     """Read sky spectrum from MUSE data reduction
@@ -349,6 +350,7 @@ class MuseCubeMosaic(CubeMosaic):
 
         self._get_unit()
 
+    @traced("convolution")
     def convolve_cubes(self, target_fwhm, target_nmoffat=None,
                         target_function="gaussian", suffix="conv", **kwargs):
         """
@@ -385,6 +387,7 @@ class MuseCubeMosaic(CubeMosaic):
             self.list_cubes[i] = BasicFile(joinpath(cube_folder,outcube_name),
                                            psf=psf)
 
+    @traced("mosaic")
     def madcombine(self, folder_cubes=None, outcube_name="dummy.fits",
                    fakemode=False, mad=True):
         """Combine the CubeMosaic and write it out.
@@ -446,6 +449,7 @@ class MuseCube(Cube):
                     nx - pixel_halfwindow: nx + pixel_halfwindow + 1]
         return MuseSpectrum(source=subcube.sum(axis=(1,2)), title=title)
 
+    @traced("image")
     def get_whiteimage_from_cube(self) :
         return MuseImage(source=self.sum(axis=0), title="White Image")
 
@@ -540,6 +544,7 @@ class MuseCube(Cube):
 
         return res * norm_factor
 
+    @traced("convolution")
     def astropy_convolve(self, other, fft=True, inplace=False):
         """Convolve a DataArray with an array of the same number of dimensions
         using a specified convolution function.
@@ -638,6 +643,7 @@ class MuseCube(Cube):
 
         return out
 
+    @traced("convolution")
     def convolve_cube_to_psf(self, target_fwhm, target_nmoffat=None,
                              target_function="gaussian",
                              outcube_folder=None,
@@ -800,6 +806,7 @@ class MuseCube(Cube):
         spec4 = self.get_spectrum_from_cube(nx34, ny34, pixel_window, title="Quadrant 4") 
         return MuseSetSpectra(spec1, spec2, spec3, spec4, subtitle="4 Quadrants")
 
+    @traced("image")
     def get_emissionline_image(self, line=None, velocity=0., redshift=None, lambda_window=10., medium='vacuum') :
         """Get a narrow band image around Ha
 
@@ -818,6 +825,7 @@ class MuseCube(Cube):
         return MuseImage(self.select_lambda(lmin, lmax).sum(axis=0), 
                 title="{0} map".format(line))
 
+    @traced("image")
     def build_filterlist_images(self, filter_list, prefix="IMAGE_FOV",
                               suffix="", folder=None, **kwargs):
         """
@@ -850,6 +858,7 @@ class MuseCube(Cube):
             upipe.print_info(f"Writing image {ima_name}")
             ima.write(joinpath(folder, ima_name))
 
+    @traced("image")
     def get_filter_image(self, filter_name=None, own_filter_file=None, filter_folder="",
             dict_filters=None):
         """Get an image given by a filter. If the filter belongs to
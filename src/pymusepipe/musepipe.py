@@ -35,11 +35,13 @@ import os
 from os.path import join as joinpath
 
 import copy
+import json
 
-# Pyfits from astropy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Astropy
 try:
     import astropy as apy
-    from astropy.io import fits as pyfits
 except ImportError:
     raise Exception("astropy is required for this module")
 
@@ -64,10 +66,11 @@ from .init_musepipe import InitMuseParameters
 from .recipes_pipe import PipeRecipes
 from .prep_recipes_pipe import PipePrep
 from . import util_pipe as upipe
+from .trace_pipe import traced
 from .config_pipe import (suffix_rawfiles, suffix_prealign, suffix_checkalign,
     listexpo_files, dict_listObject, dict_listMaster, dict_listMasterObject,
     dict_expotypes, dict_geo_astrowcs_table, exclude_list_checkmode,
-    dict_astrogeo, )
+    dict_astrogeo, list_calib_plan, )
 
 __version__ = '2.0.2 (25/09/2019)'
 
@@ -79,6 +82,109 @@ __version__ = '2.0.2 (25/09/2019)'
 # _version__ = '0.0.1 (21 November 2017)'
 
 
+def _read_rawfile_info(filename):
+    """Extract the information needed for the raw-files table
+    from the primary header of a single raw file
+
+    Args:
+        filename (str): full name of the raw file
+
+    Returns:
+        infodic (dict): values for each key of listexpo_files, or None
+            if the file should not be included in the table.
+        astrogeo_key (str): name of the ASTROMETRY/GEOMETRY type if the
+            file was recognised as such from its OBJECT, otherwise None.
+    """
+    keywords = ['OBJECT'] + [listexpo_files[k][1] for k in listexpo_files]
+    header = upipe.read_primary_keywords(filename, keywords)
+    # Short circuit in case 'OBJECT' is not found in header
+    if 'OBJECT' not in header:
+        return None, None
+
+    infodic = {}
+    good_file = True
+    object_file = None
+    for k in listexpo_files:
+        [namecol, keyword, func, form] = listexpo_files[k]
+        if keyword in header:
+            infodic[k] = func(header[keyword])
+        elif k == 'TYPE':
+            # Find the key which is right
+            astrogeo_keys = [tk for tk, tv in dict_astrogeo.items() if tv == header['OBJECT']]
+            # Nothing found?
+            if len(astrogeo_keys) == 0:
+                good_file = False
+            # If found, save value
+            else:
+                infodic[k] = astrogeo_keys[0]
+                object_file = astrogeo_keys[0]
+        else:
+            good_file = False
+
+    # Transferring the information now if complete
+    if object_file is not None:
+        infodic['OBJECT'] = object_file
+    if not good_file:
+        return None, object_file
+    return infodic, object_file
+
+
+class GeoAstroIndex(object):
+    """Sorted index of the boundaries of the validity ranges of the
+    time dependent geometry and astrometry files. The selected file is
+    the one with the closest start or end date, as in a linear scan of
+    the input dictionary (the last one in case of equal distances).
+    """
+
+    def __init__(self, dict_geoastro):
+        """Build the index
+
+        Args:
+            dict_geoastro (dict): names as keys and [start, end] dates
+                as values, with dates as 'YYYY-MM-DD' strings.
+        """
+        self.names = list(dict_geoastro.keys())
+        self.dict_dates = {}
+        list_days, list_order = [], []
+        for order, name in enumerate(self.names):
+            startd = dt.strptime(dict_geoastro[name][0], "%Y-%m-%d").date()
+            endd = dt.strptime(dict_geoastro[name][1], "%Y-%m-%d").date()
+            self.dict_dates[name] = [startd, endd]
+            list_days.extend([startd.toordinal(), endd.toordinal()])
+            list_order.extend([order, order])
+
+        # Unique boundaries, each with the last name in the dictionary
+        # having that boundary
+        days = np.array(list_days, dtype=np.int64)
+        order = np.array(list_order, dtype=np.int64)
+        self.days, inverse = np.unique(days, return_inverse=True)
+        self.last_order = np.full(len(self.days), -1, dtype=np.int64)
+        np.maximum.at(self.last_order, inverse, order)
+
+    def select(self, list_days):
+        """Get the names for a list of days
+
+        Args:
+            list_days (array): days as ordinals (see datetime.toordinal)
+
+        Returns:
+            list of names
+        """
+        days = np.atleast_1d(np.asarray(list_days, dtype=np.int64))
+        nbound = len(self.days)
+        pos = np.searchsorted(self.days, days)
+        left = np.clip(pos - 1, 0, nbound - 1)
+        right = np.clip(pos, 0, nbound - 1)
+        dist_left = np.abs(days - self.days[left])
+        dist_right = np.abs(days - self.days[right])
+        order_left = self.last_order[left]
+        order_right = self.last_order[right]
+        choose_right = (dist_right < dist_left) \
+                       | ((dist_right == dist_left) & (order_right > order_left))
+        orders = np.where(choose_right, order_right, order_left)
+        return [self.names[o] for o in orders]
+
+
 class PipeObject(object):
     """A very simple class used to store astropy tables.
     """
@@ -155,10 +261,96 @@ class MusePipe(PipePrep, PipeRecipes):
         time_astrometry: bool [False]
             Use the time dependent geo_table and astrometry_wcs files
             following on the date of the input exposures (MJD)
+        raw_nworkers: int [1]
+            Number of workers used to read the headers of the raw files
+            when building the raw-files table. 1 means sequential reading.
+        raw_scan_mode: str ['thread']
+            'thread' or 'process': type of pool used when raw_nworkers > 1
+        incremental_raw_table: bool [False]
+            Only read the headers of new or modified raw files, using
+            the header cache saved next to the raw-files table.
+        recipe_cache: bool [False]
+            Skip the recipes already run with the same command and
+            the same input files, if their products still exist.
+        force_recipes: bool [False]
+            Run the recipes even if they are found in the recipe cache.
+        max_parallel: int [1]
+            Number of tpl groups reduced at the same time in a recipe
+            (bias, flat, wave, lsf, twilight, scibasic, scipost). The
+            ncpu cpus are split between the parallel jobs.
+        max_parallel_recipes: int [1]
+            Number of recipes which can run at the same time in run_recipes
+            when their inputs are ready (e.g., scibasic and lsf).
+        memory_budget: float [None]
+            Maximum memory (GB) used by the recipes running at the same time
+        check_returncode: bool [True]
+            Raise an error when a command (e.g., esorex) ends with a
+            non-zero exit code. If False, the command is only reported
+            as failed (see get_failed_commands).
+        status_callback: function [None]
+            Called with the status of the running esorex command for each
+            warning, error and new IFU found in its output.
+        stream_buffer_size: int [65536]
+            Maximum size (bytes) of the command output kept in memory
+            before being written in the log files.
+        checkpoint: bool [False]
+            Write a marker for each completed recipe unit (recipe, tpl,
+            exposure), with its products and their checksums, and for
+            each completed run_* recipe. run_recipes then skips the
+            completed ones and resumes at the first incomplete recipe.
+        checkpoint_verify: str ['size']
+            How the products of the markers are checked when resuming:
+            'exist', 'size' (size and modification time) or 'checksum'.
+        calib_plan: bool [False]
+            Use a calibration plan (saved in the Astro tables folder)
+            associating each science tpl with its closest calibrations.
+            It is updated when the tables change.
+        recipe_backend: str ['esorex']
+            Program running the recipes: 'esorex', 'simulator' (synthetic
+            products with the right names and scaled sizes, to measure
+            the overheads of pymusepipe) or any executable taking the
+            esorex arguments.
+        simulator_options: dict [{}]
+            time_scale and size_scale of the simulator.
+        cpu_allocator: bool [False]
+            Give each recipe its own set of free cpus, NUMA-local when
+            possible and disjoint from those used by the other recipes
+            and pipes of the host (read from /sys/devices/system).
+            Only ncpu (or its share) is used, not first_cpu/list_cpu.
+            taskset replaces likwid if the latter is not installed.
+        cpu_lock_folder: str
+            Folder of the cpu lock files shared by the pipes of the host
+        async_log: bool [True]
+            Write the log files from a background thread, by batches
+            (see log_pipe). False to write each message at once.
+        json_log: bool [False]
+            Also write each message of the log as a JSON line (level,
+            target, pointing, recipe, tpl, elapsed time) in the
+            log file + '.jsonl'.
+        trace: bool [False]
+            Record nested timing spans (wall time, cpu time of python
+            and esorex, peak memory) of the run_*/recipe_* methods, sof
+            files, tables and python stages. The Chrome trace and the
+            summary table are written next to the log file at the end
+            of each top level run_*, in files named after the run and
+            its time (see PipeRecipes.export_trace).
+        usage_db: str [None]
+            SQLite file (or folder) recording the wall time, cpu time,
+            peak memory and input/output bytes of each esorex run,
+            with the target, pointing, recipe, tpl and ncpu. See
+            usage_db.UsageDB for the percentiles per recipe and the
+            scaling with ncpu.
+        shared_calibrations: dict [None]
+            Calibration tpls (for each recipe, e.g. 'bias') already
+            reduced for several pointings and linked in the Master
+            folders (see MusePipeSample.reduce_shared_calibrations).
+            The calibration recipes skip them.
         """
         # Verbose option
         self.verbose = verbose
         self._debug = kwargs.pop("debug", False)
+        # Staying in the current folder (when recipes run at the same time)
+        self._fixed_folder = False
         if self._debug:
             upipe.print_warning("In DEBUG Mode [more printing]")
 
@@ -175,6 +367,19 @@ class MusePipe(PipePrep, PipeRecipes):
         # Updating the astropy table
         self._update_astropy_table = kwargs.pop("update_astropy_table", False)
 
+        # Parallel reading of the raw file headers
+        self._raw_nworkers = kwargs.pop("raw_nworkers", 1)
+        self._raw_scan_mode = kwargs.pop("raw_scan_mode", "thread")
+        # Incremental update of the raw-files table
+        self._incremental_raw_table = kwargs.pop("incremental_raw_table", False)
+
+        # Running independent recipes at the same time
+        self._max_parallel_recipes = kwargs.pop("max_parallel_recipes", 1)
+        self._memory_budget = kwargs.pop("memory_budget", None)
+
+        # Use a calibration plan for the SOF files
+        self._use_calib_plan = kwargs.pop("calib_plan", False)
+
         # Use time dependent geo_table
         self._time_astrometry = kwargs.pop("time_astrometry", False)
 
@@ -213,7 +418,8 @@ class MusePipe(PipePrep, PipeRecipes):
         self.filter_list = kwargs.pop("filter_list", "white")
         # Init of the subclasses
         PipePrep.__init__(self, first_recipe=first_recipe,
-                          last_recipe=last_recipe)
+                          last_recipe=last_recipe,
+                          shared_calibrations=kwargs.pop("shared_calibrations", None))
         PipeRecipes.__init__(self, **kwargs)
 
         # =========================================================== #
@@ -283,18 +489,18 @@ class MusePipe(PipePrep, PipeRecipes):
         else:
             self._raw_table_initialised = False
         self.read_all_astro_tables()
+        if self._use_calib_plan:
+            self.create_calib_plan()
 
     def _init_geoastro_dates(self):
         """Initialise the dictionary for the geo and astrometry files
-        Transforms the dates into datetimes
+        Transforms the dates into datetimes and build the index
+        of the dates
         """
-        self._dict_geoastro = {}
-        for name in dict_geo_astrowcs_table:
-            startd = dt.strptime(dict_geo_astrowcs_table[name][0],
-                                 "%Y-%m-%d").date()
-            endd = dt.strptime(dict_geo_astrowcs_table[name][1],
-                               "%Y-%m-%d").date()
-            self._dict_geoastro[name] = [startd, endd]
+        self._geoastro_index = GeoAstroIndex(dict_geo_astrowcs_table)
+        self._dict_geoastro = self._geoastro_index.dict_dates
+        # Names already resolved for each (tpl, filetype, mode)
+        self._dict_geoastro_names = {}
 
     def retrieve_geoastro_name(self, date_str, filetype='geo', mode='wfm'):
         """Retrieving the astrometry or geometry fits file name
@@ -308,6 +514,24 @@ class MusePipe(PipePrep, PipeRecipes):
         mode: str
             'wfm' or 'nfm' - MUSE mode
         """
+        list_names = self.retrieve_geoastro_names([date_str], filetype, mode)
+        if list_names is None:
+            return None
+        return list_names[0]
+
+    def retrieve_geoastro_names(self, list_date_str, filetype='geo', mode='wfm'):
+        """Retrieving the astrometry or geometry fits file names
+        for a list of dates in one go
+
+        Parameters
+        ----------
+        list_date_str: list of str
+            Dates as strings (YYYY-MM-DDThh:mm:ss), e.g. tpls
+        filetype: str
+            'geo' or 'astro', type of the needed file
+        mode: str
+            'wfm' or 'nfm' - MUSE mode
+        """
         dict_pre = {'geo': 'geometry_table',
                    'astro': 'astrometry_wcs'}
         if filetype not in dict_pre:
@@ -315,18 +539,35 @@ class MusePipe(PipePrep, PipeRecipes):
                               "in retrieve_geoastro")
             return None
 
-        # Transform into a datetime date
-        date_dt = dt.strptime(date_str, "%Y-%m-%dT%H:%M:%S").date()
-        # get all the distance to the dates (start+end together)
-        near = {min(abs(date_dt - self._dict_geoastro[name][0]),
-                    abs(date_dt - self._dict_geoastro[name][1])):
-                    name for name in self._dict_geoastro}
-        # Find the minimum distance and get the name
-        ga_suffix = near[min(near.keys())]
-        # Build the name with the prefix, suffix and mode
-        ga_name = "{0}_{1}_{2}.fits".format(dict_pre[filetype],
-                                            mode, ga_suffix)
-        return ga_name
+        # Transform into datetime dates
+        list_days = [dt.strptime(date_str, "%Y-%m-%dT%H:%M:%S").date().toordinal()
+                     for date_str in list_date_str]
+        # Find the closest start or end date and build the names
+        # with the prefix, suffix and mode
+        return ["{0}_{1}_{2}.fits".format(dict_pre[filetype], mode, ga_suffix)
+                for ga_suffix in self._geoastro_index.select(list_days)]
+
+    def _get_geoastro_name(self, tpl, filetype='geo', mode='wfm'):
+        """Get the geometry or astrometry file name for a tpl.
+        When a tpl is not yet known, the names are resolved for all the
+        tpls of the raw files in one go.
+        """
+        key = (tpl, filetype, mode)
+        if key not in self._dict_geoastro_names:
+            list_tpls = [tpl]
+            if hasattr(self.Tables, "Rawfiles") and len(self.Tables.Rawfiles) > 0:
+                list_tpls += list(np.unique(self.Tables.Rawfiles['tpls']))
+            try:
+                list_names = self.retrieve_geoastro_names(list_tpls, filetype, mode)
+            except ValueError:
+                # Some raw tpls cannot be parsed: only using the given tpl
+                list_tpls = [tpl]
+                list_names = self.retrieve_geoastro_names(list_tpls, filetype, mode)
+            if list_names is None:
+                return None
+            for this_tpl, name in zip(list_tpls, list_names):
+                self._dict_geoastro_names[(this_tpl, filetype, mode)] = name
+        return self._dict_geoastro_names[key]
 
     def _set_option_astropy_table(self, overwrite=None, update=None):
         """Set the options for overwriting or updating the astropy tables
@@ -362,13 +603,16 @@ class MusePipe(PipePrep, PipeRecipes):
             Adding the folder move to the log file
         """
         verbose = kwargs.pop("verbose", self.verbose)
+        # Several recipes are running from the same folder
+        if self._fixed_folder:
+            return
         try:
             prev_folder = os.getcwd()
             newpath = os.path.normpath(newpath)
             os.chdir(newpath)
             upipe.print_info("Going to folder {0}".format(newpath), pipe=self)
             if addtolog:
-                upipe.append_file(self.paths.log_filename, "cd {0}\n".format(newpath))
+                self._append_logfile("cd {0}\n".format(newpath))
             self.paths._prev_folder = prev_folder
         except OSError:
             if not os.path.isdir(newpath):
@@ -423,6 +667,10 @@ class MusePipe(PipePrep, PipeRecipes):
         for expotype in dict_expotypes:
             setattr(self.Tables.Raw, self._get_attr_expo(expotype), [])
 
+        # Indexes on the tables need to be rebuilt
+        self._expo_store.reset()
+
+    @traced("table")
     def read_all_astro_tables(self, reset=False):
         """Initialise all existing Astropy Tables
         """
@@ -437,6 +685,7 @@ class MusePipe(PipePrep, PipeRecipes):
             setattr(self._dict_tables["processed"], self._get_attr_expo(expotype),
                     self.read_astropy_table(expotype, stage="processed"))
 
+    @traced("table")
     def read_astropy_table(self, expotype=None, stage="master"):
         """Read an existing Masterfile data table to start the pipeline
         """
@@ -451,6 +700,7 @@ class MusePipe(PipePrep, PipeRecipes):
                              pipe=self)
             return Table.read(name_table, format="fits")
 
+    @traced("table")
     def init_raw_table(self, reset=False, **kwargs):
         """ Create a fits table with all the information from
         the Raw files. Also create an astropy table with the same info
@@ -459,6 +709,17 @@ class MusePipe(PipePrep, PipeRecipes):
         ----------
         reset: bool [False]
             Resetting the raw astropy table if True
+        overwrite: bool
+            Overwrite the existing table. Default to self._overwrite_astropy_table
+        nworkers: int
+            Number of workers to read the raw headers. Default to
+            self._raw_nworkers
+        scan_mode: str
+            'thread' or 'process'. Default to self._raw_scan_mode
+        incremental: bool
+            If True, only parse the new or modified raw files and merge
+            them with the cached information. Deleted files are dropped.
+            Default to self._incremental_raw_table
         """
         upipe.print_info("Creating the astropy fits raw data table", pipe=self)
 
@@ -470,9 +731,14 @@ class MusePipe(PipePrep, PipeRecipes):
 
         # ---- File exists - we READ it ------------------- #
         overwrite = kwargs.pop("overwrite", self._overwrite_astropy_table)
+        incremental = kwargs.pop("incremental", self._incremental_raw_table)
         scan_raw = True
         if os.path.isfile(name_table):
-            if overwrite:
+            if incremental:
+                upipe.print_info("The raw-files table will be updated with "
+                                 "the new raw files", pipe=self)
+                overwrite = True
+            elif overwrite:
                 upipe.print_warning("The raw-files table will be overwritten",
                                     pipe=self)
             else:
@@ -487,6 +753,9 @@ class MusePipe(PipePrep, PipeRecipes):
 
         # ---- File does not exist - we create it ---------- #
         if scan_raw:
+            nworkers = kwargs.pop("nworkers", self._raw_nworkers)
+            scan_mode = kwargs.pop("scan_mode", self._raw_scan_mode)
+
             # Check the raw folder
             self.goto_folder(self.paths.rawfiles)
             # Get the list of files from the Raw data folder
@@ -496,49 +765,12 @@ class MusePipe(PipePrep, PipeRecipes):
             fulldic = listexpo_files.copy()
             fulldic.update(smalldic)
 
-            # Init the lists
-            MUSE_infodic = {}
-            for key in fulldic:
-                MUSE_infodic[key] = []
-
-            # Looping over the files
+            # Selecting the files with MUSE and fits.fz
+            list_rawfiles = []
             for f in files:
-                # Excluding the files without MUSE and fits.fz
                 if ('MUSE' in f):
                     if any([f.endswith(suffix) for suffix in suffix_rawfiles]):
-                        header = pyfits.getheader(f, 0)
-                        # Short circuit in case 'OBJECT' is not found in header
-                        if 'OBJECT' not in header:
-                            continue
-                        new_infodic = {}
-                        good_file = True
-                        object_file = None
-                        for k in listexpo_files:
-                            [namecol, keyword, func, form] = listexpo_files[k]
-                            if keyword in header:
-                                new_infodic[k] = func(header[keyword])
-                            elif k == 'TYPE':
-                                # Find the key which is right
-                                astrogeo_keys = [tk for tk, tv in dict_astrogeo.items() if tv == header['OBJECT']]
-                                # Nothing found?
-                                if len(astrogeo_keys) == 0:
-                                    good_file = False
-                                # If found, print info and save value
-                                else:
-                                    upipe.print_info("Found one {0} file {1}".format(
-                                        astrogeo_keys[0], f))
-                                    new_infodic[k] = astrogeo_keys[0]
-                                    object_file = astrogeo_keys[0]
-                            else:
-                                good_file = False
-                        # Transferring the information now if complete
-                        if object_file is not None:
-                            new_infodic['OBJECT'] = object_file
-                        if good_file:
-                            MUSE_infodic['FILENAME'].append(f)
-                            for k in new_infodic:
-                                MUSE_infodic[k].append(new_infodic[k])
-
+                        list_rawfiles.append(f)
                     elif any([suffix in f for suffix in suffix_rawfiles]):
                         upipe.print_warning("File {0} will be ignored "
                                             "from the Raw files "
@@ -546,9 +778,52 @@ class MusePipe(PipePrep, PipeRecipes):
                                             " please check)".format(f),
                                             pipe=self)
 
-            # Transforming into numpy arrayimport pymusepipe
-            for k in fulldic:
-                MUSE_infodic[k] = np.array(MUSE_infodic[k])
+            # Size and modification time of each file for the cache
+            list_stats = []
+            for f in list_rawfiles:
+                stat = os.stat(f)
+                list_stats.append([stat.st_size, stat.st_mtime])
+
+            # Only parsing the files which are not in the cache
+            if incremental:
+                header_cache = self._read_raw_header_cache()
+            else:
+                header_cache = {}
+            list_toscan = [f for f, fstat in zip(list_rawfiles, list_stats)
+                           if f not in header_cache
+                           or header_cache[f].get('stat') != fstat]
+            if incremental:
+                upipe.print_info("{0} new or modified raw files out of "
+                                 "{1}".format(len(list_toscan),
+                                              len(list_rawfiles)), pipe=self)
+
+            # Reading the headers, one by one or with a pool of workers
+            list_newinfo = self._scan_rawfiles(list_toscan, nworkers=nworkers,
+                                               scan_mode=scan_mode)
+            for f, (infodic, astrogeo_key) in zip(list_toscan, list_newinfo):
+                header_cache[f] = {'info': infodic, 'astrogeo': astrogeo_key}
+
+            # Updating the cache, which drops the deleted files
+            header_cache = {f: dict(header_cache[f], stat=fstat)
+                            for f, fstat in zip(list_rawfiles, list_stats)}
+            self._write_raw_header_cache(header_cache)
+            list_info = [(header_cache[f]['info'], header_cache[f]['astrogeo'])
+                         for f in list_rawfiles]
+
+            # Keeping the files with a complete set of information
+            good_files, good_info = [], []
+            for f, (infodic, astrogeo_key) in zip(list_rawfiles, list_info):
+                if astrogeo_key is not None:
+                    upipe.print_info("Found one {0} file {1}".format(
+                        astrogeo_key, f))
+                if infodic is not None:
+                    good_files.append(f)
+                    good_info.append(infodic)
+
+            # Building the numpy arrays for each column
+            MUSE_infodic = {'FILENAME': np.array(good_files)}
+            for k in listexpo_files:
+                MUSE_infodic[k] = np.array([info[k] for info in good_info])
 
             # Getting a sorted array with indices
             idxsort = np.argsort(MUSE_infodic['FILENAME'])
@@ -575,6 +850,88 @@ class MusePipe(PipePrep, PipeRecipes):
         # Sorting the types ====================================
         self.sort_raw_tables()
 
+    def _get_raw_header_cache_name(self):
+        """Get the name of the header cache of the raw files
+        """
+        name_table = self._get_fitstablename_expo('RAWFILES', "raw")
+        return name_table.replace("list_table.fits", "header_cache.json")
+
+    def _read_raw_header_cache(self):
+        """Read the cache including the header information of the raw files
+
+        Returns
+        -------
+        header_cache: dict
+            For each file name, the size and mtime ('stat'), and the
+            output of _read_rawfile_info ('info', 'astrogeo').
+            Empty if the cache does not exist or cannot be read.
+        """
+        name_cache = self._get_raw_header_cache_name()
+        if not os.path.isfile(name_cache):
+            upipe.print_warning("Raw header cache {0} does not exist - all "
+                                "raw files will be read".format(name_cache),
+                                pipe=self)
+            return {}
+        try:
+            with open(name_cache, "r") as fcache:
+                header_cache = json.load(fcache)
+        except (OSError, ValueError):
+            upipe.print_warning("Could not read raw header cache {0} - all "
+                                "raw files will be read".format(name_cache),
+                                pipe=self)
+            return {}
+        return header_cache
+
+    def _write_raw_header_cache(self, header_cache):
+        """Save the cache including the header information of the raw files
+        """
+        name_cache = self._get_raw_header_cache_name()
+        # Write first in a temporary file to never leave a broken cache
+        temp_name = name_cache + ".tmp"
+        with open(temp_name, "w") as fcache:
+            json.dump(header_cache, fcache)
+        os.replace(temp_name, name_cache)
+
+    def _scan_rawfiles(self, list_rawfiles, nworkers=1, scan_mode="thread"):
+        """Read the information from the headers of a list of raw files
+
+        Parameters
+        ----------
+        list_rawfiles: list of str
+            Names of the files in the raw folder (the current folder)
+        nworkers: int [1]
+            Number of workers. If 1, the files are read sequentially.
+        scan_mode: str ['thread']
+            'thread' or 'process' to use a pool of threads or processes
+
+        Returns
+        -------
+        list_info: list of tuples
+            For each file, the output of _read_rawfile_info, in the same
+            order as the input list.
+        """
+        # Full names as we are already in the raw folder
+        fullnames = [os.path.abspath(f) for f in list_rawfiles]
+        if nworkers is None or nworkers <= 1 or len(fullnames) <= 1:
+            return [_read_rawfile_info(f) for f in fullnames]
+
+        dict_executor = {'thread': ThreadPoolExecutor,
+                         'process': ProcessPoolExecutor}
+        if scan_mode not in dict_executor:
+            upipe.print_warning("Scan mode {0} not recognised - using "
+                                "threads".format(scan_mode), pipe=self)
+            scan_mode = 'thread'
+
+        upipe.print_info("Reading {0} raw headers with {1} {2} "
+                         "workers".format(len(fullnames), nworkers,
+                                          scan_mode), pipe=self)
+        chunksize = max(1, len(fullnames) // (4 * nworkers))
+        with dict_executor[scan_mode](max_workers=nworkers) as executor:
+            list_info = list(executor.map(_read_rawfile_info, fullnames,
+                                          chunksize=chunksize))
+        return list_info
+
+    @traced("table")
     def save_expo_table(self, expotype, tpl_gtable, stage="master",
                         fits_tablename=None, aggregate=True, suffix="",
                         overwrite=None, update=None):
@@ -627,7 +984,13 @@ class MusePipe(PipePrep, PipeRecipes):
 
         table_to_save.write(full_tablename, format="fits", overwrite=True)
         setattr(self._dict_tables[stage], attr_expo, table_to_save)
+        # The index of that table is now obsolete
+        self._expo_store.invalidate(expotype, stage)
+        # Updating the calibration plan if it uses that table
+        if self._use_calib_plan and (expotype, stage) in list_calib_plan:
+            self.create_calib_plan()
 
+    @traced("table")
     def sort_raw_tables(self, checkmode=None, strong_checkmode=None):
         """Provide lists of exposures with types defined in the dictionary
         """
@@ -707,20 +1070,68 @@ class MusePipe(PipePrep, PipeRecipes):
         # Opening the offset table
         self.offset_table = Table.read(fullname_offset_table)
 
-    def _select_closest_mjd(self, mjdin, group_table):
+    def _select_closest_mjd(self, mjdin, group_table, expotype=None, stage="master"):
         """Get the closest frame within the expotype
         If the attribute does not exist in Tables, it tries to read
         the table from the folder
+
+        Input
+        -----
+        mjdin: float
+            MJD to compare with
+        group_table: astropy Table
+            Table with the mjd and tpls columns
+        expotype: str [None]
+            If provided, the sorted MJD index of that expotype and stage
+            is used. Otherwise a full scan of the table is done.
+        stage: str ['master']
         """
         if len(group_table['mjd']) < 1:
             # Printing an error message and sending back a -1 for index
             upipe.print_error("[musepipe/_select_closest_mjd] Group table is empty - Aborting")
             return -1, None
         # Get the closest tpl
-        index = np.argmin((mjdin - group_table['mjd']) ** 2)
+        if expotype is None:
+            index = np.argmin((mjdin - group_table['mjd']) ** 2)
+        else:
+            expo_index = self._expo_store.get_index(group_table, expotype, stage)
+            # First looking in the calibration plan
+            if self._use_calib_plan:
+                planned = self._calib_plan.lookup(mjdin, expotype, stage,
+                                                  expo_index.signature)
+                if planned is not None:
+                    return planned
+            index = expo_index.closest_mjd(mjdin)
         closest_tpl = group_table[index]['tpls']
         return index, closest_tpl
 
+    def _select_closest_mjd_list(self, list_mjd, expotype, stage="master"):
+        """Get the closest frames within the expotype for a list of mjd
+        in one call, using the sorted MJD index
+
+        Input
+        -----
+        list_mjd: list or array of floats
+        expotype: str
+        stage: str ['master']
+
+        Returns
+        -------
+        indices: array of int
+            Row indices in the table of that expotype and stage.
+            Empty if the table is empty.
+        closest_tpls: array of str
+            Tpls of the closest frames
+        """
+        expo_table = self._get_table_expo(expotype, stage)
+        if len(expo_table) < 1:
+            upipe.print_error("[musepipe/_select_closest_mjd_list] Table for "
+                              "{0} / {1} is empty - Aborting".format(expotype, stage))
+            return np.array([], dtype=int), np.array([])
+        indices = self._expo_store.get_index(expo_table, expotype,
+                                             stage).closest_mjd(np.atleast_1d(list_mjd))
+        return indices, np.asarray(expo_table['tpls'])[indices]
+
     def _get_path_expo(self, expotype, stage="master"):
         masterfolder = upipe.lower_allbutfirst_letter(expotype)
         if stage.lower() == "master":
@@ -12,6 +12,9 @@ __contact__   = " <eric.emsellem@eso.org>"
 # Importing modules
 import os
 from os.path import join as joinpath
+import threading
+import json
+import hashlib
 
 from copy import deepcopy
 
@@ -21,11 +24,18 @@ import numpy as np
 # pymusepipe modules
 from . import util_pipe as upipe
 from .create_sof import SofPipe
+from .expo_store import ExpoStore
+from .calib_plan import CalibPlan
+from .recipe_scheduler import RecipeScheduler
 from .align_pipe import create_offset_table, AlignMusePointing
 from . import musepipe
 from .mpdaf_pipe import MuseSkyContinuum, MuseFilter
 from .config_pipe import mjd_names,get_suffix_product
 from .config_pipe import dict_recipes_per_num, dict_recipes_per_name
+from .config_pipe import list_science_calib_plan, list_calib_plan, name_calib_plan
+from .config_pipe import dict_recipes_dependencies, dict_recipes_memory
+from .config_pipe import dict_shared_calib_recipes
+from .trace_pipe import get_tracer, trace_span
 
 try :
     import astropy as apy
@@ -87,12 +97,20 @@ def norm_listpath(paths) :
 import functools
 def print_my_function_name(f):
     """Function to provide a print of the name of the function
-    Can be used as a decorator
+    Can be used as a decorator. The call is also recorded as a trace
+    span, and the trace is exported at the end of the top level call
+    if the pipe is traced.
     """
     @functools.wraps(f)
     def wrapped(*myargs, **mykwargs):
         upipe.print_info("################   " + f.__name__ + "   ################")
-        return f(*myargs, **mykwargs)
+        with trace_span(f.__name__, category="run"):
+            result = f(*myargs, **mykwargs)
+        pipe = myargs[0] if len(myargs) > 0 else None
+        if getattr(pipe, "_trace", False) and get_tracer().depth == 0 \
+                and threading.current_thread() is threading.main_thread():
+            pipe.export_trace(name_run=f.__name__)
+        return result
     return wrapped
 
 def _get_combine_products(filter_list='white', prefix_all=""):
@@ -124,11 +142,28 @@ def _get_combine_products(filter_list='white', prefix_all=""):
 class PipePrep(SofPipe) :
     """PipePrep class prepare the SOF files and launch the recipes
     """
-    def __init__(self, first_recipe=1, last_recipe=None):
+    def __init__(self, first_recipe=1, last_recipe=None, shared_calibrations=None):
         """Initialisation of PipePrep
+
+        Input
+        -----
+        shared_calibrations: dict [None]
+            For each calibration recipe (e.g., 'bias'), the list of tpls
+            reduced once for several pointings and linked in the Master
+            folders. These tpls are skipped by the run_* recipes.
         """
         SofPipe.__init__(self)
 #        super(PipePrep, self).__init__()
+        # Store for the indexes of the exposure tables
+        self._expo_store = ExpoStore()
+        # Plan associating science tpls and calibrations
+        self._calib_plan = CalibPlan()
+        self._calib_plan_lock = threading.Lock()
+        # Calibration tpls reduced for several pointings
+        self._shared_calibrations = {}
+        if shared_calibrations is not None:
+            for recipe in shared_calibrations:
+                self._shared_calibrations[recipe] = set(shared_calibrations[recipe])
         self.list_recipes = deepcopy(list_recipes)
         self.first_recipe = first_recipe
         if last_recipe is None:
@@ -141,10 +176,199 @@ class PipePrep(SofPipe) :
         """
         # This returns the first tpl of the group table
         tpl = gtable['tpls'][0]
-        # This returns the mean mjd, using aggregate
-        mean_mjd = gtable.groups.aggregate(np.mean)['mjd'].data[0]
+        # This returns the mean mjd of the group, without aggregating
+        # all the other columns
+        mean_mjd = np.mean(gtable['mjd'].data)
         return tpl, mean_mjd
 
+    def _get_expo_index(self, expotype, stage="raw"):
+        """Get the index of the table of a certain expotype and stage
+        It is built once and rebuilt only if the table changes.
+        """
+        return self._expo_store.get_index(self._get_table_expo(expotype, stage),
+                                          expotype, stage)
+
+    def _get_calib_plan_name(self):
+        """Get the name of the calibration plan file
+        """
+        return joinpath(self.paths.astro_tables, name_calib_plan)
+
+    def _select_calib_for_plan(self, calibkey, list_mjd):
+        """Get the closest calibrations for a list of mjd
+        Used to fill in the calibration plan
+        """
+        expotype, stage = calibkey.split("/")
+        expo_table = self._get_table_expo(expotype, stage)
+        if len(expo_table) == 0:
+            return [-1] * len(list_mjd), [""] * len(list_mjd)
+        return self._select_closest_mjd_list(list_mjd, expotype, stage)
+
+    def create_calib_plan(self, update=True, write=True):
+        """Create the plan associating each science tpl and exposure
+        (OBJECT, SKY, STD) with the closest calibrations.
+        The SOF writers then use the plan instead of searching the tables.
+
+        Input
+        -----
+        update: bool [True]
+            If True, start from the existing plan file and only recompute
+            the entries for which the science exposures or the
+            calibration tables have changed.
+        write: bool [True]
+            Write the plan in the Astro tables folder.
+        """
+        with self._calib_plan_lock:
+            self._create_calib_plan(update=update, write=write)
+
+    def _create_calib_plan(self, update=True, write=True):
+        """Create the calibration plan (see create_calib_plan)
+        """
+        name_plan = self._get_calib_plan_name()
+        if update:
+            if not self._calib_plan.read(name_plan) and self.verbose:
+                upipe.print_warning("No valid calibration plan in {0} - "
+                                    "creating a new one".format(name_plan), pipe=self)
+        else:
+            self._calib_plan.reset()
+
+        # Science points: the tpls and the individual exposures
+        science_points = {}
+        for expotype in list_science_calib_plan:
+            expo_table = self._get_table_expo(expotype, "raw")
+            if len(expo_table) == 0:
+                continue
+            for gtable in self._get_expo_index(expotype, "raw").grouped.groups:
+                tpl, mean_mjd = self._get_tpl_meanmjd(gtable)
+                science_points["{0}/{1}".format(expotype, tpl)] = [expotype, tpl,
+                                                                   0, mean_mjd]
+                for row in gtable:
+                    science_points["{0}/{1}/{2:04d}".format(expotype, tpl, row['tplno'])] = \
+                            [expotype, tpl, row['tplno'], row['mjd']]
+
+        # Signatures of the calibration tables
+        dict_signatures = {}
+        for expotype, stage in list_calib_plan:
+            expo_table = self._get_table_expo(expotype, stage)
+            if len(expo_table) == 0:
+                signature = ""
+            else:
+                signature = self._expo_store.get_index(expo_table, expotype,
+                                                       stage).signature
+            dict_signatures[CalibPlan.calib_key(expotype, stage)] = signature
+
+        nupdate = self._calib_plan.update(science_points, dict_signatures,
+                                          self._select_calib_for_plan)
+        upipe.print_info("Calibration plan: {0} science entries, {1} "
+                         "updated".format(len(science_points), nupdate), pipe=self)
+        if write:
+            self._calib_plan.write(name_plan)
+
+    def get_calib_tpl_keys(self, recipe):
+        """Get the tpls of the raw files of a calibration recipe
+        (see config_pipe.dict_shared_calib_recipes), with their files
+
+        Returns
+        -------
+        dict_keys: dict
+            For each tpl, the sorted tuple of the names of its raw files
+        """
+        expotype = dict_shared_calib_recipes[recipe][0]
+        if len(self._get_table_expo(expotype, "raw")) == 0:
+            return {}
+        dict_keys = {}
+        for gtable in self._get_expo_index(expotype, "raw").grouped.groups:
+            tpl = gtable['tpls'][0]
+            dict_keys[tpl] = tuple(sorted(os.path.basename(name) 
+                                          for name in gtable['filename']))
+        return dict_keys
+
+    def get_calib_products(self, recipe, tpl):
+        """Get the names of the master products of a calibration recipe
+        for one tpl
+        """
+        list_products = []
+        for expotype in dict_shared_calib_recipes[recipe][1]:
+            if expotype == "TWILIGHT":
+                list_names = dict_files_products['TWILIGHT']
+            else:
+                list_names = [get_suffix_product(expotype)]
+            for name_prod in list_names:
+                list_products.append("{0}_{1}.fits".format(joinpath(
+                    self._get_fullpath_expo(expotype, "master"), name_prod), tpl))
+        return list_products
+
+    def _is_shared_calibration(self, recipe, tpl):
+        """Check if a calibration tpl is reduced for several pointings
+        """
+        if tpl in self._shared_calibrations.get(recipe, set()):
+            if self.verbose:
+                upipe.print_info("{0} tpl {1} is a shared calibration - "
+                                 "skipping it".format(recipe, tpl), pipe=self)
+            self._record_shared_calibration_unit(recipe, tpl)
+            return True
+        return False
+
+    def _record_shared_calibration_unit(self, recipe, tpl):
+        """Record a shared calibration tpl as a unit of the run_* recipe
+        being run, if it was linked (see link_shared_calibration)
+        """
+        if not self._checkpoint or self.fakemode:
+            return
+        name_recipe = "shared_{0}_{1}".format(recipe, tpl)
+        if self._get_checkpoint_store().is_unit_complete(name_recipe):
+            self._record_checkpoint_unit(name_recipe)
+        else:
+            upipe.print_warning("Shared calibration {0} {1} not linked or with "
+                                "missing products".format(recipe, tpl), pipe=self)
+            self._record_checkpoint_failure(name_recipe)
+
+    def link_shared_calibration(self, recipe, tpl, folder_shared):
+        """Link the master products of a shared calibration tpl in the
+        Master folders, and add the tpl to the master tables.
+        Products already in the Master folders (from the pointing which
+        reduced them) are first moved to the shared folder.
+        The linked tpl is recorded as a completed checkpoint unit.
+
+        Input
+        -----
+        recipe: str
+            Calibration recipe (e.g., 'bias')
+        tpl: str
+        folder_shared: str
+            Folder of the shared products
+        """
+        os.makedirs(folder_shared, exist_ok=True)
+        list_products = self.get_calib_products(recipe, tpl)
+        for name_prod in list_products:
+            name_shared = joinpath(folder_shared, os.path.basename(name_prod))
+            if os.path.isfile(name_prod) and not os.path.islink(name_prod) \
+                    and not os.path.isfile(name_shared):
+                self.transfer_products([(name_prod, name_shared)],
+                                       name_recipe="shared_{0}_{1}".format(recipe, tpl))
+            if not os.path.isfile(name_shared):
+                upipe.print_error("Shared calibration {0} is missing".format(name_shared),
+                                  pipe=self)
+                continue
+            if os.path.lexists(name_prod):
+                os.remove(name_prod)
+            os.symlink(name_shared, name_prod)
+
+        # Checkpoint unit of the linked tpl, recorded by the run_* recipe
+        # (see _is_shared_calibration). Not written if a product is missing.
+        self._write_checkpoint("link_shared_calibration {0} {1} {2}".format(
+                               recipe, tpl, folder_shared), list_products,
+                               "shared_{0}_{1}".format(recipe, tpl))
+
+        # Adding the tpl to the master tables
+        self._shared_calibrations.setdefault(recipe, set()).add(tpl)
+        gtable = self.select_tpl_files(expotype=dict_shared_calib_recipes[recipe][0], tpl=tpl)
+        if len(gtable) == 0:
+            return
+        overwrite, update = self._overwrite_astropy_table, self._update_astropy_table
+        for expotype in dict_shared_calib_recipes[recipe][1]:
+            self.save_expo_table(expotype, gtable, "master", overwrite=False, update=True)
+        self._set_option_astropy_table(overwrite, update)
+
     def select_tpl_files(self, expotype=None, tpl="ALL", stage="raw"):
         """Selecting a subset of files from a certain type
         """
@@ -162,11 +386,8 @@ class PipePrep(SofPipe) :
                         pipe=self)
             return MUSE_subtable
 
-        group_table = MUSE_subtable.group_by('tpls')
-        if tpl == "ALL":
-            return group_table
-        else :
-            return group_table.groups[group_table.groups.keys['tpls'] == tpl]
+        # Using the index to avoid re-grouping the table
+        return self._get_expo_index(expotype, stage).select_tpl(tpl)
         
     @staticmethod
     def print_recipes():
@@ -192,6 +413,23 @@ class PipePrep(SofPipe) :
             Default is True (use illumination during twilight calibration)
         skymethod: str
             Default is "model".
+        force_recipes: bool
+            If True, run all recipes even if found in the recipe cache.
+            Default is the value given at initialisation.
+        max_parallel_recipes: int
+            Maximum number of recipes (e.g., wave and twilight) run at the
+            same time when their inputs are ready. The cpus are split
+            between them. 1 runs the recipes one by one in order.
+            Default is the value given at initialisation.
+        memory_budget: float
+            Maximum memory (GB) of the recipes running at the same time
+            (see config_pipe.dict_recipes_memory). Default is the value
+            given at initialisation.
+
+        With checkpoint=True at initialisation, the recipes (and their
+        units) already completed with the same arguments and inputs are
+        skipped, so that a run can be resumed at the first incomplete
+        recipe. force_recipes=True runs them again.
         """
         # Dictionary of arguments for each recipe
         default_dict_kwargs_recipes = {'twilight': {'illum': illum},
@@ -232,16 +470,87 @@ class PipePrep(SofPipe) :
         upipe.print_info("               [steps {0} - {1}]".format(
                             first_recipe, last_recipe))
 
-        # Now doing the recipes one by one in order
-        for ind in range(first_recipe, last_recipe + 1):
-            recipe = dict_recipes_per_num[ind]
-            name_recipe = "run_{}".format(recipe)
-            # Including the kwargs for each recipe
-            if recipe in dict_kwargs_recipes:
-                kdic = dict_kwargs_recipes[recipe]
+        # Forcing the recipes even if they are in the recipe cache
+        init_force_recipes = self._force_recipes
+        self._force_recipes = kwargs.pop("force_recipes", init_force_recipes)
+
+        # Scheduling the recipes following their dependencies
+        max_parallel_recipes = kwargs.pop("max_parallel_recipes", self._max_parallel_recipes)
+        memory_budget = kwargs.pop("memory_budget", self._memory_budget)
+        list_names = [dict_recipes_per_num[ind] for ind in range(first_recipe, last_recipe + 1)]
+        scheduler = RecipeScheduler(list_names, dict_recipes_dependencies,
+                                    self._get_all_cpus(), max_parallel=max_parallel_recipes,
+                                    memory_budget=memory_budget,
+                                    dict_memory=dict_recipes_memory)
+        parallel = scheduler.max_parallel > 1
+        if parallel:
+            # All recipes work from the data folder: staying there
+            # while they run at the same time
+            self.goto_folder(self.paths.data, addtolog=True)
+            self._fixed_folder = True
+
+        try:
+            scheduler.run(lambda recipe, cpus: self._run_recipe_node(recipe, cpus,
+                              dict_kwargs_recipes.get(recipe, {}), parallel))
+        finally:
+            if parallel:
+                self._fixed_folder = False
+                self.goto_prevfolder(addtolog=True)
+            self._force_recipes = init_force_recipes
+
+        if self._recipe_cache:
+            self.print_recipe_cache_report()
+
+    def _run_recipe_node(self, recipe, cpus, kdic, pin_cpus=True):
+        """Run one of the run_* recipes with its kwargs, pinning its
+        esorex commands to the given cpus if pin_cpus is True
+        """
+        name_recipe = "run_{}".format(recipe)
+        inputs = self._get_recipe_inputs_key(recipe, kdic)
+        if self._checkpoint and not self._force_recipes and not self.fakemode \
+                and self._get_checkpoint_store().is_recipe_complete(recipe, inputs,
+                        get_key=self._get_recipe_key):
+            upipe.print_info("Recipe {0} already completed (checkpoint) "
+                             "- skipping it".format(name_recipe), pipe=self)
+            return
+
+        self._job_context.recipe_node = recipe
+        with self._recipe_lock:
+            self._checkpoint_units[recipe] = []
+            self._checkpoint_failures[recipe] = []
+        try:
+            if pin_cpus:
+                self._run_with_cpus(cpus, getattr(self, name_recipe), **kdic)
             else:
-                kdic = {}
-            getattr(self, name_recipe)(**kdic)
+                getattr(self, name_recipe)(**kdic)
+        finally:
+            del self._job_context.recipe_node
+
+        with self._recipe_lock:
+            list_units = self._checkpoint_units.pop(recipe, [])
+            list_failures = self._checkpoint_failures.pop(recipe, [])
+        if not self._checkpoint or self.fakemode:
+            return
+        # A recipe which aborted (no unit) or with failed units is run again
+        if len(list_units) == 0 or len(list_failures) > 0:
+            upipe.print_warning("Recipe {0} not completed ({1} unit(s), {2} failed) "
+                                "- no checkpoint written".format(name_recipe,
+                                len(list_units), len(list_failures)), pipe=self)
+            return
+        self._get_checkpoint_store().write_recipe(recipe, list_units,
+                                                  pointing=self.pointing, inputs=inputs)
+
+    def _get_recipe_inputs_key(self, recipe, kdic):
+        """Get the hash of the inputs of a run_* recipe: its arguments
+        and the raw files (name and tpl)
+        """
+        key = hashlib.sha1(json.dumps({'recipe': recipe, 'kwargs': kdic}, sort_keys=True,
+                                      default=str).encode('utf-8'))
+        rawfiles = getattr(getattr(self, "Tables", None), "Rawfiles", None)
+        if rawfiles is not None and len(rawfiles) > 0:
+            for filename, tpl in zip(rawfiles['filename'], rawfiles['tpls']):
+                key.update("{0} {1}\n".format(filename, tpl).encode('utf-8'))
+        return key.hexdigest()
 
     @print_my_function_name
     def run_phangs_recipes(self, fraction=0.8, illum=True, skymethod="model",
@@ -294,13 +603,16 @@ class PipePrep(SofPipe) :
                     list(gtable['filename']))
             # extract the tpl (string)
             tpl = gtable['tpls'][0]
+            if self._is_shared_calibration('bias', tpl):
+                continue
             # Writing the sof file
             self.write_sof(sof_filename=sof_filename + "_" + tpl, new=True)
             # Name of final Master Bias
             name_bias = get_suffix_product('BIAS')
             dir_bias = self._get_fullpath_expo('BIAS', "master")
             # Run the recipe
-            self.recipe_bias(self.current_sof, dir_bias, name_bias, tpl)
+            self._submit_recipe(self.recipe_bias, self.current_sof, dir_bias, name_bias, tpl)
+        self._run_submitted_recipes()
 
         # Write the MASTER BIAS Table and save it
         self.save_expo_table('BIAS', tpl_gtable, "master", update=update)
@@ -341,6 +653,8 @@ class PipePrep(SofPipe) :
                     list(gtable['filename']))
             # extract the tpl (string) and mean mjd (float) 
             tpl, mean_mjd = self._get_tpl_meanmjd(gtable)
+            if self._is_shared_calibration('flat', tpl):
+                continue
             # Adding the best tpc MASTER_BIAS
             self._add_tplmaster_to_sofdict(mean_mjd, 'BIAS')
             # Writing the sof file
@@ -351,7 +665,9 @@ class PipePrep(SofPipe) :
             dir_trace = self._get_fullpath_expo('TRACE', "master")
             name_tracetable = get_suffix_product('TRACE')
             # Run the recipe
-            self.recipe_flat(self.current_sof, dir_flat, name_flat, dir_trace, name_tracetable, tpl)
+            self._submit_recipe(self.recipe_flat, self.current_sof, dir_flat, name_flat,
+                                dir_trace, name_tracetable, tpl)
+        self._run_submitted_recipes()
 
         # Write the MASTER FLAT Table and save it
         self.save_expo_table('FLAT', tpl_gtable, "master", update=update)
@@ -394,6 +710,8 @@ class PipePrep(SofPipe) :
                     list(gtable['filename']))
             # extract the tpl (string) and mean mjd (float) 
             tpl, mean_mjd = self._get_tpl_meanmjd(gtable)
+            if self._is_shared_calibration('wave', tpl):
+                continue
             # Finding the best tpl for BIAS + TRACE
             self._add_list_tplmaster_to_sofdict(mean_mjd, ['BIAS', 'TRACE'])
             # Writing the sof file
@@ -402,7 +720,8 @@ class PipePrep(SofPipe) :
             dir_wave = self._get_fullpath_expo('WAVE', "master")
             name_wave = get_suffix_product('WAVE')
             # Run the recipe
-            self.recipe_wave(self.current_sof, dir_wave, name_wave, tpl)
+            self._submit_recipe(self.recipe_wave, self.current_sof, dir_wave, name_wave, tpl)
+        self._run_submitted_recipes()
 
         # Write the MASTER WAVE Table and save it
         self.save_expo_table('WAVE', tpl_gtable, "master", update=update)
@@ -444,6 +763,8 @@ class PipePrep(SofPipe) :
                     list(gtable['filename']))
             # extract the tpl (string) and mean mjd (float) 
             tpl, mean_mjd = self._get_tpl_meanmjd(gtable)
+            if self._is_shared_calibration('lsf', tpl):
+                continue
             # Finding the best tpl for BIAS, TRACE, WAVE
             self._add_list_tplmaster_to_sofdict(mean_mjd, ['BIAS', 'TRACE', 'WAVE'])
             # Writing the sof file
@@ -452,7 +773,8 @@ class PipePrep(SofPipe) :
             dir_lsf = self._get_fullpath_expo('LSF', "master")
             name_lsf = get_suffix_product('LSF')
             # Run the recipe
-            self.recipe_lsf(self.current_sof, dir_lsf, name_lsf, tpl)
+            self._submit_recipe(self.recipe_lsf, self.current_sof, dir_lsf, name_lsf, tpl)
+        self._run_submitted_recipes()
 
         # Write the MASTER LSF PROFILE Table and save it
         self.save_expo_table('LSF', tpl_gtable, "master", update=update)
@@ -490,6 +812,8 @@ class PipePrep(SofPipe) :
         for gtable in tpl_gtable.groups:
             # extract the tpl (string) and mean mjd (float) 
             tpl, mean_mjd = self._get_tpl_meanmjd(gtable)
+            if self._is_shared_calibration('twilight', tpl):
+                continue
             self._add_geometry_to_sofdict(tpl, mean_mjd)
             # Provide the list of files to the dictionary
             self._sofdict['SKYFLAT'] = add_listpath(self.paths.rawfiles,
@@ -503,7 +827,9 @@ class PipePrep(SofPipe) :
             # Names and folder of final Master Wave
             dir_twilight = self._get_fullpath_expo('TWILIGHT', "master")
             name_twilight = deepcopy(dict_files_products['TWILIGHT'])
-            self.recipe_twilight(self.current_sof, dir_twilight, name_twilight, tpl)
+            self._submit_recipe(self.recipe_twilight, self.current_sof, dir_twilight,
+                                name_twilight, tpl)
+        self._run_submitted_recipes()
 
         # Write the MASTER TWILIGHT Table and save it
         self.save_expo_table('TWILIGHT', tpl_gtable, "master", update=update)
@@ -549,7 +875,8 @@ class PipePrep(SofPipe) :
 
         # Create the dictionary for the LSF including
         # the list of files to be processed for one MASTER Flat
-        for ntable, gtable in enumerate(tpl_gtable.groups):
+        list_gtables = []
+        for gtable in tpl_gtable.groups:
             self._add_calib_to_sofdict("BADPIX_TABLE", reset=True)
             self._add_calib_to_sofdict("LINE_CATALOG")
             # extract the tpl (string) and mean mjd (float) 
@@ -579,11 +906,16 @@ class PipePrep(SofPipe) :
             list_expo = np.arange(Nexpo).astype(np.int) + 1
             for iexpo in list_expo:
                 name_products += ['{0:04d}-{1:02d}.fits'.format(iexpo, j+1) for j in range(24)]
-            self.recipe_scibasic(self.current_sof, tpl, expotype, dir_products, name_products, suffix)
-
-            # Write the Processed files Table and save it
-            # Note: always overwrite the table so that a fresh numbering is done
+            self._submit_recipe(self.recipe_scibasic, self.current_sof, tpl, expotype,
+                                dir_products, name_products, suffix)
             gtable['iexpo'] = list_expo
+            list_gtables.append(gtable)
+
+        self._run_submitted_recipes()
+
+        # Write the Processed files Table and save it
+        # Note: always overwrite the table so that a fresh numbering is done
+        for ntable, gtable in enumerate(list_gtables):
             if ntable == 0:
                 self.save_expo_table(expotype, gtable, "processed", aggregate=False,
                                      update=update, overwrite=overwrite)
@@ -891,10 +1223,13 @@ class PipePrep(SofPipe) :
         list_expo = np.unique(list_expo)
         # Then we select those who exist in the table
         # And don't forget to group the table by tpls
-        group_table = tpl_table[np.isin(tpl_table['iexpo'], list_expo)].group_by('tpls')
-        group_list_expo = []
-        for gtable in group_table:
-            group_list_expo.append(gtable['iexpo'].data)
+        # The table is already grouped, so only regroup a subset
+        mask_expo = np.isin(tpl_table['iexpo'], list_expo)
+        if np.all(mask_expo):
+            group_table = tpl_table
+        else:
+            group_table = tpl_table[mask_expo].group_by('tpls')
+        group_list_expo = [gtable['iexpo'].data for gtable in group_table.groups]
 
         found_expo = True
         if len(group_table) == 0:
@@ -913,7 +1248,7 @@ class PipePrep(SofPipe) :
         expotype = "SKY"
         # Finding the best tpl for this sky calib file type
         expo_table = self._get_table_expo(expotype, stage)
-        index, this_tpl = self._select_closest_mjd(mjd_expo, expo_table) 
+        index, this_tpl = self._select_closest_mjd(mjd_expo, expo_table, expotype, stage)
         if index < 0:
             upipe.print_info("[prep_recipes/_normalise_skycontinum/scipost] Failed to find an "
                              "exposure in the table - Aborting")
@@ -1089,6 +1424,7 @@ class PipePrep(SofPipe) :
 
         # Create the dictionary for scipost
         # Selecting either one or all of the exposures
+        list_tpls = []
         for gtable in scipost_table.groups:
             # Getting the expo list
             list_group_expo = gtable['iexpo'].data
@@ -1162,18 +1498,22 @@ class PipePrep(SofPipe) :
             # products
             name_products, suffix_products, suffix_prefinalnames, suffix_postfinalnames, fl_expo = \
                 self._get_scipost_products(save, list_group_expo, filter_list)
-            self.recipe_scipost(self.current_sof, tpl, expotype, dir_products, 
-                    name_products, suffix_products, suffix_prefinalnames, 
+            self._submit_recipe(self.recipe_scipost, self.current_sof, tpl, expotype,
+                    dir_products, name_products, suffix_products, suffix_prefinalnames, 
                     suffix_postfinalnames, suffix=suffix, 
                     lambdamin=lambdamin, lambdamax=lambdamax, save=save, 
                     filter_list=filter_list, autocalib=autocalib, rvcorr=rvcorr, 
                     skymethod=skymethod, filter_for_alignment=filter_for_alignment,
                     list_expo=fl_expo, prefix_all=prefix_all,
                     **kwargs)
+            list_tpls.append(tpl)
 
-            # Write the MASTER files Table and save it
-            if len(list_expo) == 1: suffix_expo = "_{0:04d}".format(list_expo[0])
-            else: suffix_expo = ""
+        self._run_submitted_recipes()
+
+        # Write the MASTER files Table and save it
+        if len(list_expo) == 1: suffix_expo = "_{0:04d}".format(list_expo[0])
+        else: suffix_expo = ""
+        for tpl in list_tpls:
             self.save_expo_table(expotype, scipost_table, "reduced", 
                     "IMAGES_FOV{0}_{1}{2}_{3}_list_table.fits".format(
                         suffix, expotype, suffix_expo, tpl), 
@@ -0,0 +1,155 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS recipe scheduler module. Runs a set of recipes following
+their dependencies, starting the recipes which are ready at the same time
+within a budget of cpus and memory.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# pymusepipe modules
+from . import util_pipe as upipe
+
+
+class RecipeScheduler(object):
+    """Scheduler of recipes as a dependency graph.
+
+    The free cpus are shared between the recipes started together, and
+    are given back when a recipe ends. With max_parallel=1, the recipes
+    are run one by one in the order of the input list, in the calling
+    thread, which is the sequential mode.
+    """
+    def __init__(self, list_recipes, dict_dependencies, list_cpu,
+                 max_parallel=1, memory_budget=None, dict_memory={}):
+        """Initialise the scheduler
+
+        Input
+        -----
+        list_recipes: list of str
+            Names of the recipes to run, in the order of the sequential mode
+        dict_dependencies: dict
+            List of the recipes needed by each recipe. Those which are not
+            in list_recipes are considered as done.
+        list_cpu: list of int
+            Cpus shared between the running recipes
+        max_parallel: int [1]
+            Maximum number of recipes running at the same time
+        memory_budget: float [None]
+            Maximum total memory (GB) of the running recipes.
+            None means no limit. A recipe is always started if nothing
+            else is running.
+        dict_memory: dict
+            Memory needed by each recipe (GB). 0 if not provided.
+        """
+        self.list_recipes = list(list_recipes)
+        self.dict_dependencies = {}
+        for recipe in self.list_recipes:
+            self.dict_dependencies[recipe] = [dep for dep in dict_dependencies.get(recipe, [])
+                                              if dep in self.list_recipes]
+        self.list_cpu = list(list_cpu)
+        self.max_parallel = max(1, min(max_parallel, len(self.list_recipes)))
+        self.memory_budget = memory_budget
+        self.dict_memory = dict_memory
+
+    def _is_ready(self, recipe, done):
+        return all(dep in done for dep in self.dict_dependencies[recipe])
+
+    def run(self, run_recipe):
+        """Run all recipes
+
+        Input
+        -----
+        run_recipe: function
+            Called as run_recipe(name_recipe, cpus) for each recipe
+
+        Returns
+        -------
+        done: list of str
+            Recipes which were run, in order of completion
+        """
+        if self.max_parallel == 1:
+            return self._run_sequential(run_recipe)
+
+        pending = list(self.list_recipes)
+        free_cpu = list(self.list_cpu)
+        running = {}
+        done = []
+        used_memory = 0.
+        failure = None
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while (pending and failure is None) or running:
+                # Recipes which are ready and fit in the budget
+                list_start = []
+                start_memory = used_memory
+                for recipe in pending:
+                    if failure is not None \
+                            or len(running) + len(list_start) >= self.max_parallel:
+                        break
+                    if not self._is_ready(recipe, done):
+                        continue
+                    memory = self.dict_memory.get(recipe, 0)
+                    if self.memory_budget is not None \
+                            and len(running) + len(list_start) > 0 \
+                            and start_memory + memory > self.memory_budget:
+                        continue
+                    list_start.append(recipe)
+                    start_memory += memory
+
+                # Sharing the free cpus between the recipes to start
+                if len(self.list_cpu) > 0:
+                    list_start = list_start[:len(free_cpu)]
+                for irecipe, recipe in enumerate(list_start):
+                    ncpu_recipe = len(free_cpu) // (len(list_start) - irecipe)
+                    cpus, free_cpu = free_cpu[:ncpu_recipe], free_cpu[ncpu_recipe:]
+                    memory = self.dict_memory.get(recipe, 0)
+                    used_memory += memory
+                    pending.remove(recipe)
+                    upipe.print_info("Scheduler: starting recipe {0} "
+                                     "[{1} cpus]".format(recipe, len(cpus)))
+                    future = executor.submit(run_recipe, recipe, cpus)
+                    running[future] = (recipe, cpus, memory)
+
+                if len(running) == 0:
+                    if pending and failure is None:
+                        upipe.print_error("Scheduler: recipes {0} cannot be "
+                                          "started - check the dependencies".format(pending))
+                    break
+
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    recipe, cpus, memory = running.pop(future)
+                    free_cpu = sorted(free_cpu + cpus)
+                    used_memory -= memory
+                    if future.exception() is not None:
+                        upipe.print_error("Scheduler: recipe {0} failed".format(recipe))
+                        if failure is None:
+                            failure = future.exception()
+                    else:
+                        done.append(recipe)
+
+        if failure is not None:
+            raise failure
+        return done
+
+    def _run_sequential(self, run_recipe):
+        """Run the recipes one by one, in order, in the calling thread
+        with all the cpus (see run)
+        """
+        done = []
+        for recipe in self.list_recipes:
+            if not self._is_ready(recipe, done):
+                upipe.print_error("Scheduler: recipe {0} cannot be started "
+                                  "- check the dependencies".format(recipe))
+                break
+            upipe.print_info("Scheduler: starting recipe {0} "
+                             "[{1} cpus]".format(recipe, len(self.list_cpu)))
+            run_recipe(recipe, list(self.list_cpu))
+            done.append(recipe)
+        return done
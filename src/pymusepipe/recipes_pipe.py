@@ -14,22 +14,182 @@ __contact__   = " <eric.emsellem@eso.org>"
 # Thanks to all !
 
 # Importing modules
+import os
 from os.path import join as joinpath
+import re
+import time
+import errno
 import subprocess
+import json
+import hashlib
+import threading
+import queue
+import shutil
+import tempfile
+import functools
+import inspect
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # pymusepipe modules
 from . import util_pipe as upipe
 from .version import __version__ as pipeversion
+from .checkpoint import CheckpointStore
+from .esorex_simulator import get_simulator_command
+from .cpu_allocator import CpuAllocator, get_pin_prefix, default_cpu_lock_folder
+from .log_pipe import get_log_writer
+from .trace_pipe import get_tracer, trace_span, traced
+from .usage_db import UsageDB, get_sof_bytes, get_folder_bytes, get_esorex_recipe
 
 # Likwid command
 default_likwid = "likwid-pin -c N:"
+# Name of the file recording the completed recipes
+name_recipe_cache = "recipe_cache.json"
+# Lines of the esorex output: [optional time] [ LEVEL ] recipe: message
+esorex_line_pattern = re.compile(r"^(?:\S+\s+)?\[\s*(DEBUG|INFO|WARNING|ERROR)\s*\]"
+                                 r"\s*(?:([\w.]+):\s)?(.*)$")
+# Progress of the esorex recipes given by the IFU being processed
+esorex_ifu_pattern = re.compile(r"\bIFU\s*(\d{1,2})\b")
+# Maximum time (s) between two writings of the streamed output
+stream_flush_time = 2.
+# ioctl request to clone a file (reflink, Linux only)
+FICLONE = 0x40049409
+
+def parse_esorex_line(line):
+    """Parse one line of the esorex output
+
+    Input
+    -----
+    line: str
+
+    Returns
+    -------
+    level, recipe, message: str (recipe can be None)
+        or None if this is not an esorex message
+    """
+    match = esorex_line_pattern.match(line.strip())
+    if match is None:
+        return None
+    return match.groups()
+
+def wait_process(process):
+    """Wait for a process and get its resource usage (including
+    the processes it waited for, e.g., esorex for the shell)
+
+    Returns
+    -------
+    returncode: int
+    rusage: resource usage (see os.wait4), None if not available
+    """
+    if not hasattr(os, "wait4"):
+        return process.wait(), None
+    try:
+        _, waitstatus, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Already reaped
+        return process.wait(), None
+    if os.WIFSIGNALED(waitstatus):
+        process.returncode = -os.WTERMSIG(waitstatus)
+    else:
+        process.returncode = os.WEXITSTATUS(waitstatus)
+    return process.returncode, rusage
+
+def use_job_folders(recipe):
+    """Decorator to run a recipe_* method with its own esorex
+    output and log folders (see PipeRecipes._job_folders), and its
+    own cpus when the cpu allocator is used. The recipe and tpl are
+    also given to the log records and to the trace span of the recipe.
+    """
+    signature = inspect.signature(recipe)
+    @functools.wraps(recipe)
+    def wrapped(self, *args, **kwargs):
+        tpl = signature.bind_partial(self, *args, **kwargs).arguments.get("tpl")
+        with trace_span(recipe.__name__, category="recipe", tpl=tpl), \
+                self._log_unit(recipe.__name__.replace("recipe_", ""), tpl), \
+                self._job_folders(recipe.__name__), self._allocated_cpus():
+            return recipe(self, *args, **kwargs)
+    return wrapped
 
 class PipeRecipes(object) :
     """PipeRecipes class containing all the esorex recipes for MUSE data reduction
     """
     def __init__(self, nifu=-1, first_cpu=0, ncpu=24, list_cpu=[], likwid=default_likwid,
-            fakemode=False, domerge=True, nocache=False, nochecksum=True) :
+            fakemode=False, domerge=True, nocache=False, nochecksum=True,
+            recipe_cache=False, force_recipes=False, max_parallel=1,
+            check_returncode=True, status_callback=None, stream_buffer_size=65536,
+            checkpoint=False, checkpoint_verify="size", recipe_backend="esorex",
+            simulator_options={}, cpu_allocator=False,
+            cpu_lock_folder=default_cpu_lock_folder, async_log=True, json_log=False,
+            trace=False, usage_db=None) :
         """Initialisation of PipeRecipes
+
+        Input
+        -----
+        recipe_cache: bool [False]
+            If True, a recipe is skipped when the same command was already
+            run successfully with the same SOF content (files, sizes and
+            modification times) and its products still exist.
+        force_recipes: bool [False]
+            If True, always run the recipes, even if found in the cache.
+            The cache is still updated.
+        max_parallel: int [1]
+            Maximum number of tpl groups reduced at the same time within
+            a recipe. The cpus are split between the parallel jobs.
+        check_returncode: bool [True]
+            If True, a command with a non-zero exit code raises a
+            CalledProcessError. If False, an error is printed and the
+            command is recorded as failed.
+        status_callback: function [None]
+            Called as status_callback(status) while a command runs, for
+            each esorex warning or error and when the IFU in progress
+            changes. status is a dictionary with the command, the recipe,
+            the level and message of the last line, the number of
+            warnings and errors and the current IFU.
+        stream_buffer_size: int [65536]
+            Maximum size (bytes) of the output kept in memory before being
+            written in the .out/.err log files.
+        checkpoint: bool [False]
+            If True, write a marker (with the products and their checksums)
+            for each completed unit (recipe, tpl, exposure) and run_* recipe,
+            and skip the completed ones when running again.
+        checkpoint_verify: str ['size']
+            How the products of a marker are checked: 'exist', 'size'
+            (size and modification time) or 'checksum'.
+        recipe_backend: str ['esorex']
+            Program running the recipes: 'esorex', 'simulator' (the
+            esorex_simulator, which writes synthetic products without
+            running the MUSE pipeline) or the command of any other
+            executable taking the esorex arguments.
+        simulator_options: dict [{}]
+            Options of the simulator (time_scale, size_scale, python),
+            see esorex_simulator.get_simulator_command.
+        cpu_allocator: bool [False]
+            If True, each recipe gets its own set of free cpus (as many
+            as its share of ncpu), within one NUMA node when possible,
+            and disjoint from those of the other recipes and pipes
+            running on the host. The cpus are taken among those of the
+            pipe (first_cpu and ncpu, or list_cpu), and given back at
+            the end of the recipe.
+        cpu_lock_folder: str
+            Folder of the lock files of the cpus, shared by the pipes
+            of the host.
+        async_log: bool [True]
+            If True, the log files are written by a background thread,
+            by batches. If False, each message is written at once.
+        json_log: bool [False]
+            If True, each message of the log file is also written as a
+            JSON record (time, elapsed time, level, target, pointing,
+            recipe, tpl and message) in the log file + '.jsonl'.
+        trace: bool [False]
+            If True, record the timing spans (wall and cpu time, peak
+            memory) of the run_* and recipe_* methods, the esorex
+            commands, the sof files, the tables and the python stages
+            (see trace_pipe). They are exported at the end of each top
+            level run_* method (see export_trace).
+        usage_db: str [None]
+            SQLite database (or folder) where the resources used by each
+            esorex run are recorded (see usage_db.UsageDB), tagged with the
+            target, pointing, recipe, tpl and ncpu. None to record nothing.
         """
         # Fake mode
         self.fakemode = fakemode
@@ -40,9 +200,29 @@ class PipeRecipes(object) :
         if nocache : self.nocache = "nocache"
         else : self.nocache = ""
 
+        # Lock for the log files and the recipe cache, and
+        # attributes specific to each parallel job
+        self._recipe_lock = threading.Lock()
+        self._job_context = threading.local()
+        self._max_parallel = max_parallel
+
+        # Writing of the log files
+        self._log_writer = get_log_writer() if async_log else None
+        self._json_log = json_log
+        self._log_start_time = time.time()
+
+        # Timing spans of the stages
+        self._trace = trace
+        if trace:
+            get_tracer().enable()
+
+        # Resources used by the recipes
+        self._usage_db = UsageDB(usage_db) if usage_db is not None else None
+
         # Addressing CPU by number (cpu0=start, cpu1=end)
         self.first_cpu = first_cpu
         self.ncpu = ncpu
+        self._input_list_cpu = list_cpu
 
         if likwid is None:
             self.likwid = ""
@@ -50,16 +230,153 @@ class PipeRecipes(object) :
         else :
             self.likwid = likwid
             self._set_cpu(first_cpu, ncpu, list_cpu)
+        # taskset is used when likwid is not installed
+        self._likwid_available = self.likwid != "" \
+                                 and shutil.which(self.likwid.split()[0]) is not None
+        if self.likwid != "" and not self._likwid_available and self.verbose:
+            upipe.print_warning("WARNING: {0} not found - using taskset to "
+                                "pin the recipes".format(self.likwid.split()[0]))
+
+        # Allocation of the cpus of each recipe
+        if cpu_allocator and self.likwid != "":
+            # Only the cpus given to the pipe (first_cpu/ncpu or list_cpu)
+            self._cpu_allocator = CpuAllocator(list_cpu=self._get_all_cpus(),
+                                               lock_folder=cpu_lock_folder)
+        else:
+            self._cpu_allocator = None
         self.nifu = nifu
         self._domerge = domerge
         self.nochecksum = nochecksum
 
+        # Cache of the completed recipes
+        self._recipe_cache = recipe_cache
+        self._force_recipes = force_recipes
+        self._dict_recipe_cache = None
+        self._recipe_cache_hits = []
+        self._recipe_cache_misses = []
+
+        # Streaming of the command outputs and exit codes
+        self._check_returncode = check_returncode
+        self._status_callback = status_callback
+        self._stream_buffer_size = stream_buffer_size
+        self._list_command_status = []
+
+        # Checkpoints of the completed units and recipes
+        self._checkpoint = checkpoint
+        self._checkpoint_verify = checkpoint_verify
+        self._checkpoint_store = None
+        self._checkpoint_units = {}
+        self._checkpoint_failures = {}
+
+        # Program running the recipes
+        self.recipe_backend = recipe_backend
+        if recipe_backend == "esorex":
+            self._esorex_exec = "esorex"
+        elif recipe_backend == "simulator":
+            self._esorex_exec = get_simulator_command(**simulator_options)
+            if self.verbose:
+                upipe.print_warning("WARNING: recipes run by the esorex simulator "
+                                    "(synthetic products)")
+        else:
+            self._esorex_exec = recipe_backend
+
     @property
     def esorex(self):
-        return ("{likwid}{list_cpu} {nocache} esorex --output-dir={outputdir} {checksum}" 
-                    " --log-dir={logdir}").format(likwid=self.likwid, 
-                    list_cpu=self.list_cpu, nocache=self.nocache, outputdir=self.paths.pipe_products, 
-                    checksum=self.checksum, logdir=self.paths.esorex_log)
+        return ("{pin} {nocache} {exec_esorex} --output-dir={outputdir} {checksum}" 
+                    " --log-dir={logdir}").format(pin=self._get_pin_prefix(), 
+                    exec_esorex=self._esorex_exec,
+                    nocache=self.nocache, outputdir=self.pipe_products,
+                    checksum=self.checksum, logdir=self.esorex_log)
+
+    def _get_pin_prefix(self):
+        """Prefix of the esorex command pinning it to the cpus of the
+        current job: the allocated cpus if any, otherwise the cpu list
+        with likwid, or with taskset if likwid is not installed
+        """
+        pin_prefix = self._get_job_attr("pin_prefix", None)
+        if pin_prefix is not None:
+            return pin_prefix
+        if self.likwid == "":
+            return ""
+        if self._likwid_available:
+            return "{0}{1}".format(self.likwid, self._get_job_attr("list_cpu", self.list_cpu))
+        return get_pin_prefix(self._get_all_cpus())
+
+    @contextmanager
+    def _allocated_cpus(self):
+        """Allocate a set of free cpus to the current recipe (as many
+        as the cpus of the current job) and give them back at the end
+        """
+        if self._cpu_allocator is None or self.fakemode \
+                or self._get_job_attr("pin_prefix", None) is not None:
+            yield
+            return
+
+        cpus = self._cpu_allocator.allocate(len(self._get_all_cpus()))
+        self._job_context.pin_prefix = get_pin_prefix(cpus, self.likwid)
+        self._job_context.allocated_cpus = cpus
+        if self.verbose:
+            upipe.print_info("Allocated cpus: {0}".format(self._job_context.pin_prefix))
+        try:
+            yield
+        finally:
+            del self._job_context.pin_prefix
+            del self._job_context.allocated_cpus
+            self._cpu_allocator.release(cpus)
+
+    @property
+    def pipe_products(self):
+        """Folder where esorex writes the products. Each recipe
+        has its own temporary sub-folder.
+        """
+        return self._get_job_attr("pipe_products", self.paths.pipe_products)
+
+    @property
+    def esorex_log(self):
+        """Folder where esorex writes the log. Each recipe
+        has its own temporary sub-folder.
+        """
+        return self._get_job_attr("esorex_log", self.paths.esorex_log)
+
+    @contextmanager
+    def _job_folders(self, name_job="recipe"):
+        """Create temporary esorex output and log folders for one recipe.
+        At the end, the remaining products (those not moved by the
+        recipe) are moved to the shared products folder, the log files
+        to the esorex log folder, and the temporary folders are removed.
+        Nothing is created in fakemode.
+        """
+        if self.fakemode:
+            yield
+            return
+
+        prev_products = self._get_job_attr("pipe_products", None)
+        prev_log = self._get_job_attr("esorex_log", None)
+        job_products = tempfile.mkdtemp(prefix="{0}_".format(name_job),
+                                        dir=self.paths.pipe_products)
+        job_log = tempfile.mkdtemp(prefix="{0}_".format(name_job),
+                                   dir=self.paths.esorex_log)
+        self._job_context.pipe_products = job_products
+        self._job_context.esorex_log = job_log
+        try:
+            yield
+        finally:
+            if prev_products is None:
+                del self._job_context.pipe_products
+                del self._job_context.esorex_log
+            else:
+                self._job_context.pipe_products = prev_products
+                self._job_context.esorex_log = prev_log
+            for job_folder, folder in zip([job_products, job_log],
+                                          [self.paths.pipe_products, self.paths.esorex_log]):
+                for name in os.listdir(job_folder):
+                    os.replace(joinpath(job_folder, name), joinpath(folder, name))
+                shutil.rmtree(job_folder, ignore_errors=True)
+
+    def _get_job_attr(self, name, default):
+        """Get an attribute specific to the current parallel job
+        """
+        return getattr(self._job_context, name, default)
 
     @property
     def checksum(self):
@@ -74,18 +391,125 @@ class PipeRecipes(object) :
         else : 
             return ""
 
+    def _get_list_cpu(self, first_cpu=0, ncpu=24, list_cpu=None) :
+        """Get the cpu list in the likwid format
+        """
+        if (list_cpu is None) or (len(list_cpu) < 1):
+            return "{0}-{1}".format(first_cpu, first_cpu + ncpu - 1)
+        return ":".join(["{0}".format(cpu) for cpu in list_cpu])
+
     def _set_cpu(self, first_cpu=0, ncpu=24, list_cpu=None) :
         """Setting the cpu format for calling the esorex command
         """
-        if (list_cpu is None) | (len(list_cpu) < 1):
-            self.list_cpu = "{0}-{1}".format(first_cpu, first_cpu + ncpu - 1)
-        else :
-            self.list_cpu = "{0}".format(list_cpu[0])
-            for i in range(1, len(list_cpu)) :
-                self.list_cpu += ":{0}".format(list_cpu[i])
+        self._input_list_cpu = list_cpu
+        self.list_cpu = self._get_list_cpu(first_cpu, ncpu, list_cpu)
         if self.verbose:
             upipe.print_info("LIST_CPU: {0}".format(self.list_cpu))
 
+    def _get_all_cpus(self):
+        """Get the list of cpus available for the current job
+        (all the cpus given at initialisation if not in a job)
+        """
+        cpus = self._get_job_attr("cpus", None)
+        if cpus is not None:
+            return list(cpus)
+        if (self._input_list_cpu is None) or (len(self._input_list_cpu) < 1):
+            return list(range(self.first_cpu, self.first_cpu + self.ncpu))
+        return list(self._input_list_cpu)
+
+    def _split_cpu(self, njobs):
+        """Split the available cpus between a number of parallel jobs
+
+        Returns
+        -------
+        list of cpu lists, one per job
+        """
+        all_cpu = self._get_all_cpus()
+        # More jobs than cpus: some jobs share a cpu
+        if njobs > len(all_cpu):
+            return [[all_cpu[ijob % len(all_cpu)]] for ijob in range(njobs)]
+        # Otherwise nearly equal chunks of consecutive cpus
+        nmin, nextra = divmod(len(all_cpu), njobs)
+        list_cpu_jobs, start = [], 0
+        for ijob in range(njobs):
+            end = start + nmin + (1 if ijob < nextra else 0)
+            list_cpu_jobs.append(all_cpu[start:end])
+            start = end
+        return list_cpu_jobs
+
+    def _run_with_cpus(self, cpus, func, *args, **kwargs):
+        """Run a function in the current thread, with the esorex
+        commands pinned to a given list of cpus
+        """
+        prev_cpus = self._get_job_attr("cpus", None)
+        prev_list_cpu = self._get_job_attr("list_cpu", None)
+        self._job_context.cpus = cpus
+        self._job_context.list_cpu = self._get_list_cpu(list_cpu=cpus) \
+                                     if self.likwid != "" else ""
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if prev_cpus is None:
+                del self._job_context.cpus
+                del self._job_context.list_cpu
+            else:
+                self._job_context.cpus = prev_cpus
+                self._job_context.list_cpu = prev_list_cpu
+
+    @property
+    def _list_jobs(self):
+        """Recipes submitted in the current thread
+        """
+        if not hasattr(self._job_context, "list_jobs"):
+            self._job_context.list_jobs = []
+        return self._job_context.list_jobs
+
+    @_list_jobs.setter
+    def _list_jobs(self, list_jobs):
+        self._job_context.list_jobs = list_jobs
+
+    def _submit_recipe(self, recipe, *args, **kwargs):
+        """Run a recipe, or keep it to be run in parallel with the other
+        tpl groups by _run_submitted_recipes if max_parallel > 1
+        """
+        if self._max_parallel > 1:
+            self._list_jobs.append((recipe, args, kwargs, 
+                                    self._get_job_attr("recipe_node", None)))
+        else:
+            recipe(*args, **kwargs)
+
+    def _run_job_in_slot(self, job, slots):
+        """Run one submitted recipe using a free slot of cpus
+        """
+        recipe, args, kwargs, recipe_node = job
+        cpus = slots.get()
+        self._job_context.recipe_node = recipe_node
+        try:
+            self._run_with_cpus(cpus, recipe, *args, **kwargs)
+        finally:
+            del self._job_context.recipe_node
+            slots.put(cpus)
+
+    def _run_submitted_recipes(self):
+        """Run the submitted recipes, with at most max_parallel
+        of them at the same time
+        """
+        list_jobs, self._list_jobs = self._list_jobs, []
+        if len(list_jobs) == 0:
+            return
+
+        nparallel = min(self._max_parallel, len(list_jobs))
+        slots = queue.Queue()
+        for cpus in self._split_cpu(nparallel):
+            slots.put(cpus)
+
+        upipe.print_info("Running {0} recipes with {1} parallel jobs".format(
+                         len(list_jobs), nparallel))
+        with ThreadPoolExecutor(max_workers=nparallel) as executor:
+            # list() to get the exceptions raised in the jobs
+            list(executor.map(lambda job: self._run_job_in_slot(job, slots),
+                              list_jobs))
+
     def write_outlogfile(self, text):
         """Writing in log file
         """
@@ -96,21 +520,133 @@ class PipeRecipes(object) :
         """
         self.write_logfile(text, addext=".err")
 
-    def write_logfile(self, text, addext=""):
+    def write_logfile(self, text, addext="", level=None):
         """Writing in log file
+
+        Input
+        -----
+        text: str
+        addext: str ['']
+            Extension added to the name of the log file
+        level: str [None]
+            Level of the message for the JSON record (default is 'info')
         """
         if text == "":
             # nothing to write
             return
+        if self._json_log and addext == "":
+            self.write_logrecord(text, level=level)
+        if self._log_writer is not None:
+            self._log_writer.write(self.paths.log_filename+addext, text,
+                                   header=(self.fakemode, pipeversion))
+            return
         fulltext = "# At : {0}{1} - pymusepipe version {2}\n{3}\n".format(
                 upipe.formatted_time(),
                 " FAKEMODE" if self.fakemode else "",
                 pipeversion, text) 
-        upipe.append_file(self.paths.log_filename+addext, fulltext)
+        with self._recipe_lock:
+            upipe.append_file(self.paths.log_filename+addext, fulltext)
+
+    def write_logrecord(self, text, level=None):
+        """Write a JSON record of a message in the log file + '.jsonl',
+        with the target, pointing, recipe and tpl of the current job
+        """
+        now = time.time()
+        record = {'time': now, 'elapsed': round(now - self._log_start_time, 3),
+                  'level': level if level is not None else "info",
+                  'target': getattr(self, "targetname", None),
+                  'pointing': getattr(self, "pointing", None),
+                  'recipe': self._get_job_attr("log_recipe", None),
+                  'tpl': self._get_job_attr("log_tpl", None),
+                  'message': text}
+        if self._log_writer is not None:
+            self._log_writer.write_record(self.paths.log_filename+".jsonl", record)
+        else:
+            with self._recipe_lock:
+                upipe.append_file(self.paths.log_filename+".jsonl",
+                                  json.dumps(record, default=str) + "\n")
+
+    def export_trace(self, name_trace=None, reset=True, name_run=None):
+        """Export the timing spans as a Chrome trace (name_trace + '.json',
+        to open with chrome://tracing or https://ui.perfetto.dev) and as
+        a summary table (name_trace + '_summary.txt')
+
+        Input
+        -----
+        name_trace: str [None]
+            Default is the log file name + '_trace_' + name_run and the
+            time of the export (with a counter if that name is taken),
+            so that each export has its own files
+        reset: bool [True]
+            Remove the exported spans from the tracer, so that the next
+            export only has the spans recorded after this one
+        name_run: str [None]
+            Name of the run (e.g., 'run_bias') used in the default name
+
+        Returns
+        -------
+        summary: astropy Table
+            See trace_pipe.Tracer.summary
+        """
+        tracer = get_tracer()
+        if name_trace is None:
+            name_trace = "{0}_trace{1}_{2}".format(
+                         os.path.splitext(self.paths.log_filename)[0],
+                         "" if name_run is None else "_" + name_run,
+                         time.strftime("%Y%m%d_%H%M%S"))
+            name_base, count = name_trace, 1
+            while os.path.isfile(name_trace + ".json"):
+                name_trace = "{0}_{1:02d}".format(name_base, count)
+                count += 1
+        tracer.export_chrome_trace(name_trace + ".json")
+        summary = tracer.summary()
+        summary.write(name_trace + "_summary.txt", format="ascii.fixed_width_two_line",
+                      overwrite=True)
+        if reset:
+            tracer.reset()
+        if self.verbose:
+            upipe.print_info("Trace written in {0}.json".format(name_trace), pipe=self)
+        return summary
+
+    def flush_logfile(self):
+        """Wait until the pending messages are written in the log files
+        """
+        if self._log_writer is not None:
+            self._log_writer.flush()
+
+    @contextmanager
+    def _log_unit(self, recipe, tpl=None):
+        """Recipe and tpl given to the log records of the current job
+        """
+        prev = (self._get_job_attr("log_recipe", None), self._get_job_attr("log_tpl", None))
+        self._job_context.log_recipe, self._job_context.log_tpl = recipe, tpl
+        try:
+            yield
+        finally:
+            self._job_context.log_recipe, self._job_context.log_tpl = prev
 
-    def run_oscommand(self, command, log=True) :
+    @traced("command", name="esorex")
+    def run_oscommand(self, command, log=True, status_callback=None) :
         """Running an os.system shell command
         Fake mode will just spit out the command but not actually do it.
+
+        The output is written in the .out/.err log files while the command
+        runs, and the esorex messages are parsed to follow its status.
+
+        Input
+        -----
+        command: str
+        log: bool [True]
+            Write the command and its output in the log files
+        status_callback: function [None]
+            Called with the status while the command runs.
+            Default is the status_callback given at initialisation.
+
+        Returns
+        -------
+        status: dict or None (fakemode)
+            Including the returncode, number of warnings and errors and
+            running time of the command
         """
         if self.fakemode:
             upipe.print_warning("Running in Fakemode - "
@@ -119,104 +655,567 @@ class PipeRecipes(object) :
         if self.verbose:
             print(command)
     
-        if not self.fakemode :
-            result = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
+        if self.fakemode :
+            return None
+
+        if status_callback is None:
+            status_callback = self._status_callback
+        if log:
+            self.write_logfile(command)
+            self.write_outlogfile(command)
+            self.write_errlogfile(command)
+
+        status = {'command': command, 'recipe': None, 'level': None, 'message': "",
+                  'nwarnings': 0, 'nerrors': 0, 'ifu': None, 'returncode': None,
+                  'time': 0.}
+        status_lock = threading.Lock()
+        if self._usage_db is not None:
+            input_bytes = get_sof_bytes(command)
+            output_bytes = get_folder_bytes(self._get_job_attr("pipe_products", None))
+        start_time = time.time()
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        list_readers = [threading.Thread(target=self._stream_output,
+                                         args=(stream, addext if log else None, status,
+                                               status_lock, status_callback))
+                        for stream, addext in zip([process.stdout, process.stderr],
+                                                  [".out", ".err"])]
+        for reader in list_readers:
+            reader.start()
+        for reader in list_readers:
+            reader.join()
+        status['returncode'], rusage = wait_process(process)
+        status['time'] = time.time() - start_time
+        if self._usage_db is not None:
+            output_bytes = get_folder_bytes(self._get_job_attr("pipe_products", None)) \
+                           - output_bytes
+            self._record_usage(command, status, rusage, input_bytes, output_bytes)
+        with self._recipe_lock:
+            self._list_command_status.append({key: status[key] for key in 
+                                              ['command', 'returncode', 'nwarnings',
+                                               'nerrors', 'time']})
+
+        if status['returncode'] != 0:
+            message = "Command failed with exit code {0} [{1} error(s)]: {2}".format(
+                      status['returncode'], status['nerrors'], command)
             if log:
-                self.write_logfile(command)
-                self.write_outlogfile(command)
-                self.write_outlogfile(result.stdout.decode('utf-8'))
-                self.write_errlogfile(command)
-                self.write_errlogfile(result.stderr.decode('utf-8'))
+                self.write_errlogfile("# " + message)
+            if self._check_returncode:
+                raise subprocess.CalledProcessError(status['returncode'], command)
+            upipe.print_error(message, pipe=self)
+            self._record_checkpoint_failure(get_esorex_recipe(command, command))
+        return status
+
+    def _record_usage(self, command, status, rusage, input_bytes, output_bytes):
+        """Write the resources used by a command in the usage database
+        """
+        allocated = self._get_job_attr("allocated_cpus", None)
+        record = {'target': getattr(self, "targetname", None),
+                  'pointing': getattr(self, "pointing", None),
+                  'recipe': get_esorex_recipe(command, status['recipe']),
+                  'tpl': self._get_job_attr("log_tpl", None),
+                  'ncpu': len(allocated if allocated is not None else self._get_all_cpus()),
+                  'nifu': self.nifu, 'wall': status['time'],
+                  'input_bytes': input_bytes, 'output_bytes': output_bytes,
+                  'returncode': status['returncode'], 'command': command}
+        if rusage is not None:
+            # ru_maxrss is in kB on Linux
+            record.update({'utime': rusage.ru_utime, 'stime': rusage.ru_stime,
+                           'maxrss': rusage.ru_maxrss / 1024.})
+        try:
+            self._usage_db.add_record(record)
+        except Exception as error:
+            upipe.print_warning("Cannot write the usage of the recipe in {0}: "
+                                "{1}".format(self._usage_db.filename, error), pipe=self)
+
+    def _stream_output(self, stream, addext, status, status_lock, status_callback=None):
+        """Read the output of a command line by line, write it in the
+        log file (addext) by chunks of at most stream_buffer_size bytes
+        and update the status with the esorex messages
+        """
+        buffer, size, last_flush = [], 0, time.time()
+        for rawline in iter(lambda: stream.readline(self._stream_buffer_size), b''):
+            line = rawline.decode('utf-8', errors='replace')
+            if addext is not None:
+                buffer.append(line)
+                size += len(rawline)
+                if size >= self._stream_buffer_size \
+                        or time.time() - last_flush > stream_flush_time:
+                    self._append_logfile("".join(buffer), addext)
+                    buffer, size, last_flush = [], 0, time.time()
+            self._update_status(line, status, status_lock, status_callback)
+        if len(buffer) > 0:
+            self._append_logfile("".join(buffer), addext)
+        stream.close()
+
+    def _update_status(self, line, status, status_lock, status_callback=None):
+        """Update the status of a command with one line of its output.
+        The callback is called for warnings, errors and a change of IFU.
+        """
+        parsed = parse_esorex_line(line)
+        if parsed is None:
+            return
+        level, recipe, message = parsed
+        with status_lock:
+            event = level in ['WARNING', 'ERROR']
+            if level == 'WARNING':
+                status['nwarnings'] += 1
+            elif level == 'ERROR':
+                status['nerrors'] += 1
+            match = esorex_ifu_pattern.search(message)
+            if match is not None and int(match.group(1)) != status['ifu']:
+                status['ifu'] = int(match.group(1))
+                event = True
+            if recipe is not None:
+                status['recipe'] = recipe
+            status['level'], status['message'] = level, message
+            status_copy = dict(status)
+        if event and status_callback is not None:
+            status_callback(status_copy)
+
+    def _append_logfile(self, text, addext=""):
+        """Append text in the log file, without the time header
+        """
+        if self._log_writer is not None:
+            self._log_writer.write(self.paths.log_filename+addext, text)
+            return
+        with self._recipe_lock:
+            upipe.append_file(self.paths.log_filename+addext, text)
+
+    def transfer_products(self, list_transfers, mode="move", name_recipe=""):
+        """Move or copy a set of products within the python process
+        (no shell command), logging all of them at once.
+        Fake mode will just log the transfers but not do them.
+
+        Input
+        -----
+        list_transfers: list of (str, str)
+            Input and output names of the products
+        mode: str ['move']
+            'move' (os.replace, or a copy across filesystems) or 'copy'
+            (reflink when the filesystem allows it, or a plain copy)
+        name_recipe: str
+            Name of the recipe for the log
+
+        Returns
+        -------
+        list_failed: list of (str, str, str)
+            Input and output names and error of the failed transfers
+        """
+        if len(list_transfers) == 0:
+            return []
+        command = "mv" if mode == "move" else "cp"
+        text = "\n".join(["{0} {1} {2}".format(command, namein, nameout)
+                          for namein, nameout in list_transfers])
+        if self.verbose:
+            print(text)
+        self.write_logfile(text)
+        if self.fakemode:
+            return []
+
+        list_failed = []
+        for namein, nameout in list_transfers:
+            try:
+                if mode == "move":
+                    self._move_file(namein, nameout)
+                else:
+                    self._copy_file(namein, nameout)
+            except OSError as error:
+                list_failed.append((namein, nameout, str(error)))
+
+        name_recipe = " [{0}]".format(name_recipe) if name_recipe else ""
+        with self._recipe_lock:
+            self._list_command_status.append({'command': "{0} {1} product(s){2}".format(
+                                              command, len(list_transfers), name_recipe),
+                                              'returncode': int(len(list_failed) > 0),
+                                              'nwarnings': 0, 'nerrors': len(list_failed),
+                                              'time': 0.})
+        if len(list_failed) > 0:
+            message = "Failed to {0} {1} product(s){2}:\n{3}".format(
+                      "move" if mode == "move" else "copy", len(list_failed), name_recipe,
+                      "\n".join(["{0} -> {1} [{2}]".format(*failed) for failed in list_failed]))
+            self.write_errlogfile("# " + message)
+            if self._check_returncode:
+                raise OSError(message)
+            upipe.print_error(message, pipe=self)
+        return list_failed
+
+    def _move_file(self, namein, nameout):
+        """Move a file: renaming it, or copying it across filesystems
+        """
+        try:
+            os.replace(namein, nameout)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            shutil.move(namein, nameout)
+
+    def _copy_file(self, namein, nameout):
+        """Copy a file, sharing the data blocks (reflink) when the
+        filesystem allows it. With nocache, the copied data are
+        dropped from the page cache.
+        """
+        try:
+            import fcntl
+            with open(namein, "rb") as fin, open(nameout, "wb") as fout:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        shutil.copyfile(namein, nameout)
+        if self.nocache and hasattr(os, "posix_fadvise"):
+            for name in [namein, nameout]:
+                fd = os.open(name, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(fd)
+
+    def get_failed_commands(self):
+        """Get the commands which ended with a non-zero exit code
+
+        Returns
+        -------
+        list_status: list of dict
+        """
+        return [status for status in self._list_command_status 
+                if status['returncode'] != 0]
+
+    def _get_recipe_cache_name(self):
+        """Get the name of the file recording the completed recipes
+        """
+        return joinpath(self.paths.esorex_log, name_recipe_cache)
+
+    def _read_recipe_cache(self):
+        """Reading the recipe cache. Returns an empty dictionary
+        if the file does not exist or cannot be read.
+        """
+        name_cache = self._get_recipe_cache_name()
+        if not os.path.isfile(name_cache):
+            return {}
+        try:
+            with open(name_cache, "r") as fcache:
+                return json.load(fcache)
+        except (OSError, ValueError):
+            upipe.print_warning("Recipe cache {0} cannot be read - "
+                                "ignoring it".format(name_cache))
+            return {}
+
+    def _write_recipe_cache(self):
+        """Writing the recipe cache
+        """
+        name_cache = self._get_recipe_cache_name()
+        # Write first in a temporary file to never leave a broken cache
+        temp_name = name_cache + ".tmp"
+        with open(temp_name, "w") as fcache:
+            json.dump(self._dict_recipe_cache, fcache, indent=1)
+        os.replace(temp_name, name_cache)
+
+    def _get_recipe_key(self, command, sof):
+        """Get the hash of a recipe, from the command and the content
+        of the SOF file, including the size and modification time
+        of each input file
+        """
+        # The cpu pinning should not change the key
+        key = hashlib.sha1(command.replace(self.esorex, "esorex").encode('utf-8'))
+        if os.path.isfile(sof):
+            with open(sof, "r") as fsof:
+                lines = fsof.readlines()
+        else:
+            lines = []
+        for line in lines:
+            key.update(line.encode('utf-8'))
+            items = line.split()
+            if len(items) > 0 and os.path.isfile(items[0]):
+                filestat = os.stat(items[0])
+                key.update("{0} {1}".format(filestat.st_size,
+                                            filestat.st_mtime_ns).encode('utf-8'))
+            else:
+                key.update(b"missing")
+        return key.hexdigest()
+
+    def _get_checkpoint_store(self):
+        """Get the store of the checkpoint markers
+        """
+        if self._checkpoint_store is None:
+            self._checkpoint_store = CheckpointStore(getattr(self.paths, "checkpoints",
+                                                             self.paths.esorex_log),
+                                                     verify=self._checkpoint_verify)
+        return self._checkpoint_store
+
+    def _record_checkpoint_unit(self, name_recipe):
+        """Record a completed unit for the run_* recipe being run
+        """
+        with self._recipe_lock:
+            self._checkpoint_units.setdefault(self._get_job_attr("recipe_node", None), 
+                                              []).append(name_recipe)
+
+    def _record_checkpoint_failure(self, name_recipe):
+        """Record a failed unit for the run_* recipe being run
+        (its recipe marker is then not written)
+        """
+        with self._recipe_lock:
+            self._checkpoint_failures.setdefault(self._get_job_attr("recipe_node", None),
+                                                 []).append(name_recipe)
+
+    def _check_checkpoint(self, command, name_recipe="", key=None):
+        """Check if a unit has a valid checkpoint marker, with the
+        same command and inputs (key, see _get_recipe_key)
+        """
+        if not self._checkpoint or self.fakemode or self._force_recipes:
+            return False
+        if not self._get_checkpoint_store().is_unit_complete(name_recipe,
+                    command.replace(self.esorex, "esorex"), key):
+            return False
+        self._record_checkpoint_unit(name_recipe)
+        upipe.print_info("Recipe {0} already completed (checkpoint) "
+                         "- skipping it".format(name_recipe))
+        self.write_logfile("# Recipe {0} completed (checkpoint) - skipped\n"
+                           "# {1}".format(name_recipe, command))
+        return True
+
+    def _write_checkpoint(self, command, list_products, name_recipe="", key=None):
+        """Write the checkpoint marker of a completed unit, with the key
+        of its inputs (see _get_recipe_key) and its SOF file.
+        Nothing is written if a product is missing
+        """
+        if not self._checkpoint or self.fakemode:
+            return
+        missing = [name for name in list_products if not os.path.isfile(name)]
+        if len(missing) > 0:
+            upipe.print_warning("Recipe {0}: missing product(s) {1} - no "
+                                "checkpoint written".format(name_recipe, missing))
+            self._record_checkpoint_failure(name_recipe)
+            return
+        # The SOF is the last argument of the command
+        list_sofs = [arg for arg in command.split() if arg.endswith(".sof")]
+        sof = os.path.abspath(list_sofs[-1]) if len(list_sofs) > 0 else None
+        self._get_checkpoint_store().write_unit(name_recipe, 
+                                                command.replace(self.esorex, "esorex"),
+                                                list_products, 
+                                                pointing=getattr(self, "pointing", None),
+                                                key=key, sof=sof)
+        self._record_checkpoint_unit(name_recipe)
+
+    def _check_recipe_cache(self, command, sof, name_recipe=""):
+        """Check if a recipe was already completed with the same inputs
+        (checkpoint marker or recipe cache)
+
+        Returns
+        -------
+        key: str or None
+            Key of the recipe (None in fakemode)
+        hit: bool
+            True if the recipe can be skipped
+        """
+        if self.fakemode:
+            return None, False
+        key = self._get_recipe_key(command, sof)
+        if self._check_checkpoint(command, name_recipe, key):
+            return key, True
+        if not self._recipe_cache:
+            return key, False
+        with self._recipe_lock:
+            if self._dict_recipe_cache is None:
+                self._dict_recipe_cache = self._read_recipe_cache()
+            entry = self._dict_recipe_cache.get(key, None)
+        hit = (not self._force_recipes) and (entry is not None) \
+              and all(os.path.isfile(name) for name in entry['products'])
+        if hit:
+            self._recipe_cache_hits.append(name_recipe)
+            upipe.print_info("Recipe {0} already done with the same inputs "
+                             "[{1}] - skipping it".format(name_recipe, sof))
+            self.write_logfile("# Recipe {0} found in cache - skipped\n"
+                               "# {1}".format(name_recipe, command))
+            self._write_checkpoint(command, entry['products'], name_recipe, key)
+        else:
+            self._recipe_cache_misses.append(name_recipe)
+        return key, hit
+
+    def _store_recipe_cache(self, key, command, list_products, name_recipe=""):
+        """Record a completed recipe with the list of its products
+        (checkpoint marker and recipe cache).
+        Nothing is recorded if a product is missing
+        """
+        self._write_checkpoint(command, list_products, name_recipe, key)
+        if key is None or not self._recipe_cache:
+            return
+        missing = [name for name in list_products if not os.path.isfile(name)]
+        if len(missing) > 0:
+            upipe.print_warning("Recipe {0}: missing product(s) {1} - not "
+                                "recorded in the cache".format(name_recipe, missing))
+            return
+        with self._recipe_lock:
+            self._dict_recipe_cache[key] = {'recipe': name_recipe, 'command': command,
+                                            'products': list_products,
+                                            'time': upipe.formatted_time()}
+            self._write_recipe_cache()
+
+    def get_recipe_cache_report(self):
+        """Get the lists of recipes found (hits) or not found (misses)
+        in the recipe cache
+        """
+        return {'hits': list(self._recipe_cache_hits),
+                'misses': list(self._recipe_cache_misses)}
+
+    def print_recipe_cache_report(self):
+        """Print the number of recipes found or not in the recipe cache
+        """
+        upipe.print_info("Recipe cache: {0} hit(s), {1} miss(es)".format(
+                         len(self._recipe_cache_hits), len(self._recipe_cache_misses)))
+        for name_recipe in self._recipe_cache_hits:
+            upipe.print_info("    hit: {0}".format(name_recipe))
 
     def joinprod(self, name):
-        return joinpath(self.paths.pipe_products, name)
+        return joinpath(self.pipe_products, name)
 
+    @use_job_folders
     def recipe_bias(self, sof, dir_bias, name_bias, tpl):
         """Running the esorex muse_bias recipe
         """
-        # Runing the recipe
-        self.run_oscommand(("{esorex} --log-file=bias_{tpl}.log muse_bias " 
+        command = ("{esorex} --log-file=bias_{tpl}.log muse_bias " 
                 "--nifu={nifu} {merge} {sof}").format(esorex=self.esorex, 
-                    nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl))
+                    nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl)
+        nameout = "{0}_{1}.fits".format(joinpath(dir_bias, name_bias), tpl)
+        key, hit = self._check_recipe_cache(command, sof, "bias_{0}".format(tpl))
+        if hit:
+            return
+        # Runing the recipe
+        self.run_oscommand(command)
         # Moving the MASTER BIAS
-        self.run_oscommand("{nocache} mv {namein}.fits {nameout}_{tpl}.fits".format(nocache=self.nocache, 
-            namein=self.joinprod(name_bias), nameout=joinpath(dir_bias, name_bias), tpl=tpl))
+        self.transfer_products([(self.joinprod(name_bias) + ".fits", nameout)],
+                               name_recipe="bias_{0}".format(tpl))
+        self._store_recipe_cache(key, command, [nameout], "bias_{0}".format(tpl))
 
+    @use_job_folders
     def recipe_flat(self, sof, dir_flat, name_flat, dir_trace, name_trace, tpl):
         """Running the esorex muse_flat recipe
         """
-        self.run_oscommand(("{esorex} --log-file=flat_{tpl}.log muse_flat " 
+        command = ("{esorex} --log-file=flat_{tpl}.log muse_flat " 
                 "--nifu={nifu} {merge} {sof}").format(esorex=self.esorex, 
-                    nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl))
+                    nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl)
+        nameout_flat = "{0}_{1}.fits".format(joinpath(dir_flat, name_flat), tpl)
+        nameout_trace = "{0}_{1}.fits".format(joinpath(dir_trace, name_trace), tpl)
+        key, hit = self._check_recipe_cache(command, sof, "flat_{0}".format(tpl))
+        if hit:
+            return
+        self.run_oscommand(command)
         # Moving the MASTER FLAT and TRACE_TABLE
-        self.run_oscommand("{nocache} mv {namein}.fits {nameout}_{tpl}.fits".format(nocache=self.nocache, 
-            namein=self.joinprod(name_flat), nameout=joinpath(dir_flat, name_flat), tpl=tpl))
-        self.run_oscommand("{nocache} mv {namein}.fits {nameout}_{tpl}.fits".format(nocache=self.nocache, 
-            namein=self.joinprod(name_trace), nameout=joinpath(dir_trace, name_trace), tpl=tpl))
+        self.transfer_products([(self.joinprod(name_flat) + ".fits", nameout_flat),
+                                (self.joinprod(name_trace) + ".fits", nameout_trace)],
+                               name_recipe="flat_{0}".format(tpl))
+        self._store_recipe_cache(key, command, [nameout_flat, nameout_trace],
+                                 "flat_{0}".format(tpl))
 
+    @use_job_folders
     def recipe_wave(self, sof, dir_wave, name_wave, tpl):
         """Running the esorex muse_wavecal recipe
         """
-        self.run_oscommand(("{esorex} --log-file=wave_{tpl}.log muse_wavecal --nifu={nifu} "
+        command = ("{esorex} --log-file=wave_{tpl}.log muse_wavecal --nifu={nifu} "
                 "--resample --residuals {merge} {sof}").format(esorex=self.esorex, 
-                    nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl))
+                    nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl)
+        nameout = "{0}_{1}.fits".format(joinpath(dir_wave, name_wave), tpl)
+        key, hit = self._check_recipe_cache(command, sof, "wave_{0}".format(tpl))
+        if hit:
+            return
+        self.run_oscommand(command)
         # Moving the MASTER WAVE
-        self.run_oscommand("{nocache} mv {namein}.fits {nameout}_{tpl}.fits".format(nocache=self.nocache, 
-            namein=self.joinprod(name_wave), nameout=joinpath(dir_wave, name_wave), tpl=tpl))
+        self.transfer_products([(self.joinprod(name_wave) + ".fits", nameout)],
+                               name_recipe="wave_{0}".format(tpl))
+        self._store_recipe_cache(key, command, [nameout], "wave_{0}".format(tpl))
     
+    @use_job_folders
     def recipe_lsf(self, sof, dir_lsf, name_lsf, tpl):
         """Running the esorex muse_lsf recipe
         """
-        self.run_oscommand("{esorex} --log-file=wave_{tpl}.log muse_lsf --nifu={nifu} {merge} {sof}".format(esorex=self.esorex,
-            nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl))
+        command = "{esorex} --log-file=wave_{tpl}.log muse_lsf --nifu={nifu} {merge} {sof}".format(esorex=self.esorex,
+            nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl)
+        nameout = "{0}_{1}.fits".format(joinpath(dir_lsf, name_lsf), tpl)
+        key, hit = self._check_recipe_cache(command, sof, "lsf_{0}".format(tpl))
+        if hit:
+            return
+        self.run_oscommand(command)
         # Moving the MASTER LST PROFILE
-        self.run_oscommand("{nocache} mv {namein}.fits {nameout}_{tpl}.fits".format(nocache=self.nocache, 
-            namein=self.joinprod(name_lsf), nameout=joinpath(dir_lsf, name_lsf), tpl=tpl))
+        self.transfer_products([(self.joinprod(name_lsf) + ".fits", nameout)],
+                               name_recipe="lsf_{0}".format(tpl))
+        self._store_recipe_cache(key, command, [nameout], "lsf_{0}".format(tpl))
     
+    @use_job_folders
     def recipe_twilight(self, sof, dir_twilight, name_twilight, tpl):
         """Running the esorex muse_twilight recipe
         """
-        self.run_oscommand("{esorex} --log-file=twilight_{tpl}.log muse_twilight {sof}".format(esorex=self.esorex, 
-            sof=sof, tpl=tpl))
+        command = "{esorex} --log-file=twilight_{tpl}.log muse_twilight {sof}".format(esorex=self.esorex, 
+            sof=sof, tpl=tpl)
+        list_nameout = ["{0}_{1}.fits".format(joinpath(dir_twilight, name_prod), tpl)
+                        for name_prod in name_twilight]
+        key, hit = self._check_recipe_cache(command, sof, "twilight_{0}".format(tpl))
+        if hit:
+            return
+        self.run_oscommand(command)
         # Moving the TWILIGHT CUBE
-        for name_prod in name_twilight:
-            self.run_oscommand("{nocache} mv {namein}.fits {nameout}_{tpl}.fits".format(nocache=self.nocache, 
-                namein=self.joinprod(name_prod), nameout=joinpath(dir_twilight, name_prod), tpl=tpl))
+        self.transfer_products([(self.joinprod(name_prod) + ".fits", nameout)
+                                for name_prod, nameout in zip(name_twilight, list_nameout)],
+                               name_recipe="twilight_{0}".format(tpl))
+        self._store_recipe_cache(key, command, list_nameout, "twilight_{0}".format(tpl))
 
+    @use_job_folders
     def recipe_std(self, sof, dir_std, name_std, tpl):
         """Running the esorex muse_stc recipe
         """
         [name_cube, name_flux, name_response, name_telluric] = name_std
-        self.run_oscommand("{esorex} --log-file=std_{tpl}.log muse_standard --filter=white {sof}".format(esorex=self.esorex,
-                sof=sof, tpl=tpl))
+        command = "{esorex} --log-file=std_{tpl}.log muse_standard --filter=white {sof}".format(esorex=self.esorex,
+                sof=sof, tpl=tpl)
+        list_nameout = ["{0}_{1}.fits".format(joinpath(dir_std, name_prod), tpl)
+                        for name_prod in name_std]
+        key, hit = self._check_recipe_cache(command, sof, "std_{0}".format(tpl))
+        if hit:
+            return
+        self.run_oscommand(command)
 
-        for name_prod in name_std:
-            self.run_oscommand('{nocache} mv {name_prodin}_0001.fits {name_prodout}_{tpl}.fits'.format(nocache=self.nocache,
-                name_prodin=self.joinprod(name_prod), name_prodout=joinpath(dir_std, name_prod), tpl=tpl))
+        self.transfer_products([(self.joinprod(name_prod) + "_0001.fits", nameout)
+                                for name_prod, nameout in zip(name_std, list_nameout)],
+                               name_recipe="std_{0}".format(tpl))
+        self._store_recipe_cache(key, command, list_nameout, "std_{0}".format(tpl))
 
+    @use_job_folders
     def recipe_sky(self, sof, dir_sky, name_sky, tpl, iexpo=1, fraction=0.8):
         """Running the esorex muse_stc recipe
         """
-        self.run_oscommand("{esorex} --log-file=sky_{tpl}.log muse_create_sky --fraction={fraction} {sof}".format(esorex=self.esorex,
-                sof=sof, fraction=fraction, tpl=tpl))
+        command = "{esorex} --log-file=sky_{tpl}.log muse_create_sky --fraction={fraction} {sof}".format(esorex=self.esorex,
+                sof=sof, fraction=fraction, tpl=tpl)
+        list_nameout = ["{0}_{1}_{2:04d}.fits".format(joinpath(dir_sky, name_prod), tpl, iexpo)
+                        for name_prod in name_sky]
+        name_recipe = "sky_{0}_{1:04d}".format(tpl, iexpo)
+        key, hit = self._check_recipe_cache(command, sof, name_recipe)
+        if hit:
+            return
+        self.run_oscommand(command)
 
-        for name_prod in name_sky:
-            self.run_oscommand('{nocache} mv {name_prodin}.fits {name_prodout}_{tpl}_{iexpo:04d}.fits'.format(nocache=self.nocache,
-                name_prodin=self.joinprod(name_prod), name_prodout=joinpath(dir_sky, name_prod), iexpo=iexpo, tpl=tpl))
+        self.transfer_products([(self.joinprod(name_prod) + ".fits", nameout)
+                                for name_prod, nameout in zip(name_sky, list_nameout)],
+                               name_recipe=name_recipe)
+        self._store_recipe_cache(key, command, list_nameout, name_recipe)
 
+    @use_job_folders
     def recipe_scibasic(self, sof, tpl, expotype, dir_products=None, name_products=[], suffix=""):
         """Running the esorex muse_scibasic recipe
         """
-        self.run_oscommand("{esorex} --log-file=scibasic_{expotype}_{tpl}.log muse_scibasic --nifu={nifu} "
+        command = ("{esorex} --log-file=scibasic_{expotype}_{tpl}.log muse_scibasic --nifu={nifu} "
                 "--saveimage=FALSE {merge} {sof}".format(esorex=self.esorex, 
                     nifu=self.nifu, merge=self.merge, sof=sof, tpl=tpl, expotype=expotype))
-
         suffix_out = "{0}_{1}".format(suffix, tpl)
-        for name_prod in name_products :
-            self.run_oscommand('{nocache} mv {prod} {newprod}'.format(nocache=self.nocache,
-                prod=self.joinprod("{0}_{1}".format(suffix, name_prod)), newprod=joinpath(dir_products, 
-                    "{0}_{1}".format(suffix_out, name_prod))))
+        list_nameout = [joinpath(dir_products, "{0}_{1}".format(suffix_out, name_prod))
+                        for name_prod in name_products]
+        name_recipe = "scibasic_{0}_{1}".format(expotype, tpl)
+        key, hit = self._check_recipe_cache(command, sof, name_recipe)
+        if hit:
+            return
+        self.run_oscommand(command)
+
+        self.transfer_products([(self.joinprod("{0}_{1}".format(suffix, name_prod)), nameout)
+                                for name_prod, nameout in zip(name_products, list_nameout)],
+                               name_recipe=name_recipe)
+        self._store_recipe_cache(key, command, list_nameout, name_recipe)
    
     # Name of the output combined files are described by several key arguments
     # Summary 
@@ -228,6 +1227,7 @@ class PipeRecipes(object) :
     #       suff_pre = filter name if IMAGE_FOV, otherwise ""
     #       tpl = tpls of the exposure
     #       suff_post = number of expo if relevant (2 integer)
+    @use_job_folders
     def recipe_scipost(self, sof, tpl, expotype, dir_products="", name_products=[""],
             suffix_products=[""], suffix_prefinalnames=[""], suffix_postfinalnames=[""], 
             list_expo=[], save='cube,skymodel', filter_list='white', 
@@ -238,7 +1238,7 @@ class PipeRecipes(object) :
         """
         filter_for_alignment = kwargs.pop("filter_for_alignment", self.filter_for_alignment)
         prefix_all = kwargs.pop("prefix_all", "")
-        self.run_oscommand("{esorex} --log-file=scipost_{expotype}_{tpl}.log muse_scipost  "
+        command = ("{esorex} --log-file=scipost_{expotype}_{tpl}.log muse_scipost  "
                 "--astrometry={astro} --save={save} "
                 "--pixfrac={pixfrac}  --filter={filt} --skymethod={skym} "
                 "--darcheck={darcheck} --skymodel_frac={model:02f} "
@@ -249,6 +1249,26 @@ class PipeRecipes(object) :
                     lmax=lambdamax, autocalib=autocalib, sof=sof, expotype=expotype, 
                     tpl=tpl, rvcorr=rvcorr))
 
+        # Names of the output products
+        list_nameout = []
+        for name_prod, suff_pre, suff_post in zip(name_products, suffix_prefinalnames,
+                                                  suffix_postfinalnames):
+            list_nameout.append("{name_imaout}{suffix}{suff_pre}_{tpl}{suff_post}.fits".format(
+                                name_imaout=joinpath(dir_products, prefix_all+name_prod),
+                                suff_pre=suff_pre, suff_post=suff_post, 
+                                tpl=tpl, suffix=suffix))
+        # One unit per exposure when scipost is run exposure by exposure
+        set_expo = set(list_expo)
+        if len(set_expo) == 1:
+            name_recipe = "scipost_{0}_{1}_{2:04d}{3}".format(expotype, tpl,
+                                                              int(set_expo.pop()), suffix)
+        else:
+            name_recipe = "scipost_{0}_{1}{2}".format(expotype, tpl, suffix)
+        key, hit = self._check_recipe_cache(command, sof, name_recipe)
+        if hit:
+            return
+        self.run_oscommand(command)
+
         # Creating the images for the alignment, outside of scipost
         # The filter can be a private one
 
@@ -257,19 +1277,17 @@ class PipeRecipes(object) :
             for prod in name_products:
                 upipe.print_debug(prod)
 
-        for name_prod, suff_prod, suff_pre, suff_post, iexpo in zip(name_products, suffix_products, 
-                suffix_prefinalnames, suffix_postfinalnames, list_expo) :
-
-            # In any case move the file from Pipe_products to the right folder
-            fitsname_out = "{name_imaout}{suffix}{suff_pre}_{tpl}{suff_post}.fits".format(
-                            name_imaout=joinpath(dir_products, prefix_all+name_prod),
-                            suff_pre=suff_pre, suff_post=suff_post, 
-                            tpl=tpl, suffix=suffix)
+        list_zip = list(zip(name_products, suffix_products, suffix_postfinalnames,
+                            list_expo, list_nameout))
+        # In any case move the files from Pipe_products to the right folder
+        self.transfer_products([(self.joinprod(name_prod+suff_prod) + ".fits", fitsname_out)
+                                for name_prod, suff_prod, _, _, fitsname_out in list_zip],
+                               name_recipe=name_recipe)
 
-            self.run_oscommand("{nocache} mv {name_imain}.fits {fitsname}".format(
-                               nocache=self.nocache, 
-                               name_imain=self.joinprod(name_prod+suff_prod), 
-                               fitsname=fitsname_out))
+        list_products = []
+        list_copies = []
+        for name_prod, suff_prod, suff_post, iexpo, fitsname_out in list_zip :
+            list_products.append(fitsname_out)
             # Adding pointing and expo numbers as keywords
             if filter_for_alignment in fitsname_out:
                 upipe.add_key_pointing_expo(fitsname_out, iexpo, self.pointing)
@@ -284,28 +1302,43 @@ class PipeRecipes(object) :
                                                            prefix_all+"IMAGE_FOV"),
                                       myfilter=filter_for_alignment, suff_post=suff_post, 
                                       tpl=tpl, suffix=suffix, pointing=self.pointing))
-                self.run_oscommand("{nocache} cp {fitsname} {nameima_out}".format(
-                                   nocache=self.nocache, fitsname=fitsname_out,
-                                   nameima_out=name_imageout_align))
-                # Adding pointing and expo numbers as keywords
-                upipe.add_key_pointing_expo(name_imageout_align, iexpo, self.pointing)
+                list_copies.append((fitsname_out, name_imageout_align, iexpo))
 
+        self.transfer_products([(fitsname, name_imageout_align) 
+                                for fitsname, name_imageout_align, iexpo in list_copies],
+                               mode="copy", name_recipe=name_recipe)
+        for fitsname, name_imageout_align, iexpo in list_copies:
+            # Adding pointing and expo numbers as keywords
+            upipe.add_key_pointing_expo(name_imageout_align, iexpo, self.pointing)
+            list_products.append(name_imageout_align)
+
+        self._store_recipe_cache(key, command, list_products, name_recipe)
+
+    @use_job_folders
     def recipe_align(self, sof, dir_products, namein_products, nameout_products, tpl, group,
             threshold=10.0, srcmin=3, srcmax=80, fwhm=5.0):
         """Running the muse_exp_align recipe
         """
-        self.run_oscommand("{esorex} --log-file=exp_align_{group}_{tpl}.log "
+        command = ("{esorex} --log-file=exp_align_{group}_{tpl}.log "
                 "muse_exp_align --srcmin={srcmin} --srcmax={srcmax} "
                 "--threshold={threshold} --fwhm={fwhm} {sof}".format(
                     esorex=self.esorex, srcmin=srcmin, srcmax=srcmax, 
                     threshold=threshold, fwhm=fwhm, sof=sof, tpl=tpl,
                     group=group))
+        list_nameout = ["{0}.fits".format(joinpath(dir_products, nameout_prod))
+                        for nameout_prod in nameout_products]
+        name_recipe = "exp_align_{0}_{1}".format(group, tpl)
+        key, hit = self._check_recipe_cache(command, sof, name_recipe)
+        if hit:
+            return
+        self.run_oscommand(command)
     
-        for namein_prod, nameout_prod in zip(namein_products, nameout_products) :
-            self.run_oscommand('{nocache} mv {name_imain}.fits {name_imaout}.fits'.format(
-                nocache=self.nocache, name_imain=self.joinprod(namein_prod), 
-                name_imaout=joinpath(dir_products, nameout_prod)))
+        self.transfer_products([(self.joinprod(namein_prod) + ".fits", nameout)
+                                for namein_prod, nameout in zip(namein_products, list_nameout)],
+                               name_recipe=name_recipe)
+        self._store_recipe_cache(key, command, list_nameout, name_recipe)
 
+    @use_job_folders
     def recipe_combine(self, sof, dir_products, name_products, tpl, expotype,
             suffix_products=[""], suffix_prefinalnames=[""], 
             save='cube', pixfrac=0.6, suffix="", 
@@ -313,24 +1346,31 @@ class PipeRecipes(object) :
             lambdamin=4000., lambdamax=10000.):
         """Running the muse_exp_combine recipe for one single pointing
         """
-        self.run_oscommand("{esorex}  --log-file=exp_combine_cube_{expotype}_{tpl}.log "
+        command = ("{esorex}  --log-file=exp_combine_cube_{expotype}_{tpl}.log "
                " muse_exp_combine --save={save} --pixfrac={pixfrac:0.2f} "
                "--format={form} --filter={filt} "
                "--lambdamin={lmin} --lambdamax={lmax} {sof}".format(
                    esorex=self.esorex, save=save, 
                    pixfrac=pixfrac, form=format_out, filt=filter_list, sof=sof, 
                    tpl=tpl, expotype=expotype, lmin=lambdamin, lmax=lambdamax))
+        list_nameout = ['{name_imaout}{suffix}{suff_pre}_{pointing}_{tpl}.fits'.format(
+                        name_imaout=joinpath(dir_products, name_prod),
+                        suff_pre=suff_pre, suffix=suffix, 
+                        tpl=tpl, pointing="P{0:02d}".format(self.pointing))
+                        for name_prod, suff_pre in zip(name_products, suffix_prefinalnames)]
+        name_recipe = "exp_combine_cube_{0}_{1}".format(expotype, tpl)
+        key, hit = self._check_recipe_cache(command, sof, name_recipe)
+        if hit:
+            return
+        self.run_oscommand(command)
 
-        for name_prod, suff_prod, suff_pre in zip(name_products, suffix_products, 
-                suffix_prefinalnames):
-
-            self.run_oscommand("{nocache} mv {name_imain}.fits "
-                '{name_imaout}{suffix}{suff_pre}_{pointing}_{tpl}.fits'.format(nocache=self.nocache,
-                name_imain=self.joinprod(name_prod+suff_prod), 
-                name_imaout=joinpath(dir_products, name_prod),
-                suff_pre=suff_pre, suffix=suffix, 
-                tpl=tpl, pointing="P{0:02d}".format(self.pointing)))
+        self.transfer_products([(self.joinprod(name_prod+suff_prod) + ".fits", nameout)
+                                for name_prod, suff_prod, nameout in zip(name_products,
+                                    suffix_products, list_nameout)],
+                               name_recipe=name_recipe)
+        self._store_recipe_cache(key, command, list_nameout, name_recipe)
 
+    @use_job_folders
     def recipe_combine_pointings(self, sof, dir_products, name_products,
             suffix_products=[""], suffix_prefinalnames=[""], 
             prefix_products=[""], save='cube', pixfrac=0.6, suffix="", 
@@ -338,7 +1378,7 @@ class PipeRecipes(object) :
             lambdamin=4000., lambdamax=10000.):
         """Running the muse_exp_combine recipe for pointings
         """
-        self.run_oscommand("{esorex}  --log-file=exp_combine_pointings.log "
+        command = ("{esorex}  --log-file=exp_combine_pointings.log "
                " muse_exp_combine --save={save} --pixfrac={pixfrac:0.2f} "
                "--format={form} --filter={filt} "
                "--lambdamin={lmin} --lambdamax={lmax} "
@@ -346,18 +1386,24 @@ class PipeRecipes(object) :
                    save=save, pixfrac=pixfrac, form=format_out, 
                    filt=filter_list, sof=sof, 
                    lmin=lambdamin, lmax=lambdamax))
-
-        for name_prod, suff_prod, suff_pre, pre_prod in zip(name_products, suffix_products, 
-                suffix_prefinalnames, prefix_products):
-
-            name_imaout = "{name_imaout}{suffix}{suff_pre}.fits".format(
-                         name_imaout=joinpath(dir_products, pre_prod+name_prod),
-                         suff_pre=suff_pre, suffix=suffix)
-            self.run_oscommand("{nocache} mv {name_imain}.fits "
-                              "{name_imaout}".format(
-                                  nocache=self.nocache, 
-                                  name_imain=self.joinprod(name_prod+suff_prod), 
-                                  name_imaout=name_imaout))
+        list_nameout = ["{name_imaout}{suffix}{suff_pre}.fits".format(
+                        name_imaout=joinpath(dir_products, pre_prod+name_prod),
+                        suff_pre=suff_pre, suffix=suffix)
+                        for name_prod, suff_pre, pre_prod in zip(name_products,
+                            suffix_prefinalnames, prefix_products)]
+        for name_imaout in list_nameout:
             if "DATACUBE" in name_imaout:
                 self._combined_cube_name = name_imaout
 
+        name_recipe = "exp_combine_pointings{0}".format(suffix)
+        key, hit = self._check_recipe_cache(command, sof, name_recipe)
+        if hit:
+            return
+        self.run_oscommand(command)
+
+        self.transfer_products([(self.joinprod(name_prod+suff_prod) + ".fits", name_imaout)
+                                for name_prod, suff_prod, name_imaout in zip(name_products,
+                                    suffix_products, list_nameout)],
+                               name_recipe=name_recipe)
+        self._store_recipe_cache(key, command, list_nameout, name_recipe)
+
@@ -10,8 +10,14 @@ __contact__   = " <eric.emsellem@eso.org>"
 
 # Standard modules
 import os
+import sys
+import subprocess
 from os.path import join as joinpath
 import copy
+import time
+import traceback
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
 
@@ -23,8 +29,12 @@ from .config_pipe import (PHANGS_reduc_config,
                           default_short_filter_list,
                           default_filter_list,
                           default_prefix_wcs,
-                          default_prefix_wcs_mosaic)
+                          default_prefix_wcs_mosaic,
+                          name_job_queue,
+                          list_shared_calib_recipes,
+                          name_shared_masters)
 from .init_musepipe import InitMuseParameters
+from .job_queue import JobQueue, get_job_cpus
 from .combine import MusePointings
 from .align_pipe import rotate_pixtables
 from .mpdaf_pipe import MuseCubeMosaic, MuseCube
@@ -104,6 +114,88 @@ def update_calib_file(filename, subfolder="", folder_config=""):
     new_rc.close()
     old_rc.close()
     return new_filename
+
+
+def split_cpu_pointings(list_cpu, nslots):
+    """Split a list of cpus into nslots disjoint sets of
+    (nearly) equal sizes
+
+    Input
+    -----
+    list_cpu: list of int
+    nslots: int
+
+    Returns
+    -------
+    list_cpu_slots: list of list of int
+    """
+    nslots = max(1, min(nslots, len(list_cpu)))
+    list_cpu_slots, start = [], 0
+    for islot in range(nslots):
+        end = start + (len(list_cpu) - start) // (nslots - islot)
+        list_cpu_slots.append(list(list_cpu[start:end]))
+        start = end
+    return list_cpu_slots
+
+
+def reduce_pointing_process(pipe_kwargs, name_method, method_kwargs, cpus,
+                            history=""):
+    """Create a MusePipe for one pointing and run one of its methods.
+    This is called in a separate process by MusePipeSample, hence the
+    MusePipe is created here from its (picklable) arguments.
+
+    Input
+    -----
+    pipe_kwargs: dict
+        Arguments to initialise the MusePipe
+    name_method: str
+        Name of the MusePipe method to run (e.g., 'run_recipes')
+    method_kwargs: dict
+        Arguments for that method
+    cpus: list of int
+        Cpus to be used by this pointing
+    history: str
+        Python command saved as history of the MusePipe
+
+    Returns
+    -------
+    status: dict
+        Status of the reduction of that pointing, with the name of
+        its log file and the position where this run starts in it
+    """
+    pipe_kwargs = copy.copy(pipe_kwargs)
+    # Disjoint set of cpus for this pointing
+    pipe_kwargs.pop("list_cpu", None)
+    if cpus == list(range(cpus[0], cpus[0] + len(cpus))):
+        pipe_kwargs.update({'first_cpu': cpus[0], 'ncpu': len(cpus), 'list_cpu': []})
+    else:
+        pipe_kwargs.update({'list_cpu': cpus, 'ncpu': len(cpus)})
+
+    status = {'pointing': pipe_kwargs['pointing'], 'status': "failed",
+              'cpus': cpus, 'time': 0., 'log_filename': "", 'log_start': 0,
+              'error': ""}
+    start_time = time.time()
+    pipe = None
+    try:
+        pipe = MusePipe(**pipe_kwargs)
+        status['log_filename'] = pipe.paths.log_filename
+        pipe.flush_logfile()
+        if os.path.isfile(pipe.paths.log_filename):
+            status['log_start'] = os.path.getsize(pipe.paths.log_filename)
+        pipe.history = history
+        pipe.verbose = True
+        # Initialise raw tables if not already done (takes some time)
+        if not pipe._raw_table_initialised:
+            pipe.init_raw_table(overwrite=True)
+        getattr(pipe, name_method)(**method_kwargs)
+        status['status'] = "done"
+    except Exception:
+        status['error'] = traceback.format_exc()
+    # The log is read by the main process
+    if pipe is not None:
+        pipe.flush_logfile()
+    status['time'] = time.time() - start_time
+    return status
 #------------ End of Useful functions -------------#
 
 ####################################################
@@ -160,6 +252,10 @@ class MusePipeTarget(object):
         self.subfolder = subfolder
         self.list_pointings = list_pointings
         self.pipes = PipeDict()
+        # Arguments of the MusePipe of each pointing
+        self.pipe_kwargs = {}
+        # Summary of the last reduction of the pointings in parallel
+        self.summary = None
 
 class MusePipeSample(object):
     def __init__(self, TargetDic, rc_filename=None, cal_filename=None, 
@@ -186,6 +282,22 @@ class MusePipeSample(object):
         PHANGS: bool
             Default to False. If True, will use default configuration dictionary
             from config_pipe.
+        n_parallel_pointings: int
+            Default to 1. Number of pointings reduced at the same time, each
+            in its own process with its own MusePipe. The cpus defined by
+            first_cpu/ncpu (or list_cpu) are split between the pointings.
+        job_queue: str
+            Default to None. Name of the SQLite file of the job queue used
+            by submit_target_jobs and the pymusepipe-worker processes.
+            None means the default name in the root folder of the sample.
+        checkpoint: bool
+            Default to False. If True, the MusePipe of each pointing writes
+            checkpoint markers, and a new reduction of the target skips the
+            completed recipes and resumes at the first incomplete one.
+        shared_calibrations: bool
+            Default to False. If True, reduce_all_targets first reduces
+            the calibration tpls shared by several pointings only once
+            (see reduce_shared_calibrations).
         """
         self.sample = TargetDic
         self.targetnames = list(TargetDic.keys())
@@ -194,6 +306,12 @@ class MusePipeSample(object):
 
         self.__phangs = kwargs.pop("PHANGS", False)
         self.verbose = kwargs.pop("verbose", False)
+        self.n_parallel_pointings = kwargs.pop("n_parallel_pointings", 1)
+        self._job_queue_filename = kwargs.pop("job_queue", None)
+        self.checkpoint = kwargs.pop("checkpoint", False)
+        self.shared_calibrations = kwargs.pop("shared_calibrations", False)
+        # Shared calibration tpls of each (target, pointing)
+        self._dict_shared_calibrations = {}
 
         # Reading configuration filenames
         if rc_filename is None or cal_filename is None:
@@ -380,9 +498,9 @@ class MusePipeSample(object):
         else:
             return True
 
-    def set_pipe_target(self, targetname=None, list_pointings=None, 
-                        **kwargs):
-        """Create the musepipe instance for that target and list of pointings
+    def _get_pipe_kwargs(self, targetname=None, list_pointings=None, **kwargs):
+        """Get the arguments of the MusePipe for each pointing of a target.
+        They are also saved in self.targets[targetname].pipe_kwargs.
 
         Input
         -----
@@ -396,19 +514,20 @@ class MusePipeSample(object):
             to MusePipe. This allows to define a global configuration.
             If self.__phangs is set to True, this is overwritten with the default
             PHANGS configuration parameters as provided in config_pipe.py.
+
+        Returns
+        -------
+        dict_pipe_kwargs: dict
+            For each pointing, the MusePipe arguments and the
+            corresponding python command
         """
         verbose = kwargs.pop("verbose", self.verbose)
         # Check if targetname is valid
         if not self._check_targetname(targetname):
-            return
-
-        # Galaxy name
-        upipe.print_info("=== Initialising MusePipe for Target {name} ===".format(name=targetname))
+            return {}
 
         # Check if pointings are valid
         list_pointings = self._check_pointings_list(targetname, list_pointings)
-        if len(list_pointings) == 0:
-            return
 
         # Get the filename and extension of log file
         log_filename, log_fileext = os.path.splitext(kwargs.pop("log_filename", 
@@ -424,6 +543,8 @@ class MusePipeSample(object):
 
         first_recipe = kwargs.pop("first_recipe", 1)
         last_recipe = kwargs.pop("last_recipe", None)
+        if self.checkpoint and "checkpoint" not in kwargs:
+            kwargs['checkpoint'] = True
 
         # Over-writing the arguments in kwargs from config dictionary
         if config_args is not None:
@@ -439,10 +560,8 @@ class MusePipeSample(object):
         cal_filename = self.targets[targetname].cal_filename
         folder_config = self.targets[targetname].folder_config
 
-        # Loop on the pointings
+        dict_pipe_kwargs = {}
         for pointing in list_pointings:
-            upipe.print_info("Initialise Pipe for Target = {0:10s} / Pointing {1:02d} ".format(
-                                 targetname, pointing))
             # New log file name with pointing included
             log_filename_pointing = "{0}_P{1:02d}{2}".format(
                                     log_filename, pointing, log_fileext)
@@ -454,14 +573,58 @@ class MusePipeSample(object):
                               "{7})".format(targetname, pointing, folder_config, 
                                   rc_filename, cal_filename, log_filename_pointing, 
                                   verbose, list_kwargs))
+            pipe_kwargs = dict(targetname=targetname, pointing=pointing,
+                               folder_config=folder_config, rc_filename=rc_filename,
+                               cal_filename=cal_filename, log_filename=log_filename_pointing,
+                               first_recipe=first_recipe, last_recipe=last_recipe,
+                               init_raw_table=True, verbose=verbose, **kwargs)
+            if (targetname, pointing) in self._dict_shared_calibrations:
+                pipe_kwargs['shared_calibrations'] = \
+                        self._dict_shared_calibrations[(targetname, pointing)]
+            dict_pipe_kwargs[pointing] = (pipe_kwargs, python_command)
+
+        self.targets[targetname].pipe_kwargs.update(dict_pipe_kwargs)
+        return dict_pipe_kwargs
+
+    def set_pipe_target(self, targetname=None, list_pointings=None, 
+                        **kwargs):
+        """Create the musepipe instance for that target and list of pointings
+
+        Input
+        -----
+        targetname: str
+            Name of the target
+        list_pointings: list
+            Pointing numbers. Default is None (meaning all pointings
+            indicated in the dictonary will be reduced)
+        config_args: dic
+            Dictionary including extra configuration parameters to pass
+            to MusePipe. This allows to define a global configuration.
+            If self.__phangs is set to True, this is overwritten with the default
+            PHANGS configuration parameters as provided in config_pipe.py.
+        """
+        # Check if targetname is valid
+        if not self._check_targetname(targetname):
+            return
+
+        # Galaxy name
+        upipe.print_info("=== Initialising MusePipe for Target {name} ===".format(name=targetname))
+
+        # Check if pointings are valid
+        list_pointings = self._check_pointings_list(targetname, list_pointings)
+        if len(list_pointings) == 0:
+            return
+
+        dict_pipe_kwargs = self._get_pipe_kwargs(targetname, list_pointings, **kwargs)
+
+        # Loop on the pointings
+        for pointing in list_pointings:
+            upipe.print_info("Initialise Pipe for Target = {0:10s} / Pointing {1:02d} ".format(
+                                 targetname, pointing))
+            pipe_kwargs, python_command = dict_pipe_kwargs[pointing]
 
             # Creating the musepipe instance, using the shortcut
-            self.pipes[targetname][pointing] = MusePipe(
-                targetname=targetname, pointing=pointing,
-                folder_config=folder_config, rc_filename=rc_filename,
-                cal_filename=cal_filename, log_filename=log_filename_pointing,
-                first_recipe=first_recipe, last_recipe=last_recipe,
-                init_raw_table=True, verbose=verbose, **kwargs)
+            self.pipes[targetname][pointing] = MusePipe(**pipe_kwargs)
 
             # Saving the command
             self.pipes[targetname][pointing].history = python_command
@@ -472,6 +635,132 @@ class MusePipeSample(object):
         upipe.print_info("End of Pipe initialisation")
         self.pipes[targetname]._initialised = True
 
+    def _run_pointings_parallel(self, targetname, list_pointings, name_method,
+                                dict_method_kwargs, n_parallel_pointings=None):
+        """Run a MusePipe method on several pointings at the same time,
+        each pointing in its own process with a disjoint set of cpus.
+        The MusePipe arguments are the ones saved by set_pipe_target
+        (or _get_pipe_kwargs).
+
+        Input
+        -----
+        targetname: str
+            Name of the target
+        list_pointings: list
+            Pointing numbers
+        name_method: str
+            Name of the MusePipe method to run (e.g., 'run_recipes')
+        dict_method_kwargs: dict
+            Arguments of the method for each pointing
+        n_parallel_pointings: int
+            Number of pointings reduced at the same time.
+            Default is self.n_parallel_pointings
+
+        Returns
+        -------
+        summary: astropy Table
+            Status, cpus, time and log file of each pointing. Also
+            saved in self.targets[targetname].summary.
+        """
+        if n_parallel_pointings is None:
+            n_parallel_pointings = self.n_parallel_pointings
+
+        # All cpus, as defined for the first pointing
+        target_kwargs = self.targets[targetname].pipe_kwargs
+        missing = [pointing for pointing in list_pointings if pointing not in target_kwargs]
+        if len(missing) > 0:
+            self._get_pipe_kwargs(targetname, missing)
+        list_cpu = get_job_cpus(target_kwargs[list_pointings[0]][0])
+        free_slots = split_cpu_pointings(list_cpu, 
+                                         min(n_parallel_pointings, len(list_pointings)))
+        upipe.print_info("Reducing {0} pointings of Target {1} with {2} "
+                         "processes".format(len(list_pointings), targetname, 
+                                            len(free_slots)))
+
+        pending = list(list_pointings)
+        running = {}
+        list_status = []
+        with ProcessPoolExecutor(max_workers=len(free_slots)) as executor:
+            while pending or running:
+                while pending and free_slots:
+                    pointing = pending.pop(0)
+                    cpus = free_slots.pop(0)
+                    pipe_kwargs, python_command = target_kwargs[pointing]
+                    upipe.print_info("====== START - POINTING {0:2d} [cpus {1}-{2}] "
+                                     "======".format(pointing, cpus[0], cpus[-1]))
+                    future = executor.submit(reduce_pointing_process, pipe_kwargs,
+                                             name_method, dict_method_kwargs[pointing],
+                                             cpus, python_command)
+                    running[future] = (pointing, cpus)
+
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    pointing, cpus = running.pop(future)
+                    free_slots.append(cpus)
+                    if future.exception() is not None:
+                        status = {'pointing': pointing, 'status': "failed", 'cpus': cpus,
+                                  'time': 0., 'log_filename': "", 'log_start': 0,
+                                  'error': repr(future.exception())}
+                    else:
+                        status = future.result()
+                    list_status.append(status)
+                    upipe.print_info("====== END   - POINTING {0:2d} [{1} in {2:.1f}s] "
+                                     "======".format(pointing, status['status'], 
+                                                     status['time']))
+
+        return self._summarise_pointings(targetname, list_status)
+
+    def _summarise_pointings(self, targetname, list_status):
+        """Gather the status of the pointings reduced in parallel into
+        a Table and write their logs into a single log file
+        in the target folder.
+
+        Input
+        -----
+        targetname: str
+        list_status: list of dict
+            Status returned by reduce_pointing_process for each pointing
+
+        Returns
+        -------
+        summary: astropy Table
+        """
+        list_status = sorted(list_status, key=lambda status: status['pointing'])
+        summary = Table(rows=[[status['pointing'], status['status'], len(status['cpus']),
+                               "{0}-{1}".format(status['cpus'][0], status['cpus'][-1]),
+                               status['time'], status['log_filename']]
+                              for status in list_status],
+                        names=['pointing', 'status', 'ncpu', 'cpus', 'time', 'log_filename'],
+                        dtype=[int, 'U10', int, 'U20', float, 'U300'])
+        summary['time'].format = "{:.1f}"
+        self.targets[targetname].summary = summary
+
+        # Aggregated log of this run for all pointings
+        log_summary = joinpath(self.targets[targetname].data_path,
+                               "{0}_pointings_{1}.log".format(targetname, 
+                                                              upipe.create_time_name()))
+        with open(log_summary, "w") as flog:
+            flog.write("\n".join(summary.pformat(max_lines=-1, max_width=-1)) + "\n")
+            for status in list_status:
+                flog.write("\n# ====== POINTING {0:2d} - {1} ======\n".format(
+                           status['pointing'], status['status']))
+                if os.path.isfile(status['log_filename']):
+                    with open(status['log_filename'], "r") as fpointing:
+                        fpointing.seek(status['log_start'])
+                        flog.write(fpointing.read())
+                if status['error'] != "":
+                    flog.write(status['error'])
+
+        for line in summary.pformat(max_lines=-1, max_width=-1):
+            upipe.print_info(line)
+        nfailed = np.sum(summary['status'] != "done")
+        if nfailed > 0:
+            upipe.print_error("{0} pointing(s) failed for Target {1} - see "
+                              "{2}".format(nfailed, targetname, log_summary))
+        else:
+            upipe.print_info("All pointings done - log in {0}".format(log_summary))
+        return summary
+
     def  _get_path_data(self, targetname, pointing):
         """Get the path for the data
         Parameters
@@ -514,11 +803,266 @@ class MusePipeSample(object):
         last_recipe: int or str
             One of the recipe to end with
         """
+        if self.shared_calibrations:
+            self.reduce_shared_calibrations()
         for target in self.targets:
             upipe.print_info("=== Start Reduction of Target {name} ===".format(name=target))
             self.reduce_target(targetname=target, **kwargs)
             upipe.print_info("===  End  Reduction of Target {name} ===".format(name=target))
 
+    def find_shared_calibrations(self, list_targets=None, min_pointings=2):
+        """Find the calibration tpls shared by several pointings, namely
+        with the same tpl and the same raw files in their raw tables
+
+        Input
+        -----
+        list_targets: list of str
+            Names of the targets. Default is None (all targets)
+        min_pointings: int [2]
+            Minimum number of pointings sharing a tpl
+
+        Returns
+        -------
+        dict_shared: dict
+            For each calibration recipe (e.g., 'bias'), a dictionary with
+            (tpl, raw files) as keys and the list of (target, pointing)
+            sharing them as values
+        """
+        if list_targets is None:
+            list_targets = self.targetnames
+
+        dict_shared = {recipe: {} for recipe in list_shared_calib_recipes}
+        for targetname in list_targets:
+            if not self._check_targetname(targetname):
+                continue
+            if not self.pipes[targetname]._initialised:
+                self.set_pipe_target(targetname=targetname)
+            for pointing in self._check_pointings_list(targetname, None):
+                pipe = self.pipes[targetname][pointing]
+                if not pipe._raw_table_initialised:
+                    pipe.init_raw_table(overwrite=True)
+                for recipe in list_shared_calib_recipes:
+                    for tpl, list_files in pipe.get_calib_tpl_keys(recipe).items():
+                        dict_shared[recipe].setdefault((tpl, list_files), []).append(
+                                (targetname, pointing))
+
+        for recipe in dict_shared:
+            dict_shared[recipe] = {key: dict_shared[recipe][key] for key in dict_shared[recipe]
+                                   if len(dict_shared[recipe][key]) >= min_pointings}
+        return dict_shared
+
+    def reduce_shared_calibrations(self, list_targets=None, min_pointings=2, illum=True):
+        """Reduce once the calibration tpls shared by several pointings
+        (bias, flat, wave, lsf and twilight), in recipe order.
+        The first pointing sharing a tpl reduces it. Its master products
+        are moved to the shared master folder of the sample and linked
+        in the Master folders of all the pointings sharing it, and the
+        tpl is added to their master tables. The run_* recipes of these
+        pointings then skip it.
+
+        The shared recipes use the masters (e.g., the bias for a flat)
+        of the first pointing, which are expected to be shared too when
+        the calibrations come from the same night.
+
+        Input
+        -----
+        list_targets: list of str
+            Names of the targets. Default is None (all targets)
+        min_pointings: int [2]
+            Minimum number of pointings sharing a tpl
+        illum: bool [True]
+            Use the illumination frames for the twilight recipe
+
+        Returns
+        -------
+        dict_shared: dict
+            Shared tpls, as given by find_shared_calibrations
+        """
+        dict_shared = self.find_shared_calibrations(list_targets, min_pointings)
+        folder_root = joinpath(self.root_path, name_shared_masters)
+        nsaved = 0
+        for recipe in list_shared_calib_recipes:
+            for (tpl, list_files), list_pipes in dict_shared[recipe].items():
+                # One folder per set of raw files, as a tpl could
+                # have different files in different pointings
+                key = hashlib.sha1("\n".join(list_files).encode('utf-8')).hexdigest()[:10]
+                folder_shared = joinpath(folder_root, "{0}_{1}_{2}".format(recipe, tpl, key))
+                targetname, pointing = list_pipes[0]
+                owner = self.pipes[targetname][pointing]
+                list_shared = [joinpath(folder_shared, os.path.basename(name_prod))
+                               for name_prod in owner.get_calib_products(recipe, tpl)]
+                if not all(os.path.isfile(name) for name in list_shared):
+                    upipe.print_info("Reducing shared {0} tpl {1} with {2} P{3:02d} "
+                                     "({4} pointings)".format(recipe, tpl, targetname,
+                                     pointing, len(list_pipes)))
+                    owner._shared_calibrations.get(recipe, set()).discard(tpl)
+                    if recipe == "twilight":
+                        owner.run_twilight(tpl=tpl, illum=illum)
+                    else:
+                        getattr(owner, "run_{0}".format(recipe))(tpl=tpl)
+                nsaved += len(list_pipes) - 1
+
+                for targetname, pointing in list_pipes:
+                    self.pipes[targetname][pointing].link_shared_calibration(recipe, tpl,
+                                                                             folder_shared)
+                    shared_pointing = self._dict_shared_calibrations.setdefault(
+                                            (targetname, pointing), {})
+                    shared_pointing.setdefault(recipe, [])
+                    if tpl not in shared_pointing[recipe]:
+                        shared_pointing[recipe].append(tpl)
+
+        # The pipes created from now on skip the shared tpls
+        for targetname, pointing in self._dict_shared_calibrations:
+            if pointing in self.targets[targetname].pipe_kwargs:
+                self.targets[targetname].pipe_kwargs[pointing][0]['shared_calibrations'] = \
+                        self._dict_shared_calibrations[(targetname, pointing)]
+        upipe.print_info("Shared calibrations: {0} recipe runs saved".format(nsaved))
+        return dict_shared
+
+    def _get_job_queue(self):
+        """Get the job queue shared by the workers. The default file is
+        in the root folder of the sample.
+        """
+        if self._job_queue_filename is None:
+            self._job_queue_filename = joinpath(self.root_path, name_job_queue)
+        return JobQueue(self._job_queue_filename)
+
+    def submit_target_jobs(self, targetname=None, list_pointings=None, **kwargs):
+        """Submit the reduction of the pointings of one target to the
+        job queue, one job per pointing. The jobs are run by the
+        pymusepipe-worker processes.
+
+        Input
+        -----
+        targetname: str
+            Name of the target
+        list_pointings: list
+            Pointing numbers. Default is None (meaning all pointings
+            indicated in the dictonary will be reduced)
+        first_recipe: str or int [1]
+        last_recipe: str or int [max of all recipes]
+            Name or number of the first and last recipes to process
+        force: bool [False]
+            Submit the jobs even if the same ones were already done
+
+        Returns
+        -------
+        list_ids: list of int
+            Identifiers of the jobs in the queue
+        """
+        force = kwargs.pop("force", False)
+        param_recipes = kwargs.pop("param_recipes", {})
+        kwargs_recipe = {}
+        for key, default in zip(['fraction', 'skymethod', 'illum'],
+                                [0.8, "model", True]):
+            kwargs_recipe[key] = kwargs.pop(key, default)
+        name_method = "run_phangs_recipes" if self.__phangs else "run_recipes"
+
+        dict_pipe_kwargs = self._get_pipe_kwargs(targetname=targetname,
+                                                 list_pointings=list_pointings, **kwargs)
+        queue = self._get_job_queue()
+        list_ids = []
+        for pointing in dict_pipe_kwargs:
+            pipe_kwargs, python_command = dict_pipe_kwargs[pointing]
+            list_ids.append(queue.submit(targetname, pointing, pipe_kwargs, name_method,
+                                         dict(param_recipes=param_recipes, **kwargs_recipe),
+                                         python_command, force=force))
+        upipe.print_info("Submitted {0} job(s) for Target {1} in {2}".format(
+                         len(list_ids), targetname, queue.filename))
+        return list_ids
+
+    def submit_all_targets(self, **kwargs):
+        """Submit the reduction of all targets to the job queue
+
+        Returns
+        -------
+        list_ids: list of int
+            Identifiers of the jobs in the queue
+        """
+        list_ids = []
+        for target in self.targets:
+            list_ids.extend(self.submit_target_jobs(targetname=target, **kwargs))
+        return list_ids
+
+    def wait_for_jobs(self, list_ids=None, poll_time=30., timeout=None):
+        """Wait for the jobs of the queue to be done (or failed)
+
+        Input
+        -----
+        list_ids: list of int
+            Jobs to wait for. Default is None (all jobs of the queue)
+        poll_time: float
+            Time (s) between two checks of the queue
+        timeout: float
+            Maximum time (s) to wait. Default is None (no limit)
+
+        Returns
+        -------
+        summary: astropy Table
+            Status of each job. Also saved in self.jobs_summary.
+        """
+        list_jobs = self._get_job_queue().wait(list_ids, poll_time=poll_time,
+                                               timeout=timeout)
+        self.jobs_summary = Table(rows=[[job['id'], job['targetname'], job['pointing'],
+                                         job['first_recipe'], job['last_recipe'],
+                                         job['status'], job['worker'], job['attempts']]
+                                        for job in list_jobs],
+                                  names=['id', 'targetname', 'pointing', 'first_recipe',
+                                         'last_recipe', 'status', 'worker', 'attempts'],
+                                  dtype=[int, 'U30', int, 'U30', 'U30', 'U10', 'U60', int])
+        for line in self.jobs_summary.pformat(max_lines=-1, max_width=-1):
+            upipe.print_info(line)
+        for job in list_jobs:
+            if job['status'] == "failed":
+                upipe.print_error("Job {0} failed [Target {1} - Pointing {2:02d}]"
+                                  "\n{3}".format(job['id'], job['targetname'], 
+                                                 job['pointing'], job['error']))
+        return self.jobs_summary
+
+    def reduce_all_targets_queue(self, n_local_workers=0, poll_time=30., 
+                                 timeout=None, **kwargs):
+        """Reduce all targets via the job queue and wait for the end of
+        all jobs, e.g., before the alignment and mosaicking.
+
+        Input
+        -----
+        n_local_workers: int [0]
+            Number of pymusepipe-worker processes started on this node,
+            each with its own set of cpus (the cpus of the jobs split
+            between the workers). With 0, the workers are expected to be
+            started separately (e.g., on other nodes) with the queue
+            file as argument.
+        poll_time: float
+            Time (s) between two checks of the queue
+        timeout: float
+            Maximum time (s) to wait. Default is None (no limit)
+        **kwargs:
+            Passed to submit_target_jobs
+
+        Returns
+        -------
+        summary: astropy Table
+            Status of each job
+        """
+        list_ids = self.submit_all_targets(**kwargs)
+        queue = self._get_job_queue()
+        list_workers = []
+        list_jobs = queue.get_jobs(list_ids) if n_local_workers > 0 else []
+        if len(list_jobs) > 0:
+            # Disjoint sets of cpus for the local workers
+            list_cpu = get_job_cpus(list_jobs[0]['pipe_kwargs'])
+            for cpus in split_cpu_pointings(list_cpu, n_local_workers):
+                upipe.print_info("Starting a local worker [cpus {0}]".format(
+                                 ",".join(str(cpu) for cpu in cpus)))
+                list_workers.append(subprocess.Popen([sys.executable, "-m",
+                                                      "pymusepipe.job_queue",
+                                                      queue.filename, "--list-cpu",
+                                                      ",".join(str(cpu) for cpu in cpus)]))
+        summary = self.wait_for_jobs(list_ids, poll_time=poll_time, timeout=timeout)
+        for worker in list_workers:
+            worker.wait()
+        return summary
+
     def reduce_target_prealign(self, targetname=None, list_pointings=None, **kwargs):
         """Reduce target for all steps before pre-alignment (included)
 
@@ -651,6 +1195,9 @@ class MusePipeSample(object):
             targetname:
             list_pointings:
             **kwargs:
+                n_parallel_pointings (int): number of pointings processed
+                at the same time. If larger than 1, returns the summary
+                Table of the pointings.
 
         Returns:
 
@@ -682,7 +1229,10 @@ class MusePipeSample(object):
         folder_ref_wcs = kwargs.pop("folder_ref_wcs", default_comb_folder)
         filter_list = kwargs.pop("filter_list", self._short_filter_list)
 
+        n_parallel_pointings = kwargs.pop("n_parallel_pointings", self.n_parallel_pointings)
+
         # Running the scipost_perexpo for all pointings individually
+        dict_method_kwargs = {}
         for pointing in list_pointings:
             if wcs_auto:
                 ref_wcs = "{0}_P{1:02d}.fits".format(wcs_suffix, np.int(pointing))
@@ -702,7 +1252,15 @@ class MusePipeSample(object):
                                'prefix_all': prefix_all,
                                'save': save}
             kwargs.update(kwargs_pointing)
-            self.pipes[targetname][pointing].run_scipost_perexpo(**kwargs)
+            if n_parallel_pointings > 1:
+                dict_method_kwargs[pointing] = copy.copy(kwargs)
+            else:
+                self.pipes[targetname][pointing].run_scipost_perexpo(**kwargs)
+
+        if n_parallel_pointings > 1:
+            return self._run_pointings_parallel(targetname, list_pointings,
+                                                "run_scipost_perexpo", dict_method_kwargs,
+                                                n_parallel_pointings)
 
     def run_target_recipe(self, recipe_name, targetname=None,
                           list_pointings=None, **kwargs):
@@ -716,6 +1274,9 @@ class MusePipeSample(object):
         list_pointings: list
             Pointing numbers. Default is None (meaning all pointings
             indicated in the dictonary will be reduced)
+        n_parallel_pointings: int [self.n_parallel_pointings]
+            Number of pointings reduced at the same time. If larger than 1,
+            returns the summary Table of the reduction of the pointings.
         """
         # General print out
         upipe.print_info("---- Starting the Recipe {0} for Target={1} "
@@ -725,9 +1286,15 @@ class MusePipeSample(object):
         for key, default in zip(['fraction', 'skymethod', 'illum'],
                                 [0.8, "model", True]):
             kwargs_recipe[key] = kwargs.pop(key, default)
+        n_parallel_pointings = kwargs.pop("n_parallel_pointings", self.n_parallel_pointings)
 
         # Initialise the pipe if needed
-        self.set_pipe_target(targetname=targetname, list_pointings=list_pointings,
+        # (in parallel mode, each process creates its own pipe)
+        if n_parallel_pointings > 1:
+            self._get_pipe_kwargs(targetname=targetname, list_pointings=list_pointings,
+                first_recipe=recipe_name, last_recipe=recipe_name, **kwargs)
+        else:
+            self.set_pipe_target(targetname=targetname, list_pointings=list_pointings,
                 first_recipe=recipe_name, last_recipe=recipe_name, **kwargs)
 
         # Check if pointings are valid
@@ -738,18 +1305,24 @@ class MusePipeSample(object):
         # some parameters which depend on the pointings for this recipe
         kwargs_per_pointing = kwargs.pop("kwargs_per_pointing", {})
         param_recipes = kwargs.pop("param_recipes", {})
+        name_method = "run_phangs_recipes" if self.__phangs else "run_recipes"
 
         # Loop on the pointings
+        dict_method_kwargs = {}
         for pointing in list_pointings:
-            upipe.print_info("====== START - POINTING {0:2d} "
-                             "======".format(pointing))
-
             this_param_recipes = copy.deepcopy(param_recipes)
             if pointing in kwargs_per_pointing:
                 if recipe_name in kwargs_per_pointing[pointing]:
                     this_param_recipes[recipe_name].update(
                                      kwargs_per_pointing[pointing][recipe_name])
 
+            if n_parallel_pointings > 1:
+                dict_method_kwargs[pointing] = dict(param_recipes=this_param_recipes,
+                                                    **kwargs_recipe)
+                continue
+
+            upipe.print_info("====== START - POINTING {0:2d} "
+                             "======".format(pointing))
             # Initialise raw tables if not already done (takes some time)
             if not self.pipes[targetname][pointing]._raw_table_initialised:
                 self.pipes[targetname][pointing].init_raw_table(overwrite=True)
@@ -761,6 +1334,10 @@ class MusePipeSample(object):
                                                              **kwargs_recipe)
             upipe.print_info("====== END   - POINTING {0:2d} ======".format(pointing))
 
+        if n_parallel_pointings > 1:
+            return self._run_pointings_parallel(targetname, list_pointings, name_method,
+                                                dict_method_kwargs, n_parallel_pointings)
+
     def reduce_target(self, targetname=None, list_pointings=None, **kwargs):
         """Reduce one target for a list of pointings
 
@@ -774,6 +1351,12 @@ class MusePipeSample(object):
         first_recipe: str or int [1]
         last_recipe: str or int [max of all recipes]
             Name or number of the first and last recipes to process
+        n_parallel_pointings: int [self.n_parallel_pointings]
+            Number of pointings reduced at the same time. If larger than 1,
+            returns the summary Table of the reduction of the pointings.
+
+        With checkpoints (see MusePipeSample), the recipes already
+        completed for a pointing are skipped.
         """
         # General print out
         upipe.print_info("---- Starting the Data Reduction for Target={0} ----".format(
@@ -786,13 +1369,32 @@ class MusePipeSample(object):
                                 [0.8, "model", True]):
             kwargs_recipe[key] = kwargs.pop(key, default)
 
+        n_parallel_pointings = kwargs.pop("n_parallel_pointings", self.n_parallel_pointings)
+
+        # Check if pointings are valid
+        checked_pointings = self._check_pointings_list(targetname, list_pointings)
+
+        # In parallel mode, each process creates its own pipe
+        if n_parallel_pointings > 1:
+            if len(checked_pointings) == 0:
+                return
+            if "first_recipe" in kwargs or "last_recipe" in kwargs \
+                    or any(pointing not in self.targets[targetname].pipe_kwargs
+                           for pointing in checked_pointings):
+                self._get_pipe_kwargs(targetname=targetname,
+                                      list_pointings=checked_pointings, **kwargs)
+            name_method = "run_phangs_recipes" if self.__phangs else "run_recipes"
+            dict_method_kwargs = {pointing: dict(param_recipes=param_recipes, **kwargs_recipe)
+                                  for pointing in checked_pointings}
+            return self._run_pointings_parallel(targetname, checked_pointings, name_method,
+                                                dict_method_kwargs, n_parallel_pointings)
+
         # Initialise the pipe if needed
         if not self.pipes[targetname]._initialised  \
             or "first_recipe" in kwargs or "last_recipe" in kwargs:
             self.set_pipe_target(targetname=targetname, list_pointings=list_pointings, **kwargs)
 
-        # Check if pointings are valid
-        list_pointings = self._check_pointings_list(targetname, list_pointings)
+        list_pointings = checked_pointings
         if len(list_pointings) == 0:
             return
 
@@ -0,0 +1,262 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS trace module. Records nested timing spans (wall time,
+cpu time of the process and of its child processes, peak memory) for
+the stages of the pipeline, and exports them as a Chrome trace
+(chrome://tracing or https://ui.perfetto.dev) or as a summary table.
+
+The peak memory (ru_maxrss) is the high-water mark over the lifetime
+of the process (or of its largest child process) at the end of the
+span. Its growth during the span is also recorded: it is only non-zero
+for the spans which raised the high-water mark.
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+import time
+import json
+import functools
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from astropy.table import Table
+
+
+def _get_rusage():
+    """Return the cpu time (s) of the child processes and the peak
+    memory (MB) of the process and of its largest child process
+    """
+    if resource is None:
+        return 0., 0., 0.
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (child_usage.ru_utime + child_usage.ru_stime,
+            self_usage.ru_maxrss / 1024., child_usage.ru_maxrss / 1024.)
+
+
+class Span(object):
+    """Timing span of one stage
+    """
+    __slots__ = ["name", "category", "args", "start", "wall", "cpu", "thread_cpu",
+                 "child_cpu", "peak_rss", "peak_child_rss", "rss_growth",
+                 "child_rss_growth", "depth", "parent", "pid", "tid"]
+
+
+class Tracer(object):
+    """Recorder of the timing spans of a process. The spans are nested
+    within each thread. Nothing is recorded if not enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Remove all the recorded spans
+        """
+        with self._lock:
+            self.spans = []
+            self._origin = time.perf_counter()
+            self._origin_time = time.time()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def depth(self):
+        """Number of open spans in the current thread
+        """
+        return len(self._stack())
+
+    @contextmanager
+    def span(self, name, category="python", **kwargs):
+        """Context recording a span
+
+        Input
+        -----
+        name: str
+            Name of the span (e.g., the function)
+        category: str ['python']
+            Category of the span (e.g., 'run', 'recipe', 'table')
+        **kwargs:
+            Arguments saved with the span (e.g., the tpl)
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        stack = self._stack()
+        span = Span()
+        span.name, span.category = name, category
+        span.args = {key: kwargs[key] for key in kwargs if kwargs[key] is not None}
+        span.depth = len(stack)
+        span.parent = stack[-1].name if stack else None
+        span.pid, span.tid = os.getpid(), threading.get_ident()
+        stack.append(span)
+        child_cpu0, peak_rss0, peak_child_rss0 = _get_rusage()
+        cpu0, thread_cpu0 = time.process_time(), time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            end = time.perf_counter()
+            child_cpu, span.peak_rss, span.peak_child_rss = _get_rusage()
+            span.start = start - self._origin
+            span.wall = end - start
+            span.cpu = time.process_time() - cpu0
+            span.thread_cpu = time.thread_time() - thread_cpu0
+            span.child_cpu = child_cpu - child_cpu0
+            span.rss_growth = span.peak_rss - peak_rss0
+            span.child_rss_growth = span.peak_child_rss - peak_child_rss0
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def export_chrome_trace(self, filename):
+        """Write the spans as Chrome trace events (JSON)
+        """
+        with self._lock:
+            list_spans = list(self.spans)
+        list_events = []
+        for span in sorted(list_spans, key=lambda span: span.start):
+            args = dict(span.args)
+            args.update({'cpu_s': round(span.cpu, 6),
+                         'thread_cpu_s': round(span.thread_cpu, 6),
+                         'child_cpu_s': round(span.child_cpu, 6),
+                         'peak_rss_mb': round(span.peak_rss, 1),
+                         'peak_child_rss_mb': round(span.peak_child_rss, 1),
+                         'rss_growth_mb': round(span.rss_growth, 1),
+                         'child_rss_growth_mb': round(span.child_rss_growth, 1)})
+            list_events.append({'name': span.name, 'cat': span.category, 'ph': "X",
+                                'ts': span.start * 1.e6, 'dur': span.wall * 1.e6,
+                                'pid': span.pid, 'tid': span.tid, 'args': args})
+        with open(filename, "w") as ftrace:
+            json.dump({'traceEvents': list_events, 'displayTimeUnit': "ms",
+                       'otherData': {'start_time': time.strftime(
+                           "%d-%m-%Y %H:%M:%S", time.localtime(self._origin_time))}},
+                      ftrace, default=str)
+
+    def summary(self):
+        """Summary table of the spans, grouped by category and name,
+        sorted by decreasing total wall time
+
+        Returns
+        -------
+        summary: astropy Table
+            With the number of calls, the total, mean and maximum wall
+            time, the time spent in the span itself (without its
+            sub-spans), the cpu time
+            of the process and of the child processes (e.g., esorex),
+            the peak memory (lifetime high-water mark) and its maximum
+            growth during a span
+        """
+        with self._lock:
+            list_spans = list(self.spans)
+        # Wall time of the sub-spans, to get the time spent in each span itself
+        children = {}
+        for span in list_spans:
+            if span.parent is not None:
+                children[span.parent] = children.get(span.parent, 0.) + span.wall
+
+        dict_stats = {}
+        for span in list_spans:
+            key = (span.category, span.name)
+            stats = dict_stats.setdefault(key, {'ncalls': 0, 'wall': 0., 'max_wall': 0.,
+                                                'cpu': 0., 'child_cpu': 0.,
+                                                'peak_rss': 0., 'peak_child_rss': 0.,
+                                                'rss_growth': 0., 'child_rss_growth': 0.})
+            stats['ncalls'] += 1
+            stats['wall'] += span.wall
+            stats['max_wall'] = max(stats['max_wall'], span.wall)
+            stats['cpu'] += span.cpu
+            stats['child_cpu'] += span.child_cpu
+            stats['peak_rss'] = max(stats['peak_rss'], span.peak_rss)
+            stats['peak_child_rss'] = max(stats['peak_child_rss'], span.peak_child_rss)
+            stats['rss_growth'] = max(stats['rss_growth'], span.rss_growth)
+            stats['child_rss_growth'] = max(stats['child_rss_growth'],
+                                            span.child_rss_growth)
+
+        rows = []
+        for (category, name), stats in sorted(dict_stats.items(),
+                                              key=lambda item: -item[1]['wall']):
+            rows.append([category, name, stats['ncalls'], stats['wall'],
+                         stats['wall'] / stats['ncalls'], stats['max_wall'],
+                         max(0., stats['wall'] - children.get(name, 0.)),
+                         stats['cpu'], stats['child_cpu'],
+                         stats['peak_rss'], stats['peak_child_rss'],
+                         stats['rss_growth'], stats['child_rss_growth']])
+        names = ['category', 'name', 'ncalls', 'wall', 'mean_wall', 'max_wall',
+                 'self_wall', 'cpu', 'child_cpu', 'peak_rss', 'peak_child_rss',
+                 'rss_growth', 'child_rss_growth']
+        dtype = ['U16', 'U64', 'i8'] + ['f8'] * 10
+        summary = Table(rows=rows, names=names, dtype=dtype) if rows \
+                  else Table(names=names, dtype=dtype)
+        for name in names[3:9]:
+            summary[name].unit = "s"
+            summary[name].format = "{0:.3f}"
+        for name in names[9:]:
+            summary[name].unit = "MB"
+            summary[name].format = "{0:.1f}"
+        return summary
+
+    def write_summary(self, filename):
+        """Write the summary table in an ascii file
+        """
+        self.summary().write(filename, format="ascii.fixed_width_two_line",
+                             overwrite=True)
+
+
+_tracer = Tracer()
+# The spans of the parent are not those of a forked process
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_tracer.reset)
+
+
+def get_tracer():
+    """Return the tracer of the process
+    """
+    return _tracer
+
+
+def trace_span(name, category="python", **kwargs):
+    """Context recording a span with the tracer of the process
+    (see Tracer.span)
+    """
+    return _tracer.span(name, category=category, **kwargs)
+
+
+def traced(category="python", name=None):
+    """Decorator recording a span for each call of a function
+
+    Input
+    -----
+    category: str ['python']
+    name: str [None]
+        Name of the span. Default is the name of the function.
+    """
+    def decorator(func):
+        name_span = func.__name__ if name is None else name
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            if not _tracer.enabled:
+                return func(*args, **kwargs)
+            with _tracer.span(name_span, category=category):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
@@ -0,0 +1,272 @@
+# Licensed under a MIT license - see LICENSE
+
+"""MUSE-PHANGS usage module. Keeps the resources used by each esorex
+run (wall time, user and system cpu time, peak memory, input and output
+bytes) in a SQLite database shared by the pipes, and reports them per
+recipe (percentiles) and per number of cpus (scaling).
+"""
+
+__authors__   = "Eric Emsellem"
+__copyright__ = "(c) 2017, ESO + CRAL"
+__license__   = "MIT License"
+__contact__   = " <eric.emsellem@eso.org>"
+
+# Standard modules
+import os
+import re
+import time
+import socket
+import sqlite3
+
+# Numpy
+import numpy as np
+
+from astropy.table import Table
+
+# Name of the database when only a folder is given
+default_usage_db = "pymusepipe_usage.sqlite"
+# Time (s) to wait for a database locked by another pipe
+usage_db_timeout = 60.
+# Columns of the records, with their SQL type
+list_usage_columns = [('time', "REAL"), ('host', "TEXT"), ('target', "TEXT"),
+                      ('pointing', "INTEGER"), ('recipe', "TEXT"), ('tpl', "TEXT"),
+                      ('ncpu', "INTEGER"), ('nifu', "INTEGER"), ('wall', "REAL"),
+                      ('utime', "REAL"), ('stime', "REAL"), ('maxrss', "REAL"),
+                      ('input_bytes', "INTEGER"), ('output_bytes', "INTEGER"),
+                      ('returncode', "INTEGER"), ('command', "TEXT")]
+# Recipe in an esorex command
+esorex_recipe_pattern = re.compile(r"\s(muse_\w+)\s")
+
+
+def get_sof_bytes(command):
+    """Total size (bytes) of the input files of the SOF files of a command
+
+    Input
+    -----
+    command: str
+        The sof files are the arguments ending with '.sof'
+
+    Returns
+    -------
+    int
+    """
+    nbytes = 0
+    for sof in command.split():
+        if not sof.endswith(".sof") or not os.path.isfile(sof):
+            continue
+        with open(sof, "r") as fsof:
+            for line in fsof:
+                words = line.split()
+                if len(words) > 0 and os.path.isfile(words[0]):
+                    nbytes += os.path.getsize(words[0])
+    return nbytes
+
+
+def get_folder_bytes(folder):
+    """Total size (bytes) of the files of a folder (not recursive)
+    """
+    nbytes = 0
+    if folder is None or not os.path.isdir(folder):
+        return nbytes
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                nbytes += entry.stat().st_size
+    return nbytes
+
+
+def get_esorex_recipe(command, default=None):
+    """Name of the esorex recipe (e.g., muse_bias) of a command
+    """
+    match = esorex_recipe_pattern.search(" {0} ".format(command))
+    return match.group(1) if match is not None else default
+
+
+class UsageDB(object):
+    """SQLite database of the resources used by the esorex runs.
+    Several pipes (threads or processes) can write in the same file.
+    """
+    def __init__(self, filename=default_usage_db):
+        """Initialise the database
+
+        Input
+        -----
+        filename: str
+            Name of the database file. A folder means default_usage_db
+            in that folder.
+        """
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, default_usage_db)
+        self.filename = filename
+        conn = self._connect()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS recipe_usage ({0})".format(
+                         ", ".join(["{0} {1}".format(name, sqltype)
+                                    for name, sqltype in list_usage_columns])))
+            conn.execute("CREATE INDEX IF NOT EXISTS recipe_usage_recipe "
+                         "ON recipe_usage (recipe, ncpu)")
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=usage_db_timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def add_record(self, record):
+        """Add one record
+
+        Input
+        -----
+        record: dict
+            With (some of) the columns of list_usage_columns.
+            The time and host are added if missing.
+        """
+        record = dict(record)
+        record.setdefault('time', time.time())
+        record.setdefault('host', socket.gethostname())
+        names = [name for name, _ in list_usage_columns]
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT INTO recipe_usage ({0}) VALUES ({1})".format(
+                         ", ".join(names), ", ".join(["?"] * len(names))),
+                         [record.get(name) for name in names])
+        conn.close()
+
+    def get_records(self, recipe=None, target=None, host=None, successful=True):
+        """Get the records as a Table
+
+        Input
+        -----
+        recipe: str [None]
+        target: str [None]
+        host: str [None]
+            Only the records of that recipe, target or host if given
+        successful: bool [True]
+            Only the runs with a zero exit code
+
+        Returns
+        -------
+        records: astropy Table
+        """
+        list_conditions, list_values = [], []
+        for name, value in zip(['recipe', 'target', 'host'], [recipe, target, host]):
+            if value is not None:
+                list_conditions.append("{0} = ?".format(name))
+                list_values.append(value)
+        if successful:
+            list_conditions.append("returncode = 0")
+        query = "SELECT {0} FROM recipe_usage".format(
+                ", ".join([name for name, _ in list_usage_columns]))
+        if len(list_conditions) > 0:
+            query += " WHERE " + " AND ".join(list_conditions)
+        conn = self._connect()
+        rows = conn.execute(query + " ORDER BY time", list_values).fetchall()
+        conn.close()
+
+        names = [name for name, _ in list_usage_columns]
+        dtype = [{'REAL': 'f8', 'INTEGER': 'i8', 'TEXT': 'U'}[sqltype]
+                 for _, sqltype in list_usage_columns]
+        if len(rows) == 0:
+            return Table(names=names, dtype=[d if d != 'U' else 'U1' for d in dtype])
+        columns = [[(-1 if d == 'i8' else np.nan) if value is None else value
+                    for value in column] if d != 'U'
+                   else ["" if value is None else value for value in column]
+                   for column, d in zip(zip(*rows), dtype)]
+        return Table(columns, names=names)
+
+    def recipe_percentiles(self, column="wall", percentiles=[50, 90, 99], **kwargs):
+        """Percentiles of a quantity for each recipe
+
+        Input
+        -----
+        column: str ['wall']
+            Quantity (e.g., 'wall', 'utime', 'maxrss', 'output_bytes')
+        percentiles: list of float [50, 90, 99]
+        **kwargs:
+            Selection of the records (see get_records)
+
+        Returns
+        -------
+        stats: astropy Table
+            Number of runs, mean and percentiles for each recipe
+        """
+        records = self.get_records(**kwargs)
+        names = ['recipe', 'nruns', 'mean'] + ["p{0:g}".format(p) for p in percentiles]
+        rows = []
+        for recipe in np.unique(records['recipe']):
+            values = np.asarray(records[column][records['recipe'] == recipe], dtype=float)
+            rows.append([recipe, len(values), np.mean(values)]
+                        + list(np.percentile(values, percentiles)))
+        if len(rows) == 0:
+            return Table(names=names, dtype=['U1', 'i8'] + ['f8'] * (len(names) - 2))
+        return Table(rows=rows, names=names)
+
+    def ncpu_scaling(self, recipe=None, **kwargs):
+        """Scaling of the recipes with the number of cpus
+
+        Input
+        -----
+        recipe: str [None]
+            Only that recipe if given
+        **kwargs:
+            Selection of the records (see get_records)
+
+        Returns
+        -------
+        scaling: astropy Table
+            For each recipe and ncpu: number of runs, median wall time,
+            median cpu time (user + system), median wall time per input
+            GB, speedup and parallel efficiency with respect to the
+            smallest ncpu of that recipe (from the median wall times)
+        """
+        records = self.get_records(recipe=recipe, **kwargs)
+        names = ['recipe', 'ncpu', 'nruns', 'wall', 'cpu', 'wall_per_gb',
+                 'speedup', 'efficiency']
+        rows = []
+        for name in np.unique(records['recipe']):
+            select = records[records['recipe'] == name]
+            list_ncpu = np.unique(select['ncpu'])
+            ref_ncpu, ref_wall = None, None
+            for ncpu in list_ncpu:
+                runs = select[select['ncpu'] == ncpu]
+                wall = np.median(runs['wall'])
+                cpu = np.median(runs['utime'] + runs['stime'])
+                gbytes = np.asarray(runs['input_bytes'], dtype=float) / 1.e9
+                wall_per_gb = np.median(runs['wall'][gbytes > 0] / gbytes[gbytes > 0]) \
+                              if np.any(gbytes > 0) else np.nan
+                if ref_ncpu is None:
+                    ref_ncpu, ref_wall = ncpu, wall
+                speedup = ref_wall / wall if wall > 0 else np.nan
+                rows.append([name, ncpu, len(runs), wall, cpu, wall_per_gb, speedup,
+                             speedup * ref_ncpu / ncpu])
+        if len(rows) == 0:
+            return Table(names=names, dtype=['U1', 'i8', 'i8'] + ['f8'] * 5)
+        return Table(rows=rows, names=names)
+
+    def predict_time(self, recipe, ncpu, input_bytes=None, percentile=50, **kwargs):
+        """Predict the wall time of a recipe, from the runs with the
+        closest number of cpus
+
+        Input
+        -----
+        recipe: str
+        ncpu: int
+        input_bytes: int [None]
+            If given, the time is scaled with the input size
+        percentile: float [50]
+
+        Returns
+        -------
+        float: wall time (s), nan if the recipe was never run
+        """
+        records = self.get_records(recipe=recipe, **kwargs)
+        if len(records) == 0:
+            return np.nan
+        list_ncpu = np.unique(records['ncpu'])
+        closest = list_ncpu[np.argmin(np.abs(list_ncpu - ncpu))]
+        runs = records[records['ncpu'] == closest]
+        if input_bytes is not None and np.any(runs['input_bytes'] > 0):
+            runs = runs[runs['input_bytes'] > 0]
+            return np.percentile(runs['wall'] / runs['input_bytes'], percentile) \
+                   * input_bytes
+        return np.percentile(runs['wall'], percentile)
@@ -48,7 +48,7 @@ def print_warning(text, **kwargs):
     toprint = "# MusePipeWarning " + text
     mypipe = kwargs.pop("pipe", None)
     try:
-        mypipe.write_logfile(toprint)
+        mypipe.write_logfile(toprint, level="warning")
     except:
         pass
     try:
@@ -71,7 +71,7 @@ def print_info(text, **kwargs):
     toprint = "# MusePipeInfo " + text
     mypipe = kwargs.pop("pipe", None)
     try:
-        mypipe.write_logfile(toprint)
+        mypipe.write_logfile(toprint, level="info")
     except:
         pass
     try:
@@ -112,7 +112,7 @@ def print_error(text, **kwargs):
     toprint = "# MusePipeError " + text
     mypipe = kwargs.pop("pipe", None)
     try:
-        mypipe.write_logfile(toprint)
+        mypipe.write_logfile(toprint, level="error")
     except:
         pass
     try:
@@ -428,6 +428,117 @@ def reconstruct_filter_images(cubename, filter_list=default_filter_list,
                   filter_list, cubename, filter_fits_file)
     os.system(command)
 
+# FITS blocks and cards sizes
+fits_block_size = 2880
+fits_card_size = 80
+
+def _normalise_keyword(keyword):
+    """Normalise a FITS keyword as used in the primary header reader:
+    upper case, without the HIERARCH prefix and with single spaces
+    """
+    words = keyword.upper().split()
+    if len(words) > 0 and words[0] == "HIERARCH":
+        words = words[1:]
+    return " ".join(words)
+
+def _parse_card_value(valuestr):
+    """Parse the value of a FITS card (the part after the '=')
+    Raise a ValueError if the value is not a simple string, logical,
+    integer or float.
+    """
+    valuestr = valuestr.strip()
+    # String values, with '' being an escaped quote
+    if valuestr.startswith("'"):
+        chunks = []
+        start = 1
+        while True:
+            end = valuestr.find("'", start)
+            if end < 0:
+                raise ValueError("Unterminated string in FITS card")
+            chunks.append(valuestr[start:end])
+            if valuestr[end + 1:end + 2] == "'":
+                chunks.append("'")
+                start = end + 2
+            else:
+                break
+        return "".join(chunks).rstrip()
+
+    # Removing the comment
+    value = valuestr.split("/", 1)[0].strip()
+    if value == "T":
+        return True
+    if value == "F":
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        return float(value.replace("D", "E"))
+
+def read_primary_keywords(filename, keywords, max_blocks=100):
+    """Read a set of keywords from the primary header of a fits file
+    without building a full astropy Header. Only the first blocks of
+    the file, up to the END card, are read. If anything unusual is
+    found (no SIMPLE or END card, long strings, complex values...), it
+    falls back on astropy.
+
+    Input
+    -----
+    filename: str
+        Name of the fits file (including .fits.fz files)
+    keywords: list of str
+        Keywords to extract. HIERARCH keywords can be given with or
+        without the HIERARCH prefix (e.g., 'ESO DPR TYPE').
+    max_blocks: int [100]
+        Maximum number of 2880 bytes blocks to read before giving up
+
+    Returns
+    -------
+    values: dict
+        Values for the keywords found in the header, using the input
+        keywords as keys. Missing keywords are not included.
+    """
+    dict_keys = {}
+    for key in keywords:
+        dict_keys.setdefault(_normalise_keyword(key), []).append(key)
+    values = {}
+    try:
+        with open(filename, "rb") as fitsfile:
+            for nblock in range(max_blocks):
+                block = fitsfile.read(fits_block_size)
+                if len(block) < fits_block_size:
+                    raise ValueError("Truncated header")
+                if nblock == 0 and not block.startswith(b"SIMPLE  ="):
+                    raise ValueError("Not a primary FITS header")
+                text = block.decode("ascii")
+                for icard in range(0, fits_block_size, fits_card_size):
+                    card = text[icard:icard + fits_card_size]
+                    key = card[:8].rstrip()
+                    if key == "END":
+                        return values
+                    if key == "HIERARCH":
+                        ind = card.find("=")
+                        if ind < 0:
+                            continue
+                        key = _normalise_keyword(card[8:ind])
+                        valuestr = card[ind + 1:]
+                    elif card[8:10] == "= ":
+                        valuestr = card[10:]
+                    else:
+                        continue
+                    # Only the first occurrence is kept, as astropy does
+                    if key not in dict_keys or dict_keys[key][0] in values:
+                        continue
+                    value = _parse_card_value(valuestr)
+                    # Long strings (CONTINUE convention) go through astropy
+                    if isinstance(value, str) and value.endswith("&"):
+                        raise ValueError("Long string value")
+                    for inkey in dict_keys[key]:
+                        values[inkey] = value
+        raise ValueError("No END card found")
+    except (OSError, ValueError, UnicodeDecodeError):
+        header = pyfits.getheader(filename, 0)
+        return {key: header[key] for key in keywords if key in header}
+
 def add_key_pointing_expo(imaname, iexpo, pointing):
     """Add pointing and expo number to image
 
@@ -437,11 +548,20 @@ def add_key_pointing_expo(imaname, iexpo, pointing):
     iexpo: int
     pointing: int
     """
+    # Do not rewrite the image if the keywords are already there
+    keys = read_primary_keywords(imaname, ['MUSEPIPE_POINTING', 'MUSEPIPE_IEXPO'])
+    if keys.get('MUSEPIPE_POINTING') == pointing \
+            and keys.get('MUSEPIPE_IEXPO') == iexpo:
+        print_info("Keywords MUSEPIPE_POINTING/EXPO already set for image {}".format(
+            imaname))
+        return
+
     # Writing the pointing and iexpo in the IMAGE_FOV
     this_image = pyfits.open(imaname, mode='update')
     this_image[0].header['MUSEPIPE_POINTING'] = (pointing, "Pointing number")
     this_image[0].header['MUSEPIPE_IEXPO'] = (iexpo, "Exposure number")
     this_image.flush()
+    this_image.close()
     print_info("Keywords MUSEPIPE_POINTING/EXPO updated for image {}".format(
         imaname))
 